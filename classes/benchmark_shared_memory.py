@@ -0,0 +1,103 @@
+"""
+Benchmark of large values through SharedDataClient: pickled into the
+message vs passed through shared memory (see SharedValue).
+
+    python benchmark_shared_memory.py
+    python benchmark_shared_memory.py --sizes 65536 1048576 134217728 --number 5
+
+For each size a NumPy array (or, without NumPy, bytes) is stored and read
+back with shared_memory_min_bytes=None, which keeps it in the message, and
+with the default threshold. Reports the median time of set_data and of
+get_data, and whether the value read shares memory with the segment.
+
+Importing process_share_manager also starts the default shared manager on
+port 50000, as it does for any other user of the module; it is stopped at
+the end.
+"""
+import argparse
+import multiprocessing
+import os
+import statistics
+import sys
+import time
+from contextlib import suppress
+
+import process_share_manager as psm
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def run_server(port):
+    # the server prints every SET/GET; measure the transfer, not the terminal
+    sys.stdout = open(os.devnull, 'w')
+    psm.ProcessSharedObject(port=port).start()
+
+
+def make_value(size):
+    if numpy is None:
+        return os.urandom(size)
+    return numpy.random.default_rng(1).random(size // 8)
+
+
+def median_seconds(func, number):
+    timings = []
+    for _ in range(number):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def bench(port, sizes, number):
+    server = multiprocessing.Process(target=run_server, args=(port,))
+    server.start()
+    try:
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                psm.SharedDataClient(port=port).has_data('benchmark')
+                break
+            except OSError:
+                if time.monotonic() >= deadline:
+                    raise
+                time.sleep(0.05)
+        for size in sizes:
+            value = make_value(size)
+            for label, min_bytes in (('message', None), ('shared', psm.SHARED_MEMORY_MIN_BYTES)):
+                client = psm.SharedDataClient(port=port, shared_memory_min_bytes=min_bytes)
+                set_time = median_seconds(lambda: client.set_data('benchmark', value), number)
+                get_time = median_seconds(lambda: client.get_data('benchmark'), number)
+                zero_copy = isinstance(client.send_command('GET', 'benchmark'), psm.SharedValue)
+                print(f"{size:>12}{label:>10}{set_time * 1000:>10.3f}{get_time * 1000:>10.3f}"
+                      f"{'yes' if zero_copy else 'no':>11}")
+                client.close()
+    finally:
+        # KILL first: the server unlinks its segments when it shuts down
+        with suppress(OSError):
+            psm.SharedDataClient(port=port).send_command('KILL')
+        server.kill()
+        server.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark large values through shared memory.")
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[64 * 1024, 256 * 1024, 1024 * 1024, 16 * 1024 * 1024, 64 * 1024 * 1024],
+                        help="value sizes in bytes")
+    parser.add_argument('--number', type=int, default=10, help="repetitions of each measurement")
+    parser.add_argument('--port', type=int, default=50500)
+    args = parser.parse_args()
+
+    print(f"{'bytes':>12}{'via':>10}{'set ms':>10}{'get ms':>10}{'zero-copy':>11}")
+    bench(args.port, args.sizes, args.number)
+    # the manager importing process_share_manager started isn't needed after all
+    manager = psm.ProcessSharedObject.manager_process
+    manager.kill()
+    manager.join()
+
+
+if __name__ == '__main__':
+    main()
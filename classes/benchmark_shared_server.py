@@ -0,0 +1,129 @@
+"""
+Benchmark of the ProcessSharedObject server modes: a thread per client
+connection (the default) vs a single selectors event loop (event_loop=True).
+
+    python benchmark_shared_server.py
+    python benchmark_shared_server.py --connections 10 1000 5000 --clients 4 --seconds 3
+    python benchmark_shared_server.py --transport unix
+
+For each mode and connection count the server runs in its own process with
+that many idle client connections held open, while --clients processes
+issue SET/GET pairs on their persistent connections for --seconds. Reports
+the server's thread count and the throughput in ops/s.
+
+Importing process_share_manager also starts the default shared manager on
+port 50000, as it does for any other user of the module; it is stopped at
+the end.
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+import process_share_manager as psm
+
+
+def run_server(port, event_loop, backlog, transport):
+    # the server prints every SET/GET; measure the server, not the terminal
+    sys.stdout = open(os.devnull, 'w')
+    psm.ProcessSharedObject(port=port, event_loop=event_loop, backlog=backlog, transport=transport).start()
+
+
+def run_client(port, transport, seconds, results):
+    client = psm.SharedDataClient(port=port, transport=transport)
+    key = f'bench:{os.getpid()}'
+    ops = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        client.set_data(key, ops)
+        client.get_data(key)
+        ops += 2
+    results.put(ops)
+
+
+def server_threads(pid):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('Threads:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def connect(port, transport, timeout=10):
+    # a client holds its connection open between commands
+    client = psm.SharedDataClient(port=port, transport=transport)
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            client.has_data('benchmark')
+            return client
+        except OSError:
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(0.05)
+
+
+def bench(port, transport, event_loop, connections, clients, seconds):
+    server = multiprocessing.Process(target=run_server, args=(port, event_loop, max(128, connections), transport))
+    server.start()
+    idle = [connect(port, transport)]
+    try:
+        for _ in range(connections - 1):
+            idle.append(connect(port, transport))
+        # let the server finish accepting before counting its threads
+        time.sleep(0.5)
+        threads = server_threads(server.pid)
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=run_client, args=(port, transport, seconds, results))
+                   for _ in range(clients)]
+        for worker in workers:
+            worker.start()
+        ops = sum(results.get() for _ in workers)
+        for worker in workers:
+            worker.join()
+        return threads, ops / seconds
+    finally:
+        for client in idle:
+            client.close()
+        server.kill()
+        server.join()
+        if transport == 'unix':
+            os.remove(psm.socket_path(port))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the ProcessSharedObject server modes.")
+    parser.add_argument('--connections', type=int, nargs='+', default=[10, 1000],
+                        help="idle client connections held open during each run")
+    parser.add_argument('--clients', type=int, default=4, help="client processes issuing commands")
+    parser.add_argument('--seconds', type=float, default=3, help="duration of each run")
+    parser.add_argument('--transport', choices=psm.TRANSPORTS, default='tcp')
+    parser.add_argument('--port', type=int, default=50100)
+    args = parser.parse_args()
+
+    # one descriptor per idle connection in this process and in the server
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = max(args.connections) + 256
+    if soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(wanted, hard), hard))
+
+    print(f"{'server':<12}{'connections':>12}{'threads':>10}{'ops/s':>12}")
+    for event_loop in (False, True):
+        for connections in args.connections:
+            threads, rate = bench(args.port, args.transport, event_loop, connections, args.clients, args.seconds)
+            args.port += 1
+            label = 'event loop' if event_loop else 'threaded'
+            print(f"{label:<12}{connections:>12}{threads if threads is not None else '?':>10}{rate:>12.0f}")
+    # the manager importing process_share_manager started isn't needed after all
+    manager = psm.ProcessSharedObject.manager_process
+    manager.kill()
+    manager.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+Benchmark of the ProcessSharedObject transports: TCP loopback vs the Unix
+socket local servers use by default.
+
+    python benchmark_shared_transport.py
+    python benchmark_shared_transport.py --number 5000 --sizes 16 65536 1048576
+
+For each transport a server runs in its own process and a single client
+times GET round trips of values of each size, reporting the median and
+99th percentile latency.
+
+Importing process_share_manager also starts the default shared manager on
+port 50000, as it does for any other user of the module; it is stopped at
+the end.
+"""
+import argparse
+import multiprocessing
+import os
+import statistics
+import sys
+import time
+
+import process_share_manager as psm
+
+
+def run_server(port, transport):
+    # the server prints every SET/GET; measure the transport, not the terminal
+    sys.stdout = open(os.devnull, 'w')
+    psm.ProcessSharedObject(port=port, transport=transport).start()
+
+
+def connect(port, transport, timeout=10):
+    client = psm.SharedDataClient(port=port, transport=transport)
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            client.has_data('benchmark')
+            return client
+        except OSError:
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(0.05)
+
+
+def bench(port, transport, sizes, number):
+    server = multiprocessing.Process(target=run_server, args=(port, transport))
+    server.start()
+    try:
+        client = connect(port, transport)
+        results = []
+        for size in sizes:
+            client.set_data('benchmark', b'x' * size)
+            # fewer round trips for large values, which take far longer each
+            count = max(50, number * 1024 // max(size, 1024))
+            timings = []
+            for _ in range(count):
+                start = time.perf_counter()
+                client.get_data('benchmark')
+                timings.append(time.perf_counter() - start)
+            timings.sort()
+            results.append((size, statistics.median(timings), timings[int(len(timings) * 0.99)]))
+        client.close()
+        return results
+    finally:
+        server.kill()
+        server.join()
+        if transport == 'unix':
+            os.remove(psm.socket_path(port))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the ProcessSharedObject transports.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[16, 64 * 1024, 1024 * 1024],
+                        help="value sizes in bytes")
+    parser.add_argument('--number', type=int, default=2000, help="round trips for values up to 1KB")
+    parser.add_argument('--port', type=int, default=50300)
+    args = parser.parse_args()
+
+    print(f"{'transport':<11}{'bytes':>10}{'median µs':>12}{'p99 µs':>10}")
+    for port, transport in enumerate(('tcp', 'unix'), start=args.port):
+        for size, median, p99 in bench(port, transport, args.sizes, args.number):
+            print(f"{transport:<11}{size:>10}{median * 1e6:>12.1f}{p99 * 1e6:>10.1f}")
+    # the manager importing process_share_manager started isn't needed after all
+    manager = psm.ProcessSharedObject.manager_process
+    manager.kill()
+    manager.join()
+
+
+if __name__ == '__main__':
+    main()
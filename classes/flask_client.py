@@ -1,14 +1,155 @@
+import gzip
+import json
+import random
 import threading
 import time
 import requests
 import os
+import pickle
+from collections import OrderedDict
+from contextlib import contextmanager
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+
+class WatchError(Exception):
+    """
+    A key watched by a transaction was written by someone else before it ran.
+    """
+
+
+# Keep-alive sessions shared by every FlaskClient in the process, keyed by
+# their transport settings, so Streamlit reruns and listener threads reuse
+# pooled sockets instead of opening a new connection per command.
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(pool_size=10, retries=3, backoff_factor=0.2):
+    key = (pool_size, retries, backoff_factor)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            # POST is not idempotent: retry only when the request never reached
+            # the app (connect errors) or the server reports being unavailable.
+            retry = Retry(total=retries, connect=retries, read=0, status=retries,
+                          status_forcelist=(502, 503, 504), allowed_methods=None,
+                          backoff_factor=backoff_factor, raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                                  max_retries=retry)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[key] = session
+        return session
+
+
+class VersionCache:
+    """
+    Values read with conditional GETs from one server, key -> (version,
+    pickled value, store revision it was last checked at), least recently
+    used evicted beyond max_entries. Values are kept pickled so that each
+    read gets its own copy, and a caller modifying it doesn't change what
+    the other clients of the process are served.
+    """
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def update(self, entries):
+        with self.lock:
+            for key, entry in entries.items():
+                self.entries[key] = entry
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+# Version caches shared by every FlaskClient in the process, keyed by server
+# URL, so a client built on each Streamlit rerun still gets conditional hits.
+_version_caches = {}
+_version_caches_lock = threading.Lock()
+
+
+def get_version_cache(server_url, max_entries=1000):
+    with _version_caches_lock:
+        cache = _version_caches.get(server_url)
+        if cache is None:
+            cache = _version_caches[server_url] = VersionCache(max_entries)
+        return cache
+
+
+def encode_body(data, content_type):
+    if content_type == MSGPACK:
+        return msgpack.packb(data, use_bin_type=True)
+    return json.dumps(data, separators=(',', ':')).encode()
+
+
+def decode_body(response):
+    if response.headers.get('Content-Type', '').startswith(MSGPACK):
+        return msgpack.unpackb(response.content, raw=False, strict_map_key=False)
+    return response.json()
+
+
+def with_options(args, **options):
+    """
+    Appends the non-None options as a trailing dict argument (e.g. SET/PUSH ttl).
+    """
+    options = {k: v for k, v in options.items() if v is not None}
+    return args + [options] if options else args
 
 
 class FlaskClient:
-    def __init__(self, host=None, port=None, asynchronous=False):
+    def __init__(self, host=None, port=None, asynchronous=False, long_poll=True, poll_timeout=10,
+                 pool_size=10, connect_timeout=3.05, read_timeout=30, retries=3, backoff_factor=0.2,
+                 delta_reads=False, wire_format=None, compress_threshold=0, trim_consumed=True):
         if host is None or port is None:
             host, port = self.get_host_port()
-        self.base_url = f"http://{host}:{port}/command"
+        self.server_url = f"http://{host}:{port}"
+        self.base_url = f"{self.server_url}/command"
+        self.session = get_session(pool_size, retries, backoff_factor)
+        self.connect_timeout = connect_timeout
+        self.timeout = (connect_timeout, read_timeout)
+        # MessagePack when available: faster for large values and carries bytes.
+        # compress_threshold > 0 gzips request bodies of that many bytes or more and
+        # accepts compressed responses; it only pays off over slow links, so it is off
+        # by default (see flask/benchmark_wire.py)
+        if wire_format is None:
+            wire_format = 'json' if msgpack is None else 'msgpack'
+        self.content_type = MSGPACK if wire_format == 'msgpack' else JSON
+        self.compress_threshold = compress_threshold
+        # long_poll: block on the server /wait endpoint instead of polling every few seconds
+        self.long_poll = long_poll
+        self.poll_timeout = poll_timeout
+        # delta_reads: leave events on the server and only fetch the entries
+        # after the last id seen per key, instead of draining them.
+        # trim_consumed: each read also drops the entries the previous one
+        # returned, so the event lists don't grow without limit; this client
+        # must then be the only listener of its events. With several listeners
+        # turn it off and bound the lists instead (set_queue_limit / QUEUE_MAXLEN)
+        self.delta_reads = delta_reads
+        self.trim_consumed = trim_consumed
+        self.last_seen = {}
+        # store revision of the last non-blocking poll of each set of events;
+        # like last_seen it describes what this client has read
+        self.poll_revisions = {}
+        # versioned values for conditional GETs
+        self.version_cache = get_version_cache(self.server_url)
         self.listeners = {}
         self.listener_thread = None
         self.asynchronous = asynchronous
@@ -33,39 +174,433 @@ class FlaskClient:
 
         return host, port
 
-    def _send_command(self, command, args=None):
+    def _post(self, url, data, timeout):
+        """
+        POSTs data in the client wire format and returns the response.
+        Responses are decompressed by requests.
+        """
+        headers = {'Content-Type': self.content_type, 'Accept': self.content_type,
+                   'Accept-Encoding': 'gzip' if self.compress_threshold else 'identity'}
+        body = encode_body(data, self.content_type)
+        if self.compress_threshold and len(body) >= self.compress_threshold:
+            body = gzip.compress(body, compresslevel=1)
+            headers['Content-Encoding'] = 'gzip'
+        return self.session.post(url, data=body, headers=headers, timeout=timeout)
+
+    def _send_command(self, command, args=None, timeout=None):
         try:
             data = {'command': command, 'args': args or []}
-            response = requests.post(self.base_url, json=data)
+            response = self._post(self.base_url, data, timeout or self.timeout)
+            response.raise_for_status()
+            return decode_body(response).get('result')
+        except requests.RequestException as e:
+            print(f"Error sending command {command}: {self._error_message(e)}")
+            return None
+
+    @staticmethod
+    def _error_message(e):
+        # prefer the reason given by the store (e.g. OOM) over the bare HTTP status
+        try:
+            return decode_body(e.response)['error']
+        except Exception:
+            return e
+
+    def _send_commands(self, commands):
+        try:
+            response = self._post(self.base_url, {'commands': commands}, self.timeout)
+            response.raise_for_status()
+            body = decode_body(response)
+            for index, error in (body.get('errors') or {}).items():
+                print(f"Error in pipelined command {commands[int(index)]['command']}: {error}")
+            return body.get('results')
+        except requests.RequestException as e:
+            print(f"Error sending pipeline of {len(commands)} commands: {e}")
+            return None
+
+    @contextmanager
+    def pipeline(self):
+        """
+        Buffers the commands issued on the yielded FlaskPipeline and sends them
+        in a single request when the block exits. The results are then
+        available, in order, as pipe.results.
+        """
+        pipe = FlaskPipeline(self)
+        yield pipe
+        pipe.execute()
+
+    def transaction(self, func, *keys, retries=10):
+        """
+        Optimistic transaction: calls func(tx) with a FlaskTransaction
+        watching keys. func reads with tx.get_data() (which watches the keys
+        it reads too) and then queues writes on tx; they are applied
+        atomically only if none of the watched keys changed in the meantime,
+        otherwise func is called again, up to retries times. Returns the
+        results of the queued commands.
+
+            def toggle(tx):
+                running = (tx.get_data('is_running') or {}).get('is_running')
+                tx.set_data('is_running', not running)
+            client.transaction(toggle, 'is_running')
+        """
+        for attempt in range(retries):
+            tx = FlaskTransaction(self)
+            tx.watch(*keys)
+            func(tx)
+            try:
+                return tx.execute()
+            except WatchError:
+                # back off a little so competing writers don't keep colliding
+                time.sleep(random.uniform(0, min(0.5, 0.005 * 2 ** attempt)))
+        raise WatchError(f"Transaction on {list(keys)} still conflicting after {retries} attempts")
+
+    def get_versioned(self, key):
+        """
+        Returns (value, version) of key for compare_and_set(); the version
+        of a missing key is 0.
+        """
+        result = self._send_command('GET', [key, {}])
+        if result is None:
+            return None, None
+        version, value = result['values'].get(key, (0, None))
+        return value, version
+
+    def compare_and_set(self, key, version, value, ttl=None):
+        """
+        Sets key to value only if it still has the version read with
+        get_versioned(). Returns the new version, or None if someone else
+        wrote the key in the meantime.
+        """
+        return self._send_command('CAS', with_options([key, version, value], ttl=ttl))
+
+    def wait_for_data(self, keys, timeout=None, drain=False):
+        """
+        Blocks server-side until one of the keys holds a value or the timeout expires.
+        Returns the same shape as get_data on a list of keys (None on timeout).
+        With drain=True the returned keys are removed in the same request.
+        """
+        if not isinstance(keys, list):
+            keys = [keys]
+        timeout = self.poll_timeout if timeout is None else timeout
+        try:
+            data = {'keys': keys, 'timeout': timeout, 'drain': drain}
+            # leave some slack over the server timeout before giving up on the socket
+            response = self._post(f"{self.server_url}/wait", data, (self.connect_timeout, timeout + 5))
+            response.raise_for_status()
+            return decode_body(response).get('result')
+        except requests.RequestException as e:
+            print(f"Error waiting for {keys}: {e}")
+            # avoid a hot loop if the server is unreachable
+            time.sleep(1)
+            return None
+
+    def wait_for_entries(self, after, timeout=None, count=None, trim=False):
+        """
+        Blocks server-side until one of the keys in after ({key: last_seen_id})
+        has newer entries, and returns them like read_since (None on timeout).
+        """
+        timeout = self.poll_timeout if timeout is None else timeout
+        try:
+            data = {'after': after, 'timeout': timeout, 'count': count, 'trim': trim}
+            response = self._post(f"{self.server_url}/wait", data, (self.connect_timeout, timeout + 5))
             response.raise_for_status()
-            return response.json().get('result')
+            return decode_body(response).get('result')
         except requests.RequestException as e:
-            print(f"Error sending command {command}: {e}")
+            print(f"Error waiting for {list(after)}: {e}")
+            time.sleep(1)
+            return None
+
+    def _fetch_events(self, event_names, non_blocking=False):
+        if self.delta_reads:
+            return self._fetch_new_entries(event_names, non_blocking)
+        # events are consumed as they are read, in a single request
+        if self.long_poll and not non_blocking:
+            return self.wait_for_data(event_names, drain=True)
+        return self._poll_if_modified('DRAIN', event_names, event_names)
+
+    def _poll_if_modified(self, command, event_names, args, options=None):
+        """
+        Sends a DRAIN/READ with the store revision seen by the previous poll
+        of the same events; the server skips the read if nothing was written.
+        """
+        names = tuple(sorted(event_names))
+        options = dict(options or {}, revision=self.poll_revisions.get(names))
+        result = self._send_command(command, args + [options])
+        # None: not modified (or failed), the revision still holds
+        if result is None:
             return None
+        self.poll_revisions[names] = result['revision']
+        return result['values']
+
+    def _fetch_new_entries(self, event_names, non_blocking):
+        after = {name: self.last_seen.get(name, 0) for name in event_names}
+        if self.long_poll and not non_blocking:
+            entries = self.wait_for_entries(after, trim=self.trim_consumed)
+        else:
+            options = {'trim': True} if self.trim_consumed else None
+            entries = self._poll_if_modified('READ', event_names, [after], options)
+        if not entries:
+            return None
+        for name, items in entries.items():
+            self.last_seen[name] = items[-1][0]
+        return {name: [value for entry_id, value in items] for name, items in entries.items()}
+
+    def set_data(self, key, value, ttl=None):
+        return self._send_command('SET', with_options([key, value], ttl=ttl))
 
-    def set_data(self, key, value):
-        return self._send_command('SET', [key, value])
+    def get_data(self, keys, path=None):
+        """
+        Returns a dict of the keys that hold a value, or None if none does.
+        The versions of the values already fetched are sent along, and the
+        server only returns the values that changed since.
 
-    def get_data(self, keys):
-        if isinstance(keys, list):
-            return self._send_command('GET', keys)
+        With a path such as 'messages[-5:]' or 'config.llm' only that part of
+        each value is returned (and not cached), see flask/paths.py.
+        """
+        if not isinstance(keys, list):
+            keys = [keys]
+        if path is not None:
+            return self._send_command('GET', keys + [{'path': path}])
+        known = {}
+        for key in keys:
+            entry = self.version_cache.get(key)
+            if entry is not None:
+                known[key] = entry
+        options = {'versions': {key: entry[0] for key, entry in known.items()}}
+        if keys and all(key in known for key in keys):
+            options['revision'] = min(entry[2] for entry in known.values())
+        result = self._send_command('GET', keys + [options])
+        if result is None:
+            return None
+        revision = result['revision']
+        if result.get('not_modified') is True:
+            unchanged, changed = keys, {}
         else:
-            return self._send_command('GET', [keys])
+            unchanged, changed = result['not_modified'], result['values']
+        entries = {}
+        values = {}
+        for key in keys:
+            if key in changed:
+                version, value = changed[key]
+                pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            elif key in unchanged:
+                version, pickled, _ = known[key]
+                value = pickle.loads(pickled)
+            else:
+                version, value, pickled = 0, None, None
+            entries[key] = (version, pickled, revision)
+            if value is not None:
+                values[key] = value
+        self.version_cache.update(entries)
+        return values or None
 
     def delete_data(self, key):
         return self._send_command('DELETE', [key]) == True
 
-    def enqueue(self, key, value):
-        current_data = self.get_data(key)
-        if current_data is None:
-            current_data = []
-        elif not isinstance(current_data, list):
-            current_data = [current_data]
-        current_data.append(value)
-        return self.set_data(key, current_data)
+    def get_path(self, key, path):
+        """
+        Returns the part of the value at key that path addresses, or None.
+        """
+        result = self.get_data(key, path)
+        return None if result is None else result.get(key)
+
+    def set_path(self, key, path, value):
+        """
+        Sets the part of the value at key that path addresses, without
+        sending the rest of the value.
+        """
+        return self._send_command('SETPATH', [key, path, value]) == True
+
+    def append_path(self, key, path, value):
+        """
+        Appends value to the list at path inside the value at key, e.g.
+        append_path('chat', 'messages', message). Returns the list length.
+        """
+        return self._send_command('SETPATH', [key, path, value, {'append': True}])
+
+    def enqueue(self, key, value, ttl=None, maxlen=None, overflow=None, timeout=None):
+        """
+        Appends value to the list at key server-side. Returns the new list
+        length, or None if it was rejected because the list is full.
+        A ttl (seconds) refreshes the expiry of the list. maxlen bounds the
+        list, otherwise the limit set with set_queue_limit() applies; when it
+        is full, overflow is 'drop_oldest' (default), 'drop_newest', 'reject'
+        or 'block', which waits up to timeout seconds for room.
+        """
+        args = with_options([key, value], ttl=ttl, maxlen=maxlen, overflow=overflow, timeout=timeout)
+        # leave some slack over a blocking push before giving up on the socket
+        return self._send_command('PUSH', args, timeout=timeout and (self.connect_timeout, timeout + 5))
+
+    def set_queue_limit(self, key, maxlen, overflow='drop_oldest'):
+        """
+        Bounds the list at key (e.g. an event queue) to maxlen entries for
+        every producer; see enqueue() for the overflow policies. maxlen 0
+        makes it unbounded, None restores the server default.
+        """
+        return self._send_command('QUEUE_LIMIT', [key, maxlen, {'overflow': overflow}])
+
+    def queue_info(self, keys):
+        """
+        Returns {key: {"length", "maxlen", "overflow", "dropped", "rejected"}},
+        to spot consumers that fall behind.
+        """
+        return self._send_command('QUEUE_INFO', keys if isinstance(keys, list) else [keys])
+
+    def hset(self, key, mapping):
+        """
+        Sets fields of the hash at key without sending the rest of it.
+        Returns the number of new fields.
+        """
+        return self._send_command('HSET', [key, mapping])
+
+    def hget(self, key, field):
+        return self._send_command('HGET', [key, field])
+
+    def hgetall(self, key):
+        """
+        Returns the hash at key as a dict, or None if it is missing.
+        """
+        return self._send_command('HGETALL', [key])
+
+    def hdel(self, key, fields):
+        return self._send_command('HDEL', [key, fields if isinstance(fields, list) else [fields]])
+
+    def incrby(self, key, amount=1):
+        """
+        Atomically adds amount to the integer counter at key. Returns the new value.
+        """
+        return self._send_command('INCRBY', [key, amount])
+
+    def sadd(self, key, members):
+        """
+        Adds members to the set at key. Returns the number of members added.
+        """
+        return self._send_command('SADD', [key, members if isinstance(members, list) else [members]])
+
+    def srem(self, key, members):
+        return self._send_command('SREM', [key, members if isinstance(members, list) else [members]])
+
+    def smembers(self, key):
+        """
+        Returns the members of the set at key as a set (empty if it is missing).
+        """
+        return set(self._send_command('SMEMBERS', [key]) or [])
+
+    def read_since(self, after, count=None, trim=False):
+        """
+        Delta read of list values: after maps keys to the last entry id seen
+        (0 for none). Returns {key: [[id, value], ...]} for the keys with
+        newer entries, or None. Nothing is removed unless trim is set, which
+        first drops the entries up to the ids in after (single consumer only).
+        """
+        return self._send_command('READ', with_options([after], count=count, trim=trim or None))
+
+    def drain_data(self, keys):
+        """
+        Atomically reads and deletes the given keys. Returns a dict of the keys
+        that held a value, or None if none did.
+        """
+        if not isinstance(keys, list):
+            keys = [keys]
+        return self._send_command('DRAIN', keys)
+
+    def fire_event(self, key, value, ttl=None):
+        return self.enqueue(key, value, ttl)
+
+    def expire(self, key, ttl):
+        """
+        Sets the time to live of key in seconds (None removes it).
+        """
+        return self._send_command('EXPIRE', [key, ttl])
 
-    def fire_event(self, key, value):
-        return self.enqueue(key, value)
+    def get_ttl(self, key):
+        """
+        Remaining seconds to live, -1 for keys without TTL, -2 for missing keys.
+        """
+        return self._send_command('TTL', [key])
+
+    def publish(self, channel, message):
+        """
+        Publishes message on a pub/sub channel. Returns the number of
+        subscriptions it was delivered to.
+        """
+        return self._send_command('PUBLISH', [channel, message])
+
+    def subscribe(self, channels=None, patterns=None):
+        """
+        Returns a FlaskSubscription to the given channels and glob patterns.
+        Unlike events, every subscription gets its own copy of each message.
+        """
+        return FlaskSubscription(self, channels, patterns)
+
+    def add_to_stream(self, key, value, maxlen=None):
+        """
+        Appends value to the stream at key. Returns the entry id.
+        maxlen trims the stream to its newest maxlen entries.
+        """
+        return self._send_command('XADD', with_options([key, value], maxlen=maxlen))
+
+    def create_group(self, key, group, start='$', visibility_timeout=30):
+        """
+        Creates a consumer group reading the stream at key from after entry
+        id start ('$' for new entries only, 0 for the whole stream). Entries
+        not acknowledged within visibility_timeout seconds are redelivered.
+        Returns False if the group already exists.
+        """
+        return self._send_command('XGROUP', [key, group, {'start': start,
+                                                          'visibility_timeout': visibility_timeout}])
+
+    def read_stream(self, key, after=0, count=100, block=0):
+        """
+        Returns up to count [id, value] entries of the stream after id after,
+        waiting up to block seconds for one to be added.
+        """
+        return self._send_command('XREAD', [key, after, {'count': count, 'block': block}],
+                                  timeout=(self.connect_timeout, block + 5) if block else None)
+
+    def read_group(self, key, group, consumer, count=10, block=None):
+        """
+        Returns up to count [id, value] entries for consumer, waiting up to
+        block seconds (the poll_timeout by default) for one to arrive. Each
+        entry must be acknowledged with ack() or it is delivered again.
+        """
+        block = self.poll_timeout if block is None else block
+        return self._send_command('XREADGROUP', [key, group, consumer, {'count': count, 'block': block}],
+                                  timeout=(self.connect_timeout, block + 5))
+
+    def ack(self, key, group, ids):
+        if not isinstance(ids, list):
+            ids = [ids]
+        return self._send_command('XACK', [key, group, ids])
+
+    def pending(self, key, group):
+        """
+        Unacknowledged entries of a group: {"count", "consumers", "entries"}.
+        """
+        return self._send_command('XPENDING', [key, group])
+
+    def stream_length(self, key):
+        return self._send_command('XLEN', [key])
+
+    def consume_stream(self, key, group, consumer, callback, count=10, stop_event=None):
+        """
+        Calls callback(value) for every entry delivered to consumer and
+        acknowledges it once the callback returns, until stop_event is set.
+        If the callback raises, or the process dies before the ack, the
+        entry is delivered again after the group's visibility timeout.
+        """
+        self.create_group(key, group, start=0)
+        while stop_event is None or not stop_event.is_set():
+            entries = self.read_group(key, group, consumer, count)
+            if entries is None:
+                time.sleep(1)
+                continue
+            for entry_id, value in entries:
+                try:
+                    callback(value)
+                except Exception as e:
+                    print(f"Error handling entry {entry_id} of stream '{key}': {e}")
+                    continue
+                self.ack(key, group, entry_id)
 
     def add_event_listener(self, event_name, callback):
         if event_name in self.listeners:
@@ -100,13 +635,14 @@ class FlaskClient:
             event_names = [event_name]
 
         while True:
-            events_data = self.get_data(event_names)
+            events_data = self._fetch_events(event_names, non_blocking)
 
             if events_data is None:
                 if non_blocking:
                     return None
                 else:
-                    time.sleep(3)
+                    if not self.long_poll:
+                        time.sleep(3)
                     continue
 
             with_listeners = {k: v for k, v in events_data.items() if k in self.listeners and v is not None}
@@ -116,8 +652,6 @@ class FlaskClient:
                 self._process_events(with_listeners)
 
             if without_listeners:
-                for event in without_listeners.keys():
-                    self.delete_data(event)
                 if len(without_listeners) == 1:
                     rv = next(iter(without_listeners.values())) #return just the first response
                     if isinstance(rv, list):
@@ -127,9 +661,10 @@ class FlaskClient:
 
     def _listen_for_events(self):
         while self.is_listening:
-            time.sleep(2)  # Polling interval
+            if not self.long_poll:
+                time.sleep(2)  # Polling interval
             event_names = list(self.listeners.keys())
-            events_data = self.get_data(event_names)
+            events_data = self._fetch_events(event_names)
             # events_data = {k: v for k, v in events_data.items() if v is not None}
             self._process_events(events_data)
 
@@ -138,7 +673,6 @@ class FlaskClient:
             for event_name, value in events_data.items():
                 if value is not None:
                     print(f"Listening for event: {event_name} with value: {value}")
-                    self.delete_data(event_name)  # Clear the event before handling
                     callback = self.listeners.get(event_name)
                     if callback:
                         if isinstance(value, list):
@@ -156,6 +690,31 @@ class FlaskClient:
     def has_data(self, key):
         return self._send_command('HAS', [key])
 
+    def scan(self, cursor=None, match=None, prefix=None, count=100, values=False):
+        """
+        One page of an incremental keyspace scan. Returns [next_cursor, keys]
+        (or [next_cursor, [[key, value], ...]] with values=True); next_cursor
+        is None when the scan is complete.
+        """
+        return self._send_command('SCAN', with_options([cursor], match=match, prefix=prefix,
+                                                       count=count, values=values or None))
+
+    def scan_iter(self, match=None, prefix=None, count=100, values=False):
+        """
+        Yields every key (or (key, value) with values=True) matching the glob
+        pattern and/or prefix, fetching count keys per request.
+        """
+        cursor = None
+        while True:
+            page = self.scan(cursor, match=match, prefix=prefix, count=count, values=values)
+            if page is None:
+                return
+            cursor, items = page
+            for item in items:
+                yield tuple(item) if values else item
+            if cursor is None:
+                return
+
     def list_keys(self):
         return self._send_command('LIST_KEYS')
 
@@ -165,6 +724,289 @@ class FlaskClient:
     def clear_data(self):
         return self._send_command('CLEAR') == "Data store cleared."
 
+class FlaskPipeline:
+    """
+    Collects FlaskClient commands and sends them as one batch on execute().
+    Each method returns the pipeline itself so calls can be chained.
+    """
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+        self.transforms = []
+        self.results = None
+
+    def _queue(self, command, args=None, transform=None):
+        self.commands.append({'command': command, 'args': args or []})
+        self.transforms.append(transform)
+        return self
+
+    def set_data(self, key, value, ttl=None):
+        return self._queue('SET', with_options([key, value], ttl=ttl))
+
+    def get_data(self, keys, path=None):
+        keys = keys if isinstance(keys, list) else [keys]
+        return self._queue('GET', keys + [{'path': path}] if path is not None else keys)
+
+    def set_path(self, key, path, value):
+        return self._queue('SETPATH', [key, path, value], lambda result: result == True)
+
+    def append_path(self, key, path, value):
+        return self._queue('SETPATH', [key, path, value, {'append': True}])
+
+    def delete_data(self, key):
+        return self._queue('DELETE', [key], lambda result: result == True)
+
+    def enqueue(self, key, value, ttl=None, maxlen=None, overflow=None):
+        return self._queue('PUSH', with_options([key, value], ttl=ttl, maxlen=maxlen, overflow=overflow))
+
+    def hset(self, key, mapping):
+        return self._queue('HSET', [key, mapping])
+
+    def hdel(self, key, fields):
+        return self._queue('HDEL', [key, fields if isinstance(fields, list) else [fields]])
+
+    def incrby(self, key, amount=1):
+        return self._queue('INCRBY', [key, amount])
+
+    def sadd(self, key, members):
+        return self._queue('SADD', [key, members if isinstance(members, list) else [members]])
+
+    def srem(self, key, members):
+        return self._queue('SREM', [key, members if isinstance(members, list) else [members]])
+
+    def fire_event(self, key, value, ttl=None):
+        return self.enqueue(key, value, ttl)
+
+    def add_to_stream(self, key, value, maxlen=None):
+        return self._queue('XADD', with_options([key, value], maxlen=maxlen))
+
+    def ack(self, key, group, ids):
+        return self._queue('XACK', [key, group, ids if isinstance(ids, list) else [ids]])
+
+    def expire(self, key, ttl):
+        return self._queue('EXPIRE', [key, ttl])
+
+    def drain_data(self, keys):
+        return self._queue('DRAIN', keys if isinstance(keys, list) else [keys])
+
+    def has_data(self, key):
+        return self._queue('HAS', [key])
+
+    def list_keys(self):
+        return self._queue('LIST_KEYS')
+
+    def list_data(self):
+        return self._queue('LIST_DATA')
+
+    def clear_data(self):
+        return self._queue('CLEAR', transform=lambda result: result == "Data store cleared.")
+
+    def execute(self):
+        """
+        Sends the buffered commands and returns their results in order,
+        or None if the request failed.
+        """
+        if not self.commands:
+            self.results = []
+            return self.results
+        results = self.client._send_commands(self.commands)
+        if results is not None:
+            results = [transform(result) if transform else result
+                       for transform, result in zip(self.transforms, results)]
+        self.commands = []
+        self.transforms = []
+        self.results = results
+        return results
+
+class FlaskTransaction(FlaskPipeline):
+    """
+    A FlaskPipeline applied atomically (WATCH/MULTI/EXEC). Until multi() or
+    the first queued command, get_data() reads immediately and watches the
+    keys it reads. execute() raises WatchError, and applies nothing, if a
+    watched key was written by someone else since it was read.
+    """
+    def __init__(self, client):
+        super().__init__(client)
+        self.watched = {}
+        self.queuing = False
+
+    def watch(self, *keys):
+        """
+        Records the current version of keys. Returns a dict of those that
+        hold a value, or None.
+        """
+        if not keys:
+            return None
+        result = self.client._send_command('GET', list(keys) + [{}])
+        if result is None:
+            raise WatchError(f"Could not read the versions of {list(keys)}")
+        values = {}
+        for key in keys:
+            version, value = result['values'].get(key, (0, None))
+            self.watched[key] = version
+            if version:
+                values[key] = value
+        return values or None
+
+    def get_data(self, keys, path=None):
+        if self.queuing:
+            return super().get_data(keys, path)
+        keys = keys if isinstance(keys, list) else [keys]
+        values = self.watch(*keys)
+        # read after watching: a change in between makes execute() fail rather than go unnoticed
+        return values if path is None else self.client.get_data(keys, path)
+
+    def multi(self):
+        """
+        Starts queuing: the following commands are sent by execute().
+        """
+        self.queuing = True
+        return self
+
+    def _queue(self, command, args=None, transform=None):
+        self.queuing = True
+        return super()._queue(command, args, transform)
+
+    def execute(self):
+        """
+        Applies the queued commands if no watched key changed and returns
+        their results in order (None if the request failed). Raises
+        WatchError otherwise.
+        """
+        client = self.client
+        commands, transforms = self.commands, self.transforms
+        self.commands, self.transforms = [], []
+        try:
+            data = {'command': 'EXEC', 'args': [commands, {'watch': self.watched}]}
+            response = client._post(client.base_url, data, client.timeout)
+            response.raise_for_status()
+            result = decode_body(response).get('result')
+        except requests.RequestException as e:
+            print(f"Error sending transaction of {len(commands)} commands: {client._error_message(e)}")
+            self.results = None
+            return None
+        if result is None:
+            raise WatchError(f"Watched keys changed: {list(self.watched)}")
+        for index, error in result['errors'].items():
+            print(f"Error in transaction command {commands[int(index)]['command']}: {error}")
+        self.results = [transform(value) if transform else value
+                        for transform, value in zip(transforms, result['results'])]
+        return self.results
+
+
+class FlaskSubscription:
+    """
+    A pub/sub subscription on the server. Messages are buffered server-side
+    between calls to get_messages(); a subscription that is not read from for
+    a while (PUBSUB_IDLE_TIMEOUT) is dropped by the server and transparently
+    recreated here, losing what was published in between.
+
+    Each message is a dict {"channel", "pattern", "data"}; pattern is the
+    glob pattern that matched, or None for a plain channel subscription.
+    """
+    def __init__(self, client, channels=None, patterns=None):
+        self.client = client
+        self.channels = set(self._as_list(channels))
+        self.patterns = set(self._as_list(patterns))
+        self.id = None
+        self.dropped = 0
+        self.closed = False
+        self.listener_thread = None
+        self._subscribe(self.channels, self.patterns)
+
+    @staticmethod
+    def _as_list(names):
+        if names is None:
+            return []
+        return [names] if isinstance(names, str) else list(names)
+
+    def _subscribe(self, channels, patterns):
+        options = with_options([], patterns=list(patterns) or None, subscription=self.id)
+        self.id = self.client._send_command('SUBSCRIBE', [list(channels)] + options)
+        return self.id is not None
+
+    def subscribe(self, channels=None, patterns=None):
+        channels, patterns = self._as_list(channels), self._as_list(patterns)
+        self.channels.update(channels)
+        self.patterns.update(patterns)
+        return self._subscribe(channels, patterns)
+
+    def unsubscribe(self, channels=None, patterns=None):
+        # without arguments, leaves every channel and pattern but keeps the subscription
+        if channels is None and patterns is None:
+            channels, patterns = list(self.channels), list(self.patterns)
+        channels, patterns = self._as_list(channels), self._as_list(patterns)
+        self.channels.difference_update(channels)
+        self.patterns.difference_update(patterns)
+        return self.client._send_command('UNSUBSCRIBE', [self.id, {'channels': channels, 'patterns': patterns}])
+
+    def get_messages(self, timeout=None, count=100):
+        """
+        Returns the buffered messages, waiting up to timeout seconds (the
+        client poll_timeout by default, 0 to return immediately) for one to
+        arrive. Messages lost to a full server buffer are added to self.dropped.
+        """
+        if self.closed:
+            return []
+        if self.id is None and not self._subscribe(self.channels, self.patterns):
+            time.sleep(1)
+            return []
+        timeout = self.client.poll_timeout if timeout is None else timeout
+        try:
+            data = {'subscription': self.id, 'timeout': timeout, 'count': count}
+            response = self.client._post(f"{self.client.server_url}/receive", data,
+                                         (self.client.connect_timeout, timeout + 5))
+            if response.status_code == 404:
+                # expired on the server (or the server restarted): start over
+                self.id = None
+                return []
+            response.raise_for_status()
+            result = decode_body(response).get('result')
+        except requests.RequestException as e:
+            print(f"Error receiving messages for subscription {self.id}: {e}")
+            time.sleep(1)
+            return []
+        self.dropped += result['dropped']
+        return result['messages']
+
+    def listen(self):
+        """
+        Yields messages as they arrive until close() is called.
+        """
+        while not self.closed:
+            for message in self.get_messages():
+                yield message
+
+    def run_in_thread(self, callback):
+        """
+        Calls callback(message) for every message from a daemon thread.
+        """
+        def run():
+            for message in self.listen():
+                try:
+                    callback(message)
+                except Exception as e:
+                    print(f"Error handling message on channel '{message['channel']}': {e}")
+
+        self.listener_thread = threading.Thread(target=run, daemon=True)
+        self.listener_thread.start()
+        return self.listener_thread
+
+    def close(self):
+        self.closed = True
+        if self.id is not None:
+            self.client._send_command('UNSUBSCRIBE', [self.id])
+            self.id = None
+        if self.listener_thread is not None and self.listener_thread != threading.current_thread():
+            self.listener_thread.join()
+            self.listener_thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
 # Usage Example
 if __name__ == '__main__':
     client = FlaskClient(asynchronous=True)
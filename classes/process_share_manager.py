@@ -85,14 +85,28 @@
 #     example_controller.cleanup()  # Cleanup when needed
 
 
+import bisect
+import errno
+import ipaddress
 import multiprocessing
+import queue
+import random
+import reprlib
+import selectors
 import socket
+import struct
 import threading
 import pickle
+import tempfile
 import time
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, suppress
 from multiprocessing import Process
+from multiprocessing import resource_tracker, shared_memory
 from multiprocessing.context import AuthenticationError
+from fnmatch import fnmatchcase
 import socket
 import atexit
 
@@ -197,56 +211,597 @@ from multiprocessing.managers import BaseManager
 #             print(f"Failed to initialize shared manager server: {e}")
 
 
+# Every message on the socket is a pickle preceded by its length
+HEADER = struct.Struct('!Q')
+# Messages up to this size are sent with their header in a single write;
+# larger ones are sent from the pickle itself rather than copied after the header
+COALESCE_BYTES = 64 * 1024
+# Most bytes asked of a single recv, so large messages are read in chunks
+CHUNK_BYTES = 1024 * 1024
+
+TRANSPORTS = ('unix', 'tcp')
+# Where the Unix sockets of local servers are created, one per port number
+SOCKET_DIR = os.getenv('PROCESS_SHARE_SOCKET_DIR', tempfile.gettempdir())
+
+
+def socket_path(port):
+    return os.path.join(SOCKET_DIR, f'process_share_manager.{port}.sock')
+
+
+def is_loopback(host):
+    """
+    Whether every address host resolves to is on this machine's loopback
+    interface, so only local processes could reach a server bound to it.
+    """
+    try:
+        addresses = socket.getaddrinfo(host, None)
+    except OSError:
+        return False
+    return bool(addresses) and all(ipaddress.ip_address(address[4][0]).is_loopback for address in addresses)
+
+
+def pick_transport(host, transport=None):
+    """
+    The transport for a server on host: the one asked for, otherwise a Unix
+    socket for loopback hosts (where the platform has them) and TCP for
+    anything reachable from other machines.
+    """
+    if transport is None:
+        transport = 'unix' if hasattr(socket, 'AF_UNIX') and is_loopback(host) else 'tcp'
+    if transport not in TRANSPORTS:
+        raise ValueError(f"Unknown transport '{transport}', expected one of {', '.join(TRANSPORTS)}")
+    return transport
+
+
+def encode_message(obj, buffer_callback=None):
+    """
+    The buffers to write for obj: header and pickle, joined if small.
+    """
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL, buffer_callback=buffer_callback)
+    if len(data) <= COALESCE_BYTES:
+        return [HEADER.pack(len(data)) + data]
+    return [HEADER.pack(len(data)), data]
+
+
+def send_message(sock, obj):
+    for buffer in encode_message(obj):
+        sock.sendall(buffer)
+
+
+def recv_exactly(sock, size):
+    """
+    Reads size bytes into a preallocated buffer, in chunks of CHUNK_BYTES,
+    however the stream happens to be split.
+    """
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:], min(size - received, CHUNK_BYTES))
+        if count == 0:
+            raise EOFError("Connection closed") if received == 0 else ConnectionError("Connection closed mid-message")
+        received += count
+    return buffer
+
+
+def recv_message(sock):
+    """
+    Reads one message. Raises EOFError if the peer closed the connection
+    between messages, ConnectionError if it did so mid-message.
+    """
+    size, = HEADER.unpack(recv_exactly(sock, HEADER.size))
+    try:
+        payload = recv_exactly(sock, size)
+    except EOFError:
+        raise ConnectionError("Connection closed mid-message") from None
+    return pickle.loads(payload)
+
+
+class _Preview(reprlib.Repr):
+    # reprlib truncates str and containers itself, but formats bytes in full first
+    def repr_bytes(self, value, level):
+        return repr(value[:self.maxstring]) + ('...' if len(value) > self.maxstring else '')
+
+    repr_bytearray = repr_bytes
+
+
+_preview = _Preview()
+_preview.maxstring = _preview.maxother = 200
+
+
+def preview(value):
+    """
+    Value as str for the debugging output, shortened if it is large.
+    """
+    if isinstance(value, str):
+        return value if len(value) <= _preview.maxstring else value[:_preview.maxstring] + '...'
+    return _preview.repr(value)
+
+
+# Buffers of at least this many bytes in a value given to set_data travel
+# through shared memory instead of the socket (see share())
+SHARED_MEMORY_MIN_BYTES = 64 * 1024
+# Seconds a segment no stored value references is kept before it is
+# unlinked, for readers that were sent it but haven't mapped it yet
+SEGMENT_RELEASE_DELAY = 10
+# On Windows a segment disappears with the last handle to it, so it can't
+# outlive the writer's; out-of-band transfer is POSIX only
+SHARED_MEMORY = os.name == 'posix'
+
+
+class _Segment(shared_memory.SharedMemory):
+    def __del__(self):
+        # views of it may still be referenced when the interpreter exits
+        try:
+            self.close()
+        except (BufferError, OSError):
+            pass
+
+
+# A process that creates or opens a segment registers it with its resource
+# tracker, which unlinks it when the process exits, while segments belong to
+# the server. Every register is undone at once, under this lock so that the
+# register/unregister pairs of concurrent threads don't interleave.
+_tracker_lock = threading.Lock()
+
+
+def _open_segment(name=None, size=0):
+    """
+    Creates a segment of size bytes, or opens the one called name.
+    """
+    with _tracker_lock:
+        try:
+            return _Segment(name, create=name is None, size=size, track=False)
+        except TypeError:
+            # Python < 3.13 has no track=False
+            segment = _Segment(name, create=name is None, size=size)
+            resource_tracker.unregister(segment._name, 'shared_memory')
+            return segment
+
+
+def _unlink_segment(name):
+    with _tracker_lock:
+        try:
+            try:
+                segment = _Segment(name, track=False)
+            except TypeError:
+                # registered now, and unregistered again by unlink()
+                segment = _Segment(name)
+        except FileNotFoundError:
+            return
+        segment.unlink()
+    segment.close()
+
+
+# segments this process mapped for SharedValue.load(), unmapped once the
+# values loaded from them are gone
+_mapped = []
+_mapped_lock = threading.Lock()
+
+
+def _map_segment(name, size):
+    """
+    A read-only view of the first size bytes of the segment.
+    """
+    with _mapped_lock:
+        for segment in list(_mapped):
+            try:
+                segment.close()
+            except BufferError:
+                continue
+            _mapped.remove(segment)
+        segment = _open_segment(name)
+        _mapped.append(segment)
+        # made under the lock, so no other load() unmaps the segment first
+        return segment.buf[:size].toreadonly()
+
+
+class SharedValue:
+    """
+    A value whose large buffers were moved out of its pickle (protocol 5
+    PickleBuffers) into shared memory segments, one per buffer. The server
+    stores and returns it as is, without unpickling it, and counts the keys
+    referencing each segment. load() maps the segments and unpickles the
+    value on top of them: buffers come back as read-only memoryviews of the
+    shared memory, and NumPy arrays as read-only arrays over it, without a
+    copy. A mapping lasts as long as something loaded from it, even after
+    the server unlinks the segment.
+    """
+    __slots__ = ('payload', 'segments')
+
+    def __init__(self, payload, segments):
+        self.payload = payload
+        # [(name, size), ...] in the order the pickle asks for the buffers
+        self.segments = segments
+
+    def __repr__(self):
+        size = sum(size for name, size in self.segments)
+        return f'<SharedValue of {len(self.segments)} segments, {size} bytes>'
+
+    def load(self):
+        buffers = [_map_segment(name, size) for name, size in self.segments]
+        return pickle.loads(self.payload, buffers=buffers)
+
+
+def _collect(buffers, min_bytes):
+    """
+    A pickle buffer_callback taking the contiguous buffers of at least
+    min_bytes out of band, into buffers.
+    """
+    def callback(buffer):
+        try:
+            raw = buffer.raw()
+        except BufferError:
+            # not contiguous
+            return True
+        if raw.nbytes < min_bytes:
+            return True
+        buffers.append(raw)
+        return False
+    return callback
+
+
+class _Pickled:
+    """
+    A value pickled already. Pickling it embeds that pickle, which unpickles
+    to the value, instead of going through the value again.
+    """
+    __slots__ = ('payload',)
+
+    def __init__(self, payload):
+        self.payload = payload
+
+    def __reduce__(self):
+        return pickle.loads, (self.payload,)
+
+
+def _pickle_out_of_band(value, min_bytes):
+    """
+    Pickles value with its contiguous buffers of at least min_bytes taken
+    out of band. Returns (payload, buffers). bytes-like values are buffers
+    themselves.
+    """
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        # pickled in band otherwise, and memoryview not at all
+        value = pickle.PickleBuffer(value)
+    buffers = []
+    payload = pickle.dumps(value, pickle.HIGHEST_PROTOCOL, buffer_callback=_collect(buffers, min_bytes))
+    return payload, buffers
+
+
+def share(value, min_bytes=SHARED_MEMORY_MIN_BYTES):
+    """
+    Copies each contiguous buffer of at least min_bytes in value into a new
+    shared memory segment. Returns (SharedValue, segments), or (value, [])
+    if there are none. bytes-like values come back from load() as
+    memoryviews.
+
+    The caller hands the segments over to the server with _handoff().
+    """
+    if not SHARED_MEMORY or not min_bytes:
+        return value, []
+    payload, buffers = _pickle_out_of_band(value, min_bytes)
+    if not buffers:
+        return value, []
+    return _share_buffers(value, payload, buffers)
+
+
+def _share_buffers(original, payload, buffers):
+    """
+    share() of a value already pickled by _pickle_out_of_band(). Returns
+    (original, []) if shared memory turns out to be unavailable.
+    """
+    segments = []
+    try:
+        for raw in buffers:
+            segment = _open_segment(size=raw.nbytes)
+            segments.append(segment)
+            if hasattr(os, 'posix_fallocate'):
+                # with /dev/shm full (64MB by default in Docker) this raises,
+                # where the copy would be killed by SIGBUS
+                os.posix_fallocate(segment._fd, 0, raw.nbytes)
+            segment.buf[:raw.nbytes] = raw
+    except OSError as e:
+        _discard_segments(segments)
+        print(f"Shared memory unavailable, sending the value in the message: {e}")
+        return original, []
+    except BaseException:
+        _discard_segments(segments)
+        raise
+    return SharedValue(payload, [(segment.name, raw.nbytes) for segment, raw in zip(segments, buffers)]), segments
+
+
+def _discard_segments(segments):
+    for segment in segments:
+        segment.close()
+        _unlink_segment(segment.name)
+
+
+def _failed(reply):
+    # the reply of a command the server raised on
+    return isinstance(reply, str) and reply.startswith('Error: ')
+
+
+@contextmanager
+def _handoff(segments):
+    """
+    Gives the segments created for a command to the server once the command
+    went through: they are closed here, not unlinked. If it failed, e.g. the
+    server died before recording them, they are unlinked. So are those the
+    block adds to the yielded list: the ones of values the server answered
+    an error for, which it didn't store.
+    """
+    rejected = []
+    try:
+        yield rejected
+    except BaseException:
+        _discard_segments(segments)
+        raise
+    for segment in segments:
+        segment.close()
+    for segment in rejected:
+        _unlink_segment(segment.name)
+
+
+def load(value):
+    """
+    value, or what it stands for if it is a SharedValue.
+    """
+    return value.load() if isinstance(value, SharedValue) else value
+
+
+class _Connection:
+    """
+    A client connection of the event-loop server: the message being read,
+    and the replies to its requests, written in request order even when a
+    CALL completes after later requests.
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self.inbox = bytearray()
+        # a large message being read directly into its own buffer
+        self.body = None
+        self.received = 0
+        # one [buffers or None while pending] slot per request, oldest first
+        self.replies = deque()
+        self.outbox = deque()
+
+    def read(self):
+        """
+        Reads what is available. Returns the complete messages, still
+        pickled. Raises EOFError when the client closed the connection.
+        """
+        if self.body is not None:
+            view = memoryview(self.body)[self.received:]
+            count = self.sock.recv_into(view, min(len(view), CHUNK_BYTES))
+            if count == 0:
+                raise EOFError("Connection closed")
+            self.received += count
+            if self.received < len(self.body):
+                return []
+            messages, self.body = [self.body], None
+            return messages
+        data = self.sock.recv(COALESCE_BYTES)
+        if not data:
+            raise EOFError("Connection closed")
+        self.inbox += data
+        messages = []
+        position = 0
+        while len(self.inbox) - position >= HEADER.size:
+            size, = HEADER.unpack_from(self.inbox, position)
+            start = position + HEADER.size
+            if len(self.inbox) - start >= size:
+                messages.append(bytes(self.inbox[start:start + size]))
+                position = start + size
+            elif size > COALESCE_BYTES:
+                # read the rest in place rather than growing the inbox
+                self.body = bytearray(size)
+                self.received = len(self.inbox) - start
+                self.body[:self.received] = self.inbox[start:]
+                position = len(self.inbox)
+                break
+            else:
+                break
+        del self.inbox[:position]
+        return messages
+
+    def flush(self):
+        """
+        Writes the replies that are ready, in order, as far as the socket
+        accepts them. Returns True if something is left to write.
+        """
+        while self.replies and self.replies[0][0] is not None:
+            self.outbox.extend(memoryview(buffer) for buffer in self.replies.popleft()[0])
+        while self.outbox:
+            try:
+                sent = self.sock.send(self.outbox[0])
+            except BlockingIOError:
+                return True
+            if sent < len(self.outbox[0]):
+                self.outbox[0] = self.outbox[0][sent:]
+            else:
+                self.outbox.popleft()
+        return False
+
+
+# Commands that can be queued in an EXEC transaction
+TRANSACTION_COMMANDS = {'SET', 'GET', 'DELETE', 'HAS', 'CAS', 'GET_VERSIONED'}
+
+# How a pooled connection the server closed since its last use (e.g. on a
+# restart) fails: on send, or closed or reset before any reply arrives
+STALE_CONNECTION_ERRORS = (EOFError, ConnectionResetError, BrokenPipeError)
+
+
+class _StaleConnection(Exception):
+    """
+    Raised out of SharedDataClient._connection() to discard a pooled
+    connection found closed and retry on a new one.
+    """
+
+
+class WatchError(Exception):
+    """
+    A key watched by a transaction was written by someone else before it ran.
+    """
+
+
 class ProcessSharedObject:
-    def __init__(self, host='localhost', port=50000):
+    """
+    Socket server holding the shared data and methods.
+
+    By default every client connection gets its own thread. With
+    event_loop=True a single thread multiplexes all connections with
+    selectors and runs every command itself, so the commands never run
+    concurrently; only CALLs, which run arbitrary and possibly slow
+    registered methods, go to a pool of call_workers threads.
+
+    A server on a loopback host listens on a Unix socket (socket_path(port))
+    rather than the TCP port, unless transport='tcp'. The socket file is
+    only accessible to the user running the server, which takes the place
+    of the open port as access control.
+
+    Values whose large buffers a client put in shared memory are stored as
+    SharedValues. The server counts the keys referencing each segment and
+    unlinks a segment SEGMENT_RELEASE_DELAY seconds after the last of them
+    is overwritten or deleted, and every segment when it shuts down.
+    """
+    def __init__(self, host='localhost', port=50000, event_loop=False, call_workers=8, backlog=128,
+                 transport=None):
         self.host = host
         self.port = port
+        self.transport = pick_transport(host, transport)
+        self.socket_path = None
+        self.event_loop = event_loop
+        self.call_workers = call_workers
         self.data = {}
+        # sorted copy of the str keys, so SCAN can page through them by range;
+        # other keys (ints, tuples, ...) don't sort with them and aren't scanned
+        self.key_index = []
+        # version of each key, taken from a counter so a recreated key never
+        # gets an old version back; missing keys have version 0
+        self.versions = {}
+        self.revision = 0
+        # guards data, key_index and versions for writes and transactions
+        self.index_lock = threading.RLock()
+        # keys referencing each shared memory segment (see SharedValue), and the
+        # (deadline, name) of segments left unreferenced, oldest first
+        self.segment_refs = {}
+        self.retired = deque()
+        self.segment_lock = threading.Lock()
         self.methods = {}
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(5)
-        print(f"Server started on {self.host}:{self.port}")
+        self.server_socket = self.listen(backlog)
         self.stop_event = threading.Event()
         self.printer_thread = threading.Thread(target=self.print_data_periodically)
         self.printer_thread.daemon = True
         self.printer_thread.start()
+        self.reaper_thread = threading.Thread(target=self.reap_segments_periodically)
+        self.reaper_thread.daemon = True
+        self.reaper_thread.start()
+
+    def listen(self, backlog):
+        if self.transport == 'tcp':
+            server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            # clients keep their connections open, so those of a server that just
+            # exited linger on the port; let a restarted server bind it anyway
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server_socket.bind((self.host, self.port))
+            server_socket.listen(backlog)
+            print(f"Server started on {self.host}:{self.port}")
+            return server_socket
+        path = socket_path(self.port)
+        if os.path.exists(path):
+            # a running server accepts, the file left behind by a killed one refuses
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except ConnectionRefusedError:
+                os.remove(path)
+            else:
+                raise OSError(errno.EADDRINUSE, f"Address already in use: {path}")
+            finally:
+                probe.close()
+        server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # create the file without access for other users rather than chmod it after
+        umask = os.umask(0o177)
+        try:
+            server_socket.bind(path)
+        finally:
+            os.umask(umask)
+        server_socket.listen(backlog)
+        self.socket_path = path
+        print(f"Server started on {path}")
+        return server_socket
+
+    def _close_server_socket(self):
+        self.server_socket.close()
+        if self.socket_path:
+            with suppress(FileNotFoundError):
+                os.remove(self.socket_path)
+            self.socket_path = None
 
     def handle_client(self, client_socket):
         with client_socket:
             while True:
                 try:
-                    request = client_socket.recv(4096)
-                    if not request:
-                        break
-                    command, *args = pickle.loads(request)
-                    response = self.process_command(command, *args)
-                    client_socket.sendall(pickle.dumps(response))
-                except EOFError:
+                    command, *args = recv_message(client_socket)
+                except (EOFError, OSError):
                     break
                 except Exception as e:
-                    client_socket.sendall(pickle.dumps(f"Error: {e}"))
+                    # a message that doesn't unpickle was still read whole, so the stream is intact
+                    response = f"Error: {e}"
+                else:
+                    try:
+                        response = self.process_command(command, *args)
+                    except Exception as e:
+                        response = f"Error: {e}"
+                try:
+                    send_message(client_socket, response)
+                except (pickle.PicklingError, TypeError, AttributeError) as e:
+                    send_message(client_socket, f"Error: {e}")
+                except OSError:
                     break
 
     def process_command(self, command, *args):
         if command == 'SET':
             key, value = args
-            self.data[key] = value
-            print(f"Data set: {key} -> {self.data[key]}")  # Debugging statement
-            return f'SET {key} {value}'
+            self._set(key, value)
+            print(f"Data set: {key} -> {preview(value)}")  # Debugging statement
+            return f'SET {key} {preview(value)}'
         elif command == 'GET':
             key = args[0]
             value = self.data.get(key, None)
-            print(f"Data retrieved: {key} -> {value}")  # Debugging statement
+            print(f"Data retrieved: {key} -> {preview(value)}")  # Debugging statement
             return value  # Return None if key not found
         elif command == 'DELETE':
             key = args[0]
-            deleted = self.data.pop(key, None) is not None
+            with self.index_lock:
+                if key in self.data:
+                    if isinstance(key, str):
+                        del self.key_index[bisect.bisect_left(self.key_index, key)]
+                    self.versions.pop(key, None)
+                value = self.data.pop(key, None)
+                self._release(value)
+                deleted = value is not None
             print(f"Data deleted: {key} -> {deleted}")  # Debugging statement
             return deleted  # Return True if deleted, else False
         elif command == 'HAS':
             key = args[0]
             return key in self.data
+        elif command == 'GET_VERSIONED':
+            key = args[0]
+            with self.index_lock:
+                return self.data.get(key), self.versions.get(key, 0)
+        elif command == 'CAS':
+            # returns the new version, or None if key no longer has version
+            key, version, value = args
+            with self.index_lock:
+                if self.versions.get(key, 0) != version:
+                    self._discard(value)
+                    return None
+                return self._set(key, value)
+        elif command == 'EXEC':
+            watched, commands = args
+            return self.execute(watched, commands)
         elif command == 'CALL':
             method_name, method_args, method_kwargs = args
             return self.call_method(method_name, *method_args, **method_kwargs)
@@ -258,12 +813,153 @@ class ProcessSharedObject:
             return list(self.data.keys())
         elif command == 'LIST_DATA':
             return list(self.data.items())
+        elif command == 'SCAN':
+            cursor, options = args
+            return self.scan(cursor, **options)
         elif command == 'KILL':
             self.shutdown_server()
             return 'Server is shutting down...'
         else:
             return 'UNKNOWN_COMMAND'
 
+    def _set(self, key, value):
+        with self.index_lock:
+            if key not in self.data and isinstance(key, str):
+                bisect.insort(self.key_index, key)
+            self._retain(value)
+            self._release(self.data.get(key))
+            self.data[key] = value
+            self.revision += 1
+            self.versions[key] = self.revision
+            return self.revision
+
+    def execute(self, watched, commands):
+        """
+        Optimistic transaction (WATCH/MULTI/EXEC): runs commands, a list of
+        (command, *args) tuples of TRANSACTION_COMMANDS, with no other write
+        in between, provided every watched key still has the version the
+        caller read ({key: version}). Returns their results, or None if a
+        watched key changed.
+        """
+        with self.index_lock:
+            if any(self.versions.get(key, 0) != version for key, version in watched.items()):
+                for command, *args in commands:
+                    if command in ('SET', 'CAS'):
+                        self._discard(args[-1])
+                return None
+            results = []
+            for index, (command, *args) in enumerate(commands):
+                if command not in TRANSACTION_COMMANDS:
+                    results.append(f"Error: {command} can't be used in a transaction")
+                    continue
+                try:
+                    results.append(self.process_command(command, *args))
+                except Exception:
+                    # the client can't tell which values were stored: the
+                    # ones of the commands not run are discarded here
+                    for command, *args in commands[index:]:
+                        if command in ('SET', 'CAS'):
+                            self._discard(args[-1])
+                    raise
+            return results
+
+    def _retain(self, value):
+        if isinstance(value, SharedValue):
+            with self.segment_lock:
+                for name, size in value.segments:
+                    self.segment_refs[name] = self.segment_refs.get(name, 0) + 1
+
+    def _release(self, value):
+        """
+        Drops a reference to the segments of value, if it is a SharedValue.
+        Unreferenced segments are unlinked after SEGMENT_RELEASE_DELAY, so a
+        reader that was just sent the value can still map them.
+        """
+        if isinstance(value, SharedValue):
+            deadline = time.monotonic() + SEGMENT_RELEASE_DELAY
+            with self.segment_lock:
+                for name, size in value.segments:
+                    if name not in self.segment_refs:
+                        # unlinked when the server shut down
+                        continue
+                    self.segment_refs[name] -= 1
+                    if self.segment_refs[name] == 0:
+                        self.retired.append((deadline, name))
+
+    def _discard(self, value):
+        # a value that was sent but not stored: its segments go like a replaced value's
+        self._retain(value)
+        self._release(value)
+
+    def reap_segments(self, everything=False):
+        """
+        Unlinks the segments unreferenced for SEGMENT_RELEASE_DELAY, or every
+        segment when the server shuts down. Readers that mapped a segment
+        keep their mapping.
+        """
+        now = time.monotonic()
+        expired = []
+        with self.segment_lock:
+            while self.retired and (everything or self.retired[0][0] <= now):
+                deadline, name = self.retired.popleft()
+                # stored again in the meantime, or already unlinked
+                if self.segment_refs.get(name) == 0:
+                    del self.segment_refs[name]
+                    expired.append(name)
+            if everything:
+                expired.extend(self.segment_refs)
+                self.segment_refs.clear()
+        for name in expired:
+            _unlink_segment(name)
+
+    def reap_segments_periodically(self):
+        while not self.stop_event.wait(1):
+            self.reap_segments()
+
+    def scan(self, cursor=None, match=None, prefix=None, count=100, values=False):
+        """
+        One page of an incremental scan over the keys in sorted order.
+        Returns [next_cursor, keys] (or [next_cursor, [(key, value), ...]]
+        with values=True); next_cursor is None when the scan is complete.
+        The cursor is the last key examined, so keys that exist for the whole
+        scan are returned exactly once even while others are added or removed.
+        match is a glob pattern; its literal prefix narrows the walked range.
+        Only str keys are scanned; LIST_KEYS still returns every key.
+        """
+        count = max(1, min(int(count), 1000))
+        if prefix is None:
+            prefix = ''
+            for char in match or '':
+                if char in '*?[\\':
+                    break
+                prefix += char
+        limit = count * 10
+        with self.index_lock:
+            if cursor is not None and cursor >= prefix:
+                start = bisect.bisect_right(self.key_index, cursor)
+            else:
+                start = bisect.bisect_left(self.key_index, prefix)
+            candidates = self.key_index[start:start + limit]
+
+        keys = []
+        last = None
+        done = len(candidates) < limit
+        for position, key in enumerate(candidates):
+            if not key.startswith(prefix):
+                done = True
+                break
+            last = key
+            if match and not fnmatchcase(key, match):
+                continue
+            keys.append(key)
+            if len(keys) >= count:
+                done = done and position == len(candidates) - 1
+                break
+        next_cursor = None if done or last is None else last
+        if values:
+            return [next_cursor, [(key, self.data[key]) for key in keys if key in self.data]]
+        return [next_cursor, keys]
+
     def call_method(self, method_name, *args, **kwargs):
         if method_name in self.methods:
             return self.methods[method_name](*args, **kwargs)
@@ -271,32 +967,156 @@ class ProcessSharedObject:
             return f"Method {method_name} not found."
 
     def start(self):
+        if self.event_loop:
+            return self.serve_event_loop()
+        # clients keep their connections open, so this is one thread per
+        # client connection rather than per command
         while True:
             client_socket, addr = self.server_socket.accept()
+            if self.transport == 'tcp':
+                client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             print(f"Accepted connection from {addr}")
             client_handler = threading.Thread(target=self.handle_client, args=(client_socket,))
+            client_handler.daemon = True
             client_handler.start()
 
+    def serve_event_loop(self):
+        """
+        Serves every connection from this thread (see the class docstring)
+        until the server socket is closed (KILL, stop()), checked at least
+        every second.
+        """
+        self.selector = selectors.DefaultSelector()
+        self.call_pool = ThreadPoolExecutor(max_workers=self.call_workers, thread_name_prefix='call')
+        # finished CALLs, handed back to the loop, which a byte on the wakeup socket interrupts
+        self.completed = queue.SimpleQueue()
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        for sock in (self.server_socket, self.wakeup_recv, self.wakeup_send):
+            sock.setblocking(False)
+        self.selector.register(self.server_socket, selectors.EVENT_READ, None)
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ, None)
+        try:
+            while self.server_socket.fileno() != -1:
+                for key, events in self.selector.select(timeout=1):
+                    if key.fileobj is self.server_socket:
+                        self._accept()
+                    elif key.fileobj is self.wakeup_recv:
+                        self._complete_calls()
+                    else:
+                        self._service(key.data, events)
+        finally:
+            self.call_pool.shutdown(wait=False)
+            for key in list(self.selector.get_map().values()):
+                key.fileobj.close()
+            self.selector.close()
+
+    def _accept(self):
+        while True:
+            try:
+                client_socket, addr = self.server_socket.accept()
+            except (BlockingIOError, OSError):
+                return
+            client_socket.setblocking(False)
+            if self.transport == 'tcp':
+                client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.selector.register(client_socket, selectors.EVENT_READ, _Connection(client_socket))
+
+    def _service(self, connection, events):
+        try:
+            if events & selectors.EVENT_READ:
+                for message in connection.read():
+                    self._dispatch(connection, message)
+            self._flush(connection)
+        except (EOFError, OSError):
+            self._close(connection)
+
+    def _dispatch(self, connection, message):
+        slot = [None]
+        connection.replies.append(slot)
+        try:
+            command, *args = pickle.loads(message)
+        except Exception as e:
+            slot[0] = self._encode_response(f"Error: {e}")
+            return
+        if command == 'CALL':
+            future = self.call_pool.submit(self._run_command, command, args)
+            future.add_done_callback(lambda done: self._call_done(connection, slot, done.result()))
+        else:
+            slot[0] = self._encode_response(self._run_command(command, args))
+
+    def _run_command(self, command, args):
+        try:
+            return self.process_command(command, *args)
+        except Exception as e:
+            return f"Error: {e}"
+
+    @staticmethod
+    def _encode_response(response):
+        try:
+            return encode_message(response)
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            return encode_message(f"Error: {e}")
+
+    def _call_done(self, connection, slot, response):
+        # runs in the worker thread: pickle here, leave the connection to the loop
+        self.completed.put((connection, slot, self._encode_response(response)))
+        try:
+            self.wakeup_send.send(b'\0')
+        except (BlockingIOError, OSError):
+            # already woken up, or shutting down
+            pass
+
+    def _complete_calls(self):
+        try:
+            while self.wakeup_recv.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while True:
+            try:
+                connection, slot, buffers = self.completed.get_nowait()
+            except queue.Empty:
+                return
+            slot[0] = buffers
+            if connection.sock.fileno() != -1:
+                try:
+                    self._flush(connection)
+                except OSError:
+                    self._close(connection)
+
+    def _flush(self, connection):
+        pending = connection.flush()
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if pending else 0)
+        if self.selector.get_key(connection.sock).events != events:
+            self.selector.modify(connection.sock, events, connection)
+
+    def _close(self, connection):
+        if connection.sock.fileno() != -1:
+            self.selector.unregister(connection.sock)
+            connection.sock.close()
+
     def shutdown_server(self):
         """
         Shutdown the server by closing the socket.
         """
         print("Shutting down the server...")
-        self.server_socket.close()
+        self._close_server_socket()
+        self.reap_segments(everything=True)
 
     def print_data_periodically(self):
         while not self.stop_event.is_set():
             time.sleep(60)  # Sleep for one minute
-            print("Current data:", self.data)
+            print("Current data:", preview(self.data))
 
     def stop(self):
         self.stop_event.set()
-        self.server_socket.close()
+        self._close_server_socket()
+        self.reap_segments(everything=True)
 
     @staticmethod
-    def start_shared_manager(port_number=50000):
+    def start_shared_manager(port_number=50000, event_loop=False, transport=None):
         def run_server():
-            server = ProcessSharedObject(port=port_number)
+            server = ProcessSharedObject(port=port_number, event_loop=event_loop, transport=transport)
             server.start()
 
         server_process = multiprocessing.Process(target=run_server)
@@ -306,8 +1126,8 @@ class ProcessSharedObject:
         return server_process
 
     @staticmethod
-    def connect_to_shared_manager(port_number=50000):
-        return SharedDataClient(port=port_number)
+    def connect_to_shared_manager(port_number=50000, transport=None):
+        return SharedDataClient(port=port_number, transport=transport)
 
     @staticmethod
     def stop_shared_manager():
@@ -327,29 +1147,208 @@ class ProcessSharedObject:
         ProcessSharedObject.manager_process = None
 
 class SharedDataClient:
-    def __init__(self, host='localhost', port=50000):
+    """
+    Client of a ProcessSharedObject. Connections are kept open and reused:
+    each command takes an idle connection from a small pool (opening one if
+    none is idle) and returns it afterwards, so threads of a process can
+    issue commands concurrently and a command costs a single round trip.
+    Connections inherited through fork are never reused by the child.
+
+    Connects over the same transport a ProcessSharedObject on host and port
+    listens on: its Unix socket for loopback hosts, otherwise TCP.
+
+    Buffers of at least shared_memory_min_bytes in the values it stores
+    (large NumPy arrays, bytes, DataFrame columns...) go through shared
+    memory rather than the socket, see SharedValue; None keeps every value
+    in the message. This needs the server on the same machine, so 'auto'
+    uses SHARED_MEMORY_MIN_BYTES only over the Unix socket or to a loopback
+    host, and None otherwise.
+    """
+    def __init__(self, host='localhost', port=50000, pool_size=4, transport=None,
+                 shared_memory_min_bytes='auto'):
         self.host = host
         self.port = port
+        self.transport = pick_transport(host, transport)
+        if shared_memory_min_bytes == 'auto':
+            local = self.transport == 'unix' or is_loopback(host)
+            shared_memory_min_bytes = SHARED_MEMORY_MIN_BYTES if local else None
+        self.shared_memory_min_bytes = shared_memory_min_bytes
+        self.pool_size = pool_size
+        self.idle = []
+        self.pool_lock = threading.Lock()
+        self.pid = os.getpid()
+
+    def _connect(self):
+        if self.transport == 'unix':
+            client_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                client_socket.connect(socket_path(self.port))
+            except OSError:
+                client_socket.close()
+                raise
+            return client_socket
+        client_socket = socket.create_connection((self.host, self.port))
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return client_socket
+
+    @contextmanager
+    def _connection(self):
+        """
+        Yields (socket, reused). The socket goes back to the pool unless the
+        block raised, since the stream may then be out of sync.
+        """
+        with self.pool_lock:
+            if self.pid != os.getpid():
+                # the parent's sockets, which it may still be using
+                self.idle, self.pid = [], os.getpid()
+            client_socket = self.idle.pop() if self.idle else None
+        reused = client_socket is not None
+        if not reused:
+            client_socket = self._connect()
+        try:
+            yield client_socket, reused
+        except BaseException:
+            client_socket.close()
+            raise
+        with self.pool_lock:
+            if len(self.idle) < self.pool_size and self.pid == os.getpid():
+                self.idle.append(client_socket)
+                return
+        client_socket.close()
 
     def send_command(self, command, *args):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_socket:
-            client_socket.connect((self.host, self.port))
-            client_socket.sendall(pickle.dumps((command, *args)))
-            response = pickle.loads(client_socket.recv(4096))
-            return response
+        return self._send(encode_message((command, *args)))
+
+    def _encode_value(self, command, *args):
+        """
+        encode_message() of a command whose last argument is a value to store,
+        with the value's large buffers moved to shared memory (see share()).
+        Returns (buffers, segments). The value is pickled just once: its
+        pickle goes into the message as is when it has no large buffers.
+        """
+        value = args[-1]
+        min_bytes = self.shared_memory_min_bytes if SHARED_MEMORY else None
+        if not min_bytes:
+            return encode_message((command, *args)), []
+        payload, buffers = _pickle_out_of_band(value, min_bytes)
+        if buffers:
+            value, segments = _share_buffers(value, payload, buffers)
+        else:
+            value, segments = _Pickled(payload), []
+        return encode_message((command, *args[:-1], value)), segments
+
+    def _send_value(self, command, *args):
+        buffers, segments = self._encode_value(command, *args)
+        if not segments:
+            return self._send(buffers)
+        with _handoff(segments) as rejected:
+            reply = self._send(buffers)
+            if _failed(reply):
+                rejected.extend(segments)
+            return reply
+
+    def _is_stale(self, error, reused, attempt):
+        """
+        Whether error is the first failure of a pooled connection the server
+        closed, whose command wasn't run and can be retried. The other idle
+        connections were closed along with it, so they are dropped too.
+        """
+        if not reused or attempt or not isinstance(error, STALE_CONNECTION_ERRORS):
+            return False
+        self.close()
+        return True
+
+    def _send(self, buffers):
+        """
+        Sends one message and returns the reply, retrying once on a new
+        connection if the pooled one turns out to be closed.
+        """
+        for attempt in range(2):
+            try:
+                with self._connection() as (client_socket, reused):
+                    try:
+                        for buffer in buffers:
+                            client_socket.sendall(buffer)
+                        return recv_message(client_socket)
+                    except (EOFError, OSError) as e:
+                        if self._is_stale(e, reused, attempt):
+                            raise _StaleConnection() from e
+                        raise
+            except _StaleConnection:
+                continue
+
+    def pipeline(self):
+        """
+        Returns a SharedPipeline that sends several commands before reading
+        any reply, for a single round trip.
+        """
+        return SharedPipeline(self)
+
+    def close(self):
+        with self.pool_lock:
+            idle, self.idle = self.idle, []
+        for client_socket in idle:
+            client_socket.close()
 
     def set_data(self, key, value):
-        return self.send_command('SET', key, value)
+        return self._send_value('SET', key, value)
 
     def get_data(self, key):
         ret = self.send_command('GET', key)
-        if ret == 'NOT_FOUND':
+        # ret may be an array, which doesn't compare to a str
+        if isinstance(ret, str) and ret == 'NOT_FOUND':
             return None
-        return ret
+        return load(ret)
 
     def has_data(self, key) -> bool:
         return self.send_command('HAS', key)
 
+    def get_versioned(self, key):
+        """
+        Returns (value, version) of key for compare_and_set(); the version
+        of a missing key is 0.
+        """
+        value, version = self.send_command('GET_VERSIONED', key)
+        return load(value), version
+
+    def compare_and_set(self, key, version, value):
+        """
+        Sets key to value only if it still has the version read with
+        get_versioned(). Returns the new version, or None if someone else
+        wrote the key in the meantime.
+        """
+        return self._send_value('CAS', key, version, value)
+
+    def execute(self, commands, watched=None):
+        """
+        Runs commands, a list of (command, *args) tuples, with no other write
+        in between. Returns their results, or None if one of the watched
+        keys ({key: version}) changed.
+        """
+        results = self.send_command('EXEC', watched or {}, list(commands))
+        if results is None or _failed(results):
+            return results
+        return [load(result) for result in results]
+
+    def transaction(self, func, *keys, retries=10):
+        """
+        Optimistic transaction: calls func(tx) with a SharedTransaction
+        watching keys; func reads with tx.get_data() and queues writes on tx.
+        They are applied atomically only if none of the watched keys changed
+        in the meantime, otherwise func is called again, up to retries times.
+        Returns the results of the queued commands.
+        """
+        for attempt in range(retries):
+            tx = SharedTransaction(self)
+            tx.watch(*keys)
+            func(tx)
+            try:
+                return tx.execute()
+            except WatchError:
+                # back off a little so competing writers don't keep colliding
+                time.sleep(random.uniform(0, min(0.5, 0.005 * 2 ** attempt)))
+        raise WatchError(f"Transaction on {list(keys)} still conflicting after {retries} attempts")
+
     def delete_data(self, key):
         ret = self.send_command('DELETE', key)
         if ret == 'NOT_FOUND':
@@ -362,11 +1361,177 @@ class SharedDataClient:
     def register_method(self, method_name, method):
         return self.send_command('REGISTER', method_name, method)
 
+    def scan(self, cursor=None, match=None, prefix=None, count=100, values=False):
+        cursor, items = self.send_command('SCAN', cursor, {'match': match, 'prefix': prefix,
+                                                           'count': count, 'values': values})
+        if values:
+            items = [(key, load(value)) for key, value in items]
+        return [cursor, items]
+
+    def scan_iter(self, match=None, prefix=None, count=100, values=False):
+        """
+        Yields every key (or (key, value) with values=True) matching the glob
+        pattern and/or prefix, fetching count keys per request.
+        """
+        cursor = None
+        while True:
+            cursor, items = self.scan(cursor, match=match, prefix=prefix, count=count, values=values)
+            yield from items
+            if cursor is None:
+                return
+
     def list_keys(self):
         return self.send_command('LIST_KEYS')
 
     def list_data(self):
-        return self.send_command('LIST_DATA')
+        return [(key, load(value)) for key, value in self.send_command('LIST_DATA')]
+
+class SharedPipeline:
+    """
+    Commands of a SharedDataClient sent back to back on one connection;
+    execute() then reads their replies in order. Each method returns the
+    pipeline so calls can be chained, and it can be used as a context
+    manager that executes on exit.
+
+        with client.pipeline() as pipe:
+            pipe.get_data('a').get_data('b').set_data('c', 1)
+        a, b, _ = pipe.results
+    """
+    def __init__(self, client):
+        self.client = client
+        # the encoded commands, and the shared memory segments of each one's value
+        self.messages = []
+        self.segments = []
+        self.results = None
+
+    def _queue(self, command, *args):
+        self.messages.append(encode_message((command, *args)))
+        self.segments.append([])
+        return self
+
+    def set_data(self, key, value):
+        buffers, segments = self.client._encode_value('SET', key, value)
+        self.messages.append(buffers)
+        self.segments.append(segments)
+        return self
+
+    def get_data(self, key):
+        return self._queue('GET', key)
+
+    def has_data(self, key):
+        return self._queue('HAS', key)
+
+    def delete_data(self, key):
+        return self._queue('DELETE', key)
+
+    def call_method(self, method_name, *args, **kwargs):
+        return self._queue('CALL', method_name, args, kwargs)
+
+    def execute(self):
+        """
+        Sends the queued commands and returns their replies in order.
+        """
+        messages, self.messages = self.messages, []
+        segments, self.segments = self.segments, []
+        buffers = [buffer for message in messages for buffer in message]
+        with _handoff([segment for shared in segments for segment in shared]) as rejected:
+            for attempt in range(2):
+                try:
+                    self.results = self._send_pipelined(buffers, len(messages), attempt)
+                    break
+                except _StaleConnection:
+                    continue
+            for result, shared in zip(self.results, segments):
+                if _failed(result):
+                    rejected.extend(shared)
+        return self.results
+
+    def _send_pipelined(self, buffers, count, attempt):
+        results = []
+        with self.client._connection() as (client_socket, reused):
+            # write from another thread: with large replies the server stops
+            # reading until they are read, and a single thread would deadlock
+            sender = threading.Thread(target=self._send_all, args=(client_socket, buffers))
+            sender.daemon = True
+            sender.start()
+            try:
+                for _ in range(count):
+                    results.append(load(recv_message(client_socket)))
+            except (EOFError, OSError) as e:
+                # once a reply arrived the commands ran, and can't be sent again
+                if not results and self.client._is_stale(e, reused, attempt):
+                    raise _StaleConnection() from e
+                raise
+            sender.join()
+        return results
+
+    @staticmethod
+    def _send_all(client_socket, buffers):
+        try:
+            for buffer in buffers:
+                client_socket.sendall(buffer)
+        except OSError:
+            # the reading side sees the connection close
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+
+
+class SharedTransaction:
+    """
+    Commands of a SharedDataClient applied atomically (WATCH/MULTI/EXEC).
+    Until the first queued command, get_data() reads immediately and
+    watches the keys it reads. execute() raises WatchError, and applies
+    nothing, if a watched key was written by someone else since it was read.
+    """
+    def __init__(self, client):
+        self.client = client
+        self.watched = {}
+        self.commands = []
+        self.segments = []
+        self.results = None
+
+    def watch(self, *keys):
+        for key in keys:
+            value, self.watched[key] = self.client.get_versioned(key)
+
+    def get_data(self, key):
+        if self.commands:
+            return self._queue('GET', key)
+        value, self.watched[key] = self.client.get_versioned(key)
+        return value
+
+    def _queue(self, command, *args):
+        self.commands.append((command, *args))
+        return self
+
+    def set_data(self, key, value):
+        value, segments = share(value, self.client.shared_memory_min_bytes)
+        self.segments.extend(segments)
+        return self._queue('SET', key, value)
+
+    def delete_data(self, key):
+        return self._queue('DELETE', key)
+
+    def has_data(self, key):
+        return self._queue('HAS', key)
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        segments, self.segments = self.segments, []
+        # the server discards the values of a transaction it doesn't apply,
+        # or of the commands it didn't get to when one raised
+        with _handoff(segments):
+            results = self.client.execute(commands, self.watched)
+        if results is None:
+            raise WatchError(f"Watched keys changed: {list(self.watched)}")
+        self.results = results
+        return results
 
 # Start Shared Manager and Register the stop_server_process function to be called on exit
 ProcessSharedObject.start_shared_manager(50000)
@@ -421,9 +1586,8 @@ class SharedProcessBase:
         Returns:
             The data associated with the key, or None if the key does not exist.
         """
-        if self.shared_object.has_data(key):
-            return self.shared_object.get_data(key)
-        return None
+        # a missing key reads as None, no need to ask HAS first
+        return self.shared_object.get_data(key)
 
     def list_data(self):
         """
@@ -478,12 +1642,16 @@ class SharedProcessBase:
         self.listeners[event_name] = callback
 
     def fire_event(self, event_name, value):
-        existing_data = self.shared_object.get_data(event_name) or []
-        if isinstance(existing_data, list):
-            existing_data.append(value)
-        else:
-            existing_data = [existing_data, value]
-        self.set_data(event_name, existing_data)
+        # compare-and-set, so events fired concurrently by other processes aren't overwritten
+        while True:
+            existing_data, version = self.shared_object.get_versioned(event_name)
+            existing_data = existing_data or []
+            if isinstance(existing_data, list):
+                existing_data.append(value)
+            else:
+                existing_data = [existing_data, value]
+            if self.shared_object.compare_and_set(event_name, version, existing_data) is not None:
+                return
 
     def start_listening(self, asynchronous:bool):
         """
@@ -519,11 +1687,25 @@ class SharedProcessBase:
         """
         while not self.stop_event.is_set():
             time.sleep(1)  # Polling interval
-            for event_name, callback in self.listeners.items():
-                if self.shared_object.has_data(event_name):
-                    value = self.shared_object.get_data(event_name) or []
+            listeners = list(self.listeners.items())
+            if not listeners:
+                continue
+            # read and clear every event in one step (and one round trip), so events fired in between aren't lost
+            try:
+                results = self.shared_object.execute([command for event_name, callback in listeners
+                                                      for command in (('GET', event_name), ('DELETE', event_name))])
+            except (EOFError, OSError) as e:
+                print(f"Error reading events: {e}")
+                continue
+            if _failed(results):
+                # nothing was deleted, so the events are read again on the next poll
+                print(f"Error reading events: {results}")
+                continue
+            for index, (event_name, callback) in enumerate(listeners):
+                value, deleted = results[2 * index:2 * index + 2]
+                if deleted:
+                    value = value or []
                     print("Listening for event:", event_name, "with value:", value)
-                    self.shared_object.delete_data(event_name)  # Clear the event before handling
                     if isinstance(value, list):
                         for item in value:
                             try:
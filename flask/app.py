@@ -1,37 +1,180 @@
+import atexit
 import logging
 import os
 import uuid
-from flask import Flask, request, jsonify, send_from_directory
-import threading
+from flask import Flask, Response, abort, g, request, jsonify, send_from_directory
 import time
 from flask_cors import CORS
-from datetime import datetime
 from werkzeug.utils import secure_filename
+from kv_store import TRANSACTION_METHODS, StoreError
+from metrics import MetricsRegistry, SIZE_BUCKETS
+from store_service import RemoteStore, StoreService
+from audit_log import AuditLog, setup_queue_logging
+import wire
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all domains on all routes.
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
+# Configure logging: records are written by a background listener thread,
+# command payloads are truncated and can be sampled (LOG_SAMPLE_RATE 0..1).
+setup_queue_logging(os.getenv('LOG_LEVEL', 'INFO').upper(), '%(asctime)s - %(message)s')
 logger = logging.getLogger()
+audit_log = AuditLog(logger,
+                     sample_rate=float(os.getenv('LOG_SAMPLE_RATE', '1.0')),
+                     max_chars=int(os.getenv('LOG_MAX_CHARS', '200')))
 
-data_store = {}
+# STORE_SOCKET: use the shared store process started by serve.py instead of
+# an in-process store (configured from the STORE_* environment variables)
+STORE_SOCKET = os.getenv('STORE_SOCKET', '')
+data_store = RemoteStore(STORE_SOCKET) if STORE_SOCKET else StoreService.from_env()
+MAX_WAIT_TIMEOUT = 60
+# Responses of at least this many bytes are compressed if the client accepts gzip/deflate
+COMPRESS_MIN_BYTES = int(os.getenv('COMPRESS_MIN_BYTES', '1024'))
+# Anything else is reported as UNKNOWN in metrics to keep label cardinality bounded
+KNOWN_COMMANDS = {'SET', 'GET', 'PUSH', 'DRAIN', 'DELETE', 'HAS', 'EXPIRE', 'TTL', 'SCAN', 'LIST_KEYS', 'LIST_DATA', 'CLEAR',
+                  'PUBLISH', 'SUBSCRIBE', 'UNSUBSCRIBE', 'RECEIVE', 'QUEUE_LIMIT', 'QUEUE_INFO',
+                  'CAS', 'EXEC', 'SETPATH', 'HSET', 'HGET', 'HGETALL', 'HDEL', 'INCRBY', 'SADD', 'SREM', 'SMEMBERS',
+                  'READ', 'XADD', 'XGROUP', 'XREAD', 'XREADGROUP', 'XACK', 'XPENDING', 'XLEN'}
 
 UPLOAD_FOLDER = 'uploads'
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
-file_registry = {}
-
-def print_data_store():
-    while True:
-        time.sleep(10)
-        logger.info("Current data_store contents:")
-        for key, value in data_store.items():
-            logger.info(f"{key} -> {value}")
+metrics = MetricsRegistry()
+command_count = metrics.counter('store_commands_total', 'Commands processed by the data store.', 'command')
+command_errors = metrics.counter('store_command_errors_total', 'Commands that raised an error.', 'command')
+command_latency = metrics.histogram('store_command_duration_seconds', 'Command execution time.', 'command')
+payload_size = metrics.histogram('store_request_payload_bytes', 'Request body size.', 'route', SIZE_BUCKETS)
+# every store gauge comes from one stats() call per scrape, which under
+# serve.py is a round trip to the store process
+store_stats = metrics.collector(data_store.stats)
+store_stats.gauge('store_keys', 'Number of keys in the data store.', 'keys')
+store_stats.gauge('store_bytes', 'Approximate size of the data store in bytes.', 'used_memory')
+store_stats.gauge('store_maxmemory_bytes', 'Configured memory budget, 0 if unlimited.', 'maxmemory')
+store_stats.gauge('store_evicted_keys_total', 'Keys evicted to stay within maxmemory.',
+                  'evicted_keys', metric_type='counter')
+store_stats.gauge('store_expired_keys_total', 'Keys removed because their TTL expired.',
+                  'expired_keys', metric_type='counter')
+store_stats.gauge('store_queue_dropped_entries_total', 'Entries dropped because a bounded queue was full.',
+                  'queue_dropped_entries', metric_type='counter')
+store_stats.gauge('store_queue_rejected_pushes_total', 'Pushes rejected because a bounded queue was full.',
+                  'queue_rejected_pushes', metric_type='counter')
+store_stats.gauge('store_queue_max_depth', 'Entries in the longest bounded queue.', 'queue_max_depth')
+store_stats.gauge('pubsub_subscriptions', 'Live pub/sub subscriptions.', 'subscriptions')
+store_stats.gauge('pubsub_published_messages_total', 'Messages published on pub/sub channels.',
+                  'published_messages', metric_type='counter')
+store_stats.gauge('pubsub_dropped_messages_total', 'Messages dropped because a subscriber buffer was full.',
+                  'dropped_messages', metric_type='counter')
+store_stats.gauge('stream_entries', 'Entries held in streams.', 'stream_entries')
+store_stats.gauge('stream_pending_entries', 'Stream entries delivered to a consumer group but not acknowledged.',
+                  'pending_entries')
 
 def log_operation(operation, args):
-    timestamp = datetime.now().strftime("%d%m%y")
-    logger.info(f"{timestamp}-{operation}-data: {args}")
+    audit_log.log(operation, args)
+
+def read_payload():
+    """
+    The request body, decoded according to its Content-Type (MessagePack or
+    JSON) and Content-Encoding, see wire.py.
+    """
+    if 'payload' not in g:
+        if request.mimetype == wire.MSGPACK and wire.msgpack is None:
+            abort(415)
+        try:
+            body = wire.decompress(request.get_data(), request.headers.get('Content-Encoding'))
+            g.payload = wire.decode(body, request.mimetype)
+        except Exception as e:
+            logger.warning(f"Undecodable request body: {e}")
+            abort(400)
+    return g.payload
+
+def respond(status=200, **fields):
+    """
+    Encodes fields in the format negotiated with the client, compressed
+    above COMPRESS_MIN_BYTES if the client accepts it.
+    """
+    content_type = wire.negotiate(request.mimetype, request.headers.get('Accept'))
+    body = wire.encode(fields, content_type)
+    headers = {}
+    encoding = wire.accepted_encoding(request.headers.get('Accept-Encoding'))
+    if encoding and len(body) >= COMPRESS_MIN_BYTES:
+        body = wire.compress(body, encoding)
+        headers['Content-Encoding'] = encoding
+    headers['Vary'] = 'Accept, Accept-Encoding'
+    return Response(body, status=status, mimetype=content_type, headers=headers)
+
+@app.route('/wait', methods=['POST'])
+def wait_for_keys():
+    """
+    Long-poll: blocks until at least one of the requested keys holds a value
+    or the timeout expires. Returns the same shape as a multi-key GET.
+    A waiting request sleeps on an event and costs no CPU.
+
+    With {"after": {key: last_seen_id}} instead of keys it waits for entries
+    newer than the given ids and returns them in the shape of READ;
+    {"trim": true} first drops the entries up to those ids, as for READ.
+    """
+    payload = read_payload()
+    timeout = min(float(payload.get('timeout', 30)), MAX_WAIT_TIMEOUT)
+    if 'after' in payload:
+        after = payload['after']
+        log_operation('WAIT', after)
+        command_count.inc('WAIT')
+        return respond(result=data_store.read_since(after, payload.get('count'), timeout,
+                                                     trim=bool(payload.get('trim', False))))
+
+    keys = payload.get('keys', [])
+    if not isinstance(keys, list):
+        keys = [keys]
+    # drain: atomically remove the keys that are returned (same as DRAIN)
+    drain = bool(payload.get('drain', False))
+
+    log_operation('WAIT', keys)
+    command_count.inc('WAIT')
+
+    return respond(result=data_store.wait(keys, timeout, drain=drain))
+
+@app.route('/receive', methods=['POST'])
+def receive_messages():
+    """
+    Long-poll for pub/sub: blocks until the subscription has buffered
+    messages or the timeout expires, and returns {"messages", "dropped"}.
+    Answers 404 if the subscription is unknown (e.g. removed while idle).
+    """
+    payload = read_payload()
+    subscription = payload.get('subscription')
+    timeout = min(float(payload.get('timeout', 30)), MAX_WAIT_TIMEOUT)
+    count = int(payload.get('count', 100))
+
+    command_count.inc('RECEIVE')
+    try:
+        return respond(result=data_store.receive(subscription, timeout, count))
+    except StoreError as e:
+        return respond(result=None, error=str(e), status=e.status)
+
+@app.before_request
+def record_payload_size():
+    if request.content_length and request.url_rule is not None:
+        payload_size.observe(request.url_rule.rule, request.content_length)
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/logging', methods=['GET', 'POST'])
+def logging_config():
+    """
+    Reads or changes the audit logging settings at runtime:
+    POST {"level": "WARNING", "sample_rate": 0.1, "max_chars": 100}
+    """
+    if request.method == 'POST':
+        settings = request.json or {}
+        try:
+            return jsonify(result=audit_log.configure(level=settings.get('level'),
+                                                      sample_rate=settings.get('sample_rate'),
+                                                      max_chars=settings.get('max_chars')))
+        except ValueError as e:
+            return jsonify(result=None, error=str(e)), 400
+    return jsonify(result=audit_log.as_dict())
 
 @app.route('/upload', methods=['POST'])
 def upload_file():
@@ -45,15 +188,15 @@ def upload_file():
         saved_filename = str(uuid.uuid4())
         file_path = os.path.join(UPLOAD_FOLDER, saved_filename)
         file.save(file_path)
-        file_registry[saved_filename] = original_filename
+        data_store.register_file(saved_filename, original_filename)
         return jsonify(result='File uploaded', url=f'/download/{saved_filename}'), 201
 
 @app.route('/download/<filename>', methods=['GET'])
 def download_file(filename):
     try:
-        if filename not in file_registry:
+        original_filename = data_store.lookup_file(filename)
+        if original_filename is None:
             return jsonify(result='File not found'), 404
-        original_filename = file_registry[filename]
         return send_from_directory(UPLOAD_FOLDER, filename, as_attachment=True, download_name=original_filename)
     except Exception as e:
         app.logger.error(f"Error downloading file: {e}")
@@ -61,60 +204,297 @@ def download_file(filename):
 
 @app.route('/delete/<filename>', methods=['DELETE'])
 def delete_file(filename):
-    if filename not in file_registry:
+    if data_store.lookup_file(filename) is None:
         return jsonify(result='File not found'), 404
     file_path = os.path.join(UPLOAD_FOLDER, filename)
     if os.path.exists(file_path):
         os.remove(file_path)
-        del file_registry[filename]
+        data_store.unregister_file(filename)
         return jsonify(result='File deleted'), 200
     else:
         return jsonify(result='File not found'), 404
 
 @app.route('/command', methods=['POST'])
 def process_command():
-    command = request.json.get('command')
-    args = request.json.get('args', [])
+    """
+    Accepts either a single {"command", "args"} pair, answered with {"result"},
+    or a pipeline {"commands": [{"command", "args"}, ...]} answered with
+    {"results": [...]} in the same order, so a batch costs a single round trip.
+    Commands refused by the store are reported in "error" / "errors".
+    Bodies may be JSON or MessagePack, see read_payload / respond.
+    """
+    payload = read_payload()
+    if 'commands' in payload:
+        # a refused or failed command yields None and an entry in errors, keyed
+        # by its index; the commands before it were applied, so the rest still run
+        results, errors = [], {}
+        for index, item in enumerate(payload['commands']):
+            try:
+                results.append(run_command(item.get('command'), item.get('args', [])))
+            except StoreError as e:
+                results.append(None)
+                errors[index] = str(e)
+            except Exception as e:
+                logger.exception(f"Error in pipelined command {index}")
+                results.append(None)
+                errors[index] = f"{type(e).__name__}: {e}"
+        data_store.wait_synced()
+        return respond(results=results, errors=errors)
+
+    command = payload.get('command')
+    args = payload.get('args', [])
+    try:
+        result = run_command(command, args)
+    except StoreError as e:
+        return respond(result=None, error=str(e), status=e.status)
+    data_store.wait_synced()
+    return respond(result=result)
 
+def run_command(command, args):
     log_operation(command, args)
 
+    label = command if command in KNOWN_COMMANDS else 'UNKNOWN'
+    command_count.inc(label)
+    start = time.perf_counter()
+    try:
+        result = execute_command(command, args)
+    except Exception:
+        command_errors.inc(label)
+        raise
+    command_latency.observe(label, time.perf_counter() - start)
+    return result
+
+def execute_command(command, args, store=data_store):
     if command == 'SET':
-        key, value = args
-        data_store[key] = value
-        return jsonify(result=True)
+        # optional third argument: {"ttl": seconds}
+        key, value, *options = args
+        options = options[0] if options else {}
+        return store.set(key, value, ttl=options.get('ttl'))
     elif command == 'GET':
         if isinstance(args, list):
-            result = {key: data_store.get(key, None) for key in args}
-            # Filter out None values from result
-            result = {k: v for k, v in result.items() if v is not None}
-            if not result:
-                result = None
+            # a trailing {"path"} projects each value (see paths.py), a trailing
+            # {"versions", "revision"} makes it a conditional GET, see DataStore.get_versioned
+            if args and isinstance(args[-1], dict):
+                *keys, options = args
+                if options.get('path') is not None:
+                    return store.get_path(keys, options['path'])
+                return store.get_versioned(keys, options.get('versions'), options.get('revision'))
+            return store.get_many(args)
         else:
             key = args
-            result = data_store.get(key, None)
-        return jsonify(result=result)
+            return store.get(key)
+    elif command == 'PUSH':
+        key, value, *options = args
+        options = options[0] if options else {}
+        # optional third argument: {"ttl": seconds, "maxlen": entries kept,
+        # "overflow": policy when full, "timeout": seconds to block for}, see DataStore.push
+        timeout = min(float(options.get('timeout', 0)), MAX_WAIT_TIMEOUT)
+        return store.push(key, value, ttl=options.get('ttl'), maxlen=options.get('maxlen'),
+                          overflow=options.get('overflow'), timeout=timeout)
+    elif command == 'QUEUE_LIMIT':
+        # [key, maxlen, {"overflow"}]; maxlen 0 for unbounded, null for the store default
+        key, maxlen, *options = args
+        options = options[0] if options else {}
+        return store.set_queue_limit(key, maxlen, options.get('overflow', 'drop_oldest'))
+    elif command == 'QUEUE_INFO':
+        # [key, ...]; returns {key: {"length", "maxlen", "overflow", "dropped", "rejected"}}
+        return store.queue_info(args)
+    elif command == 'DRAIN':
+        keys = args if isinstance(args, list) else [args]
+        # optional trailing {"revision"}, see if_modified
+        if keys and isinstance(keys[-1], dict):
+            *keys, options = keys
+            return if_modified(options.get('revision'), lambda: store.drain(keys))
+        return store.drain(keys)
     elif command == 'DELETE':
         key = args[0]
-        deleted = data_store.pop(key, None) is not None
-        return jsonify(result=deleted)
+        return store.delete(key)
     elif command == 'HAS':
         key = args[0]
-        has_key = key in data_store
-        return jsonify(result=has_key)
+        return store.has(key)
+    elif command == 'EXPIRE':
+        key, ttl = args
+        return store.expire(key, ttl)
+    elif command == 'TTL':
+        key = args[0]
+        return store.ttl(key)
+    elif command == 'SCAN':
+        # [cursor, {"match", "prefix", "count", "values"}], see DataStore.scan
+        cursor, *options = args
+        options = options[0] if options else {}
+        return store.scan(cursor, match=options.get('match'), prefix=options.get('prefix'),
+                               count=options.get('count', 100), values=options.get('values', False))
+    elif command == 'CAS':
+        # [key, version, value, {"ttl"}]; returns the new version, or null if the key changed since version
+        key, version, value, *options = args
+        options = options[0] if options else {}
+        return store.cas(key, version, value, ttl=options.get('ttl'))
+    elif command == 'EXEC':
+        # [[{"command", "args"}, ...], {"watch": {key: version}}]; see DataStore.execute
+        commands, *options = args
+        options = options[0] if options else {}
+        return store.execute(options.get('watch') or {}, queue_transaction(commands))
+    elif command == 'SETPATH':
+        # [key, path, value, {"append": bool}]; sets (or appends to the list at) a path inside the value
+        key, path, value, *options = args
+        options = options[0] if options else {}
+        return store.set_path(key, path, value, append=options.get('append', False))
+    elif command == 'HSET':
+        # [key, {field: value, ...}]; returns the number of new fields
+        key, mapping = args
+        return store.hset(key, mapping)
+    elif command == 'HGET':
+        key, field = args
+        return store.hget(key, field)
+    elif command == 'HGETALL':
+        key = args[0]
+        return store.hgetall(key)
+    elif command == 'HDEL':
+        key, fields = args
+        return store.hdel(key, fields)
+    elif command == 'INCRBY':
+        # [key, amount]; returns the new value
+        key, *amount = args
+        return store.incrby(key, amount[0] if amount else 1)
+    elif command == 'SADD':
+        # [key, [member, ...]]; returns the number of members added
+        key, members = args
+        return store.sadd(key, members)
+    elif command == 'SREM':
+        key, members = args
+        return store.srem(key, members)
+    elif command == 'SMEMBERS':
+        key = args[0]
+        return store.smembers(key)
+    elif command == 'PUBLISH':
+        # returns the number of subscriptions the message was delivered to
+        channel, message = args
+        return store.publish(channel, message)
+    elif command == 'SUBSCRIBE':
+        # [channels, {"patterns", "subscription"}]; returns the subscription id
+        channels, *options = args
+        options = options[0] if options else {}
+        return store.subscribe(channels, options.get('patterns'), options.get('subscription'))
+    elif command == 'UNSUBSCRIBE':
+        # [subscription, {"channels", "patterns"}]; without options the subscription is closed
+        subscription, *options = args
+        options = options[0] if options else {}
+        return store.unsubscribe(subscription, options.get('channels'), options.get('patterns'))
+    elif command == 'RECEIVE':
+        # non-blocking; use the /receive endpoint to wait for messages
+        subscription, *options = args
+        options = options[0] if options else {}
+        return store.receive(subscription, 0, options.get('count', 100))
+    elif command == 'XADD':
+        # [key, value, {"maxlen"}]; returns the entry id
+        key, value, *options = args
+        options = options[0] if options else {}
+        return store.xadd(key, value, options.get('maxlen'))
+    elif command == 'XGROUP':
+        # [key, group, {"start": "$" | id, "visibility_timeout": seconds}]
+        key, group, *options = args
+        options = options[0] if options else {}
+        return store.xgroup(key, group, options.get('start', '$'), options.get('visibility_timeout', 30))
+    elif command == 'XREAD':
+        # [key, last_seen_id, {"count", "block": seconds}]; returns [[id, value], ...]
+        key, after, *options = args
+        options = options[0] if options else {}
+        block = min(float(options.get('block', 0)), MAX_WAIT_TIMEOUT)
+        return store.xread(key, after, options.get('count', 100), block)
+    elif command == 'XREADGROUP':
+        # [key, group, consumer, {"count", "block": seconds}]; returns [[id, value], ...]
+        key, group, consumer, *options = args
+        options = options[0] if options else {}
+        block = min(float(options.get('block', 0)), MAX_WAIT_TIMEOUT)
+        return store.xreadgroup(key, group, consumer, options.get('count', 10), block)
+    elif command == 'XACK':
+        key, group, ids = args
+        return store.xack(key, group, ids)
+    elif command == 'XPENDING':
+        key, group = args
+        return store.xpending(key, group)
+    elif command == 'XLEN':
+        key = args[0]
+        return store.xlen(key)
+    elif command == 'READ':
+        # [{key: last_seen_id, ...}, {"count", "trim"}]; see DataStore.read_since
+        after, *options = args
+        options = options[0] if options else {}
+        trim = bool(options.get('trim', False))
+        if 'revision' in options:
+            return if_modified(options['revision'], lambda: store.read_since(after, options.get('count'), trim=trim))
+        return store.read_since(after, options.get('count'), trim=trim)
     elif command == 'LIST_KEYS':
-        keys = list(data_store.keys())
-        return jsonify(result=keys)
+        return store.keys()
     elif command == 'LIST_DATA':
-        data_items = list(data_store.items())
-        return jsonify(result=data_items)
+        return store.items()
     elif command == 'CLEAR':
-        data_store.clear()
-        return jsonify(result="Data store cleared.")
+        store.clear()
+        return "Data store cleared."
     else:
-        return jsonify(result='UNKNOWN_COMMAND')
+        return 'UNKNOWN_COMMAND'
+
+class TransactionQueue:
+    """
+    Stands in for the store while execute_command parses the commands of an
+    EXEC: collects the store calls they would make, for DataStore.execute
+    to make atomically.
+    """
+    QUEUED = object()
+
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, method):
+        if method not in TRANSACTION_METHODS:
+            raise StoreError(f"'{method}' can't be used in a transaction")
+
+        def queue(*args, **kwargs):
+            self.calls.append([method, list(args), kwargs])
+            return self.QUEUED
+        return queue
+
+def queue_transaction(commands):
+    queue = TransactionQueue()
+    for item in commands:
+        command = item.get('command')
+        if execute_command(command, item.get('args', []), store=queue) is not TransactionQueue.QUEUED:
+            raise StoreError(f"{command} can't be used in a transaction")
+    return queue.calls
+
+def if_modified(revision, fetch):
+    """
+    Conditional read for pollers that know the store revision: answers
+    null without touching any key if nothing was written since, else
+    {"revision", "values": fetch()}.
+    """
+    current = data_store.changed_since(revision)
+    if current is None:
+        return None
+    return {'revision': current, 'values': fetch()}
+
+_services_started = False
+
+def start_services():
+    """
+    Restores the persisted data and starts the background threads (TTL
+    reaper, persistence, summary dump) of the in-process store. Importing
+    this module doesn't, so every entry point calls it once: python app.py,
+    wsgi.py and the workers of serve.py. With a shared store process
+    (STORE_SOCKET) that process runs them instead, and this does nothing.
+    """
+    global _services_started
+    if _services_started or STORE_SOCKET:
+        return
+    _services_started = True
+    data_store.start()
+    atexit.register(data_store.stop)
 
 if __name__ == '__main__':
-    print_thread = threading.Thread(target=print_data_store, daemon=True)
-    print_thread.start()
+    # With the debug reloader the parent process only watches files; the
+    # child (WERKZEUG_RUN_MAIN set) serves requests and owns the services.
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_services()
 
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    # threaded so that long-poll /wait requests don't block other clients
+    app.run(debug=True, host='0.0.0.0', port=5000, threaded=True)
@@ -0,0 +1,105 @@
+import atexit
+import logging
+import queue
+import random
+import threading
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+
+
+def setup_queue_logging(level=logging.INFO, fmt='%(asctime)s - %(message)s'):
+    """
+    Routes the root logger through a QueueHandler so request threads only
+    enqueue records; a QueueListener thread does the formatting and I/O.
+    """
+    log_queue = queue.Queue(-1)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(fmt))
+    listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    queue_handler = QueueHandler(log_queue)
+    # only merge the message arguments here; the listener applies the real format
+    queue_handler.setFormatter(logging.Formatter('%(message)s'))
+    logging.basicConfig(level=level, handlers=[queue_handler], force=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+def summarize(value, max_chars=200, depth=2):
+    """
+    Bounded description of a value for logging. Never walks more than a few
+    items per container, so its cost does not grow with the size of the value.
+    """
+    if isinstance(value, str):
+        if len(value) > max_chars:
+            return repr(value[:max_chars]) + f"...(+{len(value) - max_chars} chars)"
+        return repr(value)
+    if isinstance(value, (list, tuple)):
+        if depth == 0:
+            return f"{type(value).__name__}[{len(value)}]"
+        items = [summarize(item, max_chars, depth - 1) for item in value[:3]]
+        if len(value) > 3:
+            items.append(f"...(+{len(value) - 3} items)")
+        return "[" + ", ".join(items) + "]"
+    if isinstance(value, dict):
+        if depth == 0:
+            return f"dict[{len(value)}]"
+        items = [f"{key!r}: {summarize(item, max_chars, depth - 1)}"
+                 for key, item in list(value.items())[:5]]
+        if len(value) > 5:
+            items.append(f"...(+{len(value) - 5} keys)")
+        return "{" + ", ".join(items) + "}"
+    text = repr(value)
+    return text if len(text) <= max_chars else text[:max_chars] + "..."
+
+
+class AuditLog:
+    """
+    Per-command audit logging with payload truncation and sampling.
+    level, sample_rate and max_chars can be changed at runtime with configure().
+    """
+    def __init__(self, logger, sample_rate=1.0, max_chars=200):
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.configure(sample_rate=sample_rate, max_chars=max_chars)
+
+    def configure(self, level=None, sample_rate=None, max_chars=None):
+        """
+        Changes the given settings. Raises ValueError, and changes nothing,
+        if one of them is invalid (e.g. an unknown level name).
+        """
+        if isinstance(level, str):
+            if level.upper() not in logging._nameToLevel:
+                raise ValueError(f"Unknown log level '{level}', expected one of {', '.join(logging._nameToLevel)}")
+            level = logging._nameToLevel[level.upper()]
+        elif level is not None and (not isinstance(level, int) or isinstance(level, bool)):
+            raise ValueError(f"Log level must be a name or a number, not {level!r}")
+        try:
+            if sample_rate is not None:
+                sample_rate = min(max(float(sample_rate), 0.0), 1.0)
+            if max_chars is not None:
+                max_chars = max(int(max_chars), 0)
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"Invalid logging setting: {e}") from None
+        with self.lock:
+            if level is not None:
+                self.logger.setLevel(level)
+            if sample_rate is not None:
+                self.sample_rate = sample_rate
+            if max_chars is not None:
+                self.max_chars = max_chars
+        return self.as_dict()
+
+    def as_dict(self):
+        return {'level': logging.getLevelName(self.logger.getEffectiveLevel()),
+                'sample_rate': self.sample_rate,
+                'max_chars': self.max_chars}
+
+    def log(self, operation, args):
+        # Check level and sampling before doing any formatting work
+        if not self.logger.isEnabledFor(logging.INFO):
+            return
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+        timestamp = datetime.now().strftime("%d%m%y")
+        self.logger.info("%s-%s-data: %s", timestamp, operation, summarize(args, self.max_chars))
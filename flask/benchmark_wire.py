@@ -0,0 +1,109 @@
+"""
+Benchmark of the /command wire formats (see wire.py): JSON vs MessagePack,
+with and without gzip/deflate, on payloads shaped like the ones the store
+carries.
+
+    python benchmark_wire.py                          # codecs only
+    python benchmark_wire.py --url http://localhost:5000   # plus live round trips
+
+The live part stores a chat history on the server and reads it back in each
+format, reporting latency and bytes on the wire.
+"""
+import argparse
+import random
+import string
+import time
+import timeit
+
+import requests
+
+import wire
+
+
+def chat_history(messages=200):
+    rng = random.Random(1)
+    words = [''.join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 9))) for _ in range(2000)]
+    return [{'role': 'user' if i % 2 == 0 else 'assistant',
+             'content': ' '.join(rng.choices(words, k=rng.randint(10, 150))),
+             'timestamp': 1718000000 + i * 17,
+             'metadata': {'tokens': rng.randint(10, 400), 'model': 'gpt-4o', 'tools': []}}
+            for i in range(messages)]
+
+
+def pipeline(commands=100):
+    return {'commands': [{'command': 'SET', 'args': [f'session:{i}:state', {'step': i, 'done': False,
+                                                                             'score': i * 0.25}]}
+                         for i in range(commands)]}
+
+
+def embeddings(vectors=8, dims=1536):
+    rng = random.Random(2)
+    return [[rng.uniform(-1, 1) for _ in range(dims)] for _ in range(vectors)]
+
+
+PAYLOADS = {
+    'chat history (200 msgs)': lambda: {'result': chat_history()},
+    'pipeline (100 SETs)': pipeline,
+    'embeddings (8x1536)': lambda: {'result': embeddings()},
+}
+
+
+def best_of(func, number):
+    return min(timeit.repeat(func, number=number, repeat=5)) / number
+
+
+def bench_codecs(number):
+    print(f"{'payload':<26}{'format':<10}{'bytes':>10}{'gzip':>10}{'deflate':>10}"
+          f"{'encode µs':>12}{'decode µs':>12}{'gzip µs':>10}")
+    for name, make in PAYLOADS.items():
+        payload = make()
+        for content_type in (wire.JSON, wire.MSGPACK):
+            if content_type == wire.MSGPACK and wire.msgpack is None:
+                print(f"{name:<26}msgpack   (not installed)")
+                continue
+            body = wire.encode(payload, content_type)
+            encode = best_of(lambda: wire.encode(payload, content_type), number)
+            decode = best_of(lambda: wire.decode(body, content_type), number)
+            compress = best_of(lambda: wire.compress(body, 'gzip'), number)
+            label = 'json' if content_type == wire.JSON else 'msgpack'
+            print(f"{name:<26}{label:<10}{len(body):>10}{len(wire.compress(body, 'gzip')):>10}"
+                  f"{len(wire.compress(body, 'deflate')):>10}"
+                  f"{encode * 1e6:>12.1f}{decode * 1e6:>12.1f}{compress * 1e6:>10.1f}")
+
+
+def bench_live(url, number):
+    session = requests.Session()
+    session.post(f'{url}/command', json={'command': 'SET', 'args': ['benchmark:history', chat_history()]})
+    request = {'command': 'GET', 'args': ['benchmark:history']}
+    print(f"\nGET of a 200 message chat history from {url}, {number} requests each")
+    print(f"{'format':<10}{'compression':<13}{'wire bytes':>12}{'ms/request':>12}")
+    for content_type in (wire.JSON, wire.MSGPACK):
+        if content_type == wire.MSGPACK and wire.msgpack is None:
+            continue
+        body = wire.encode(request, content_type)
+        for encoding in ('identity', 'gzip'):
+            headers = {'Content-Type': content_type, 'Accept': content_type, 'Accept-Encoding': encoding}
+            response = session.post(f'{url}/command', data=body, headers=headers, stream=True)
+            wire_bytes = len(response.raw.read(decode_content=False))
+            start = time.perf_counter()
+            for _ in range(number):
+                response = session.post(f'{url}/command', data=body, headers=headers)
+                wire.decode(response.content, content_type)
+            elapsed = (time.perf_counter() - start) / number
+            label = 'json' if content_type == wire.JSON else 'msgpack'
+            print(f"{label:<10}{encoding:<13}{wire_bytes:>12}{elapsed * 1000:>12.2f}")
+    session.post(f'{url}/command', json={'command': 'DELETE', 'args': ['benchmark:history']})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the store wire formats.")
+    parser.add_argument('--number', type=int, default=200, help="iterations per measurement")
+    parser.add_argument('--url', help="base URL of a running server for live round trips")
+    args = parser.parse_args()
+    bench_codecs(args.number)
+    if args.url:
+        bench_live(args.url.rstrip('/'), args.number)
+
+
+if __name__ == '__main__':
+    main()
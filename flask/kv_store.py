@@ -0,0 +1,1221 @@
+import base64
+import bisect
+import heapq
+import json
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from fnmatch import fnmatchcase
+
+import paths
+
+EVICTION_POLICIES = ('noeviction', 'allkeys-lru', 'allkeys-lfu', 'volatile-lru', 'volatile-lfu')
+# What a push does to a list that already holds its maxlen entries, see DataStore.push
+OVERFLOW_POLICIES = ('drop_oldest', 'drop_newest', 'reject', 'block')
+# Methods that can be queued in a transaction, see DataStore.execute
+TRANSACTION_METHODS = {'get', 'get_many', 'get_path', 'set', 'set_path', 'cas', 'push', 'drain', 'delete', 'has',
+                       'expire', 'ttl', 'incrby', 'hset', 'hget', 'hgetall', 'hdel', 'sadd', 'srem', 'smembers'}
+
+
+class StoreError(Exception):
+    """
+    A command was refused by the store; reported to the client instead of a result.
+    """
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def _encode_default(value):
+    return list(value) if isinstance(value, (set, frozenset)) else str(value)
+
+
+def sizeof(value):
+    """
+    Approximate memory cost of a value, measured as the length of its JSON encoding.
+    """
+    return len(json.dumps(value, default=_encode_default, separators=(',', ':')))
+
+
+def field_size(field, value):
+    # cost of one '"field":value,' entry of a hash
+    return len(field) + sizeof(value) + 4
+
+
+def export(value):
+    """
+    The form in which a value leaves the store: hashes and sets are updated
+    in place, so they are copied under the key lock before being encoded
+    (sets as lists).
+    """
+    if isinstance(value, dict):
+        return dict(value)
+    if isinstance(value, set):
+        return list(value)
+    return value
+
+
+class LRUTracker:
+    """
+    Least recently used order kept in an OrderedDict: O(1) touch and victim.
+    """
+    def __init__(self):
+        self.keys = OrderedDict()
+
+    def add(self, key):
+        self.keys[key] = None
+        self.keys.move_to_end(key)
+
+    def touch(self, key):
+        if key in self.keys:
+            self.keys.move_to_end(key)
+
+    def remove(self, key):
+        self.keys.pop(key, None)
+
+    def victim(self):
+        return next(iter(self.keys), None)
+
+
+class LFUTracker:
+    """
+    Least frequently used order kept as frequency buckets of insertion-ordered
+    keys, O(1) per operation. Frequencies saturate at MAX_FREQ, which bounds
+    the number of buckets scanned when the minimum bucket is emptied by a delete.
+    """
+    MAX_FREQ = 255
+
+    def __init__(self):
+        self.freq = {}
+        self.buckets = {}
+        self.min_freq = 0
+
+    def _move(self, key, old, new):
+        if old is not None:
+            bucket = self.buckets[old]
+            del bucket[key]
+            if not bucket:
+                del self.buckets[old]
+        self.buckets.setdefault(new, OrderedDict())[key] = None
+        self.freq[key] = new
+
+    def add(self, key):
+        if key in self.freq:
+            self.touch(key)
+        else:
+            self._move(key, None, 1)
+            self.min_freq = 1
+
+    def touch(self, key):
+        freq = self.freq.get(key)
+        if freq is not None and freq < self.MAX_FREQ:
+            self._move(key, freq, freq + 1)
+            if self.min_freq == freq and freq not in self.buckets:
+                self.min_freq = freq + 1
+
+    def remove(self, key):
+        freq = self.freq.pop(key, None)
+        if freq is not None:
+            bucket = self.buckets[freq]
+            del bucket[key]
+            if not bucket:
+                del self.buckets[freq]
+
+    def victim(self):
+        if not self.freq:
+            return None
+        if self.min_freq not in self.buckets:
+            self.min_freq = min(self.buckets)
+        return next(iter(self.buckets[self.min_freq]))
+
+
+class DataStore:
+    """
+    Thread-safe key/value store used by the Flask app.
+
+    Keys are guarded by a fixed set of striped locks, so commands on unrelated
+    keys don't contend. Keys can carry a TTL; expired keys are removed lazily
+    when accessed and by an incremental reaper that only pops the keys whose
+    deadline has passed, at most a batch at a time.
+
+    Every entry of a list value (a scalar counts as a single entry) has an id,
+    offsets[key] + 1 + index, so readers can fetch only the entries after the
+    last id they saw with read_since(). When a key is removed or replaced its
+    ids are retired: the next value of any key starts above id_floor, so ids
+    never go backwards for a key even across deletes.
+
+    Every write bumps the store revision, and a key's version is the revision
+    of its last write, so a client that knows a version can be told the key
+    is unchanged (get_versioned). The revision starts from the clock in
+    microseconds rather than 0, so versions handed out before a restart are
+    never reused for different values afterwards.
+
+    With maxmemory set, the approximate size of each key is accounted on write
+    and keys are evicted according to eviction_policy to make room for new
+    writes. Under 'noeviction' (or a volatile-* policy with no volatile keys
+    left) writes that don't fit are refused with a StoreError.
+
+    Lists used as queues can be bounded, so a stalled consumer can't make
+    them grow without limit: queue_maxlen and queue_overflow are the default
+    bound and overflow policy (0 for unbounded), set_queue_limit() overrides
+    them per key.
+    """
+    def __init__(self, stripes=16, maxmemory=0, eviction_policy='noeviction',
+                 queue_maxlen=0, queue_overflow='drop_oldest'):
+        if eviction_policy not in EVICTION_POLICIES:
+            raise ValueError(f"Unknown eviction policy '{eviction_policy}', expected one of {EVICTION_POLICIES}")
+        if queue_overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy '{queue_overflow}', expected one of {OVERFLOW_POLICIES}")
+        self.data = {}
+        self.stripes = [threading.RLock() for _ in range(stripes)]
+        # memory accounting and eviction order, guarded by accounting_lock
+        self.maxmemory = maxmemory
+        self.eviction_policy = eviction_policy
+        self.volatile_only = eviction_policy.startswith('volatile-')
+        self.tracker = None
+        if eviction_policy.endswith('-lru'):
+            self.tracker = LRUTracker()
+        elif eviction_policy.endswith('-lfu'):
+            self.tracker = LFUTracker()
+        self.sizes = {}
+        # every key in sorted order, for SCAN
+        self.key_index = []
+        # global revision, bumped by every write; key -> revision of its last write
+        self.revision = time.time_ns() // 1000
+        self.versions = {}
+        # key -> entry id offset (see read_since), highest id ever retired
+        self.offsets = {}
+        self.id_floor = 0
+        self.used_memory = 0
+        self.evicted_keys = 0
+        self.expired_keys = 0
+        self.accounting_lock = threading.Lock()
+        # queue bounds: key -> (maxlen, overflow), and key -> [dropped, rejected]
+        # since the list was created, plus their totals since startup (guarded
+        # by accounting_lock)
+        self.queue_maxlen = queue_maxlen
+        self.queue_overflow = queue_overflow
+        self.queue_limits = {}
+        self.queue_drops = {}
+        self.dropped_entries = 0
+        self.rejected_pushes = 0
+        # called with every mutation as a replayable record, see replay()
+        self.journal = None
+        # key -> absolute expiry time (time.time()); heap may hold stale entries
+        self.expires = {}
+        self.expiry_heap = []
+        self.expiry_lock = threading.Lock()
+        # key -> set of threading.Event of long-poll waiters on that key
+        self.waiters = {}
+        self.waiters_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.reaper_thread = None
+
+    # -- locking ---------------------------------------------------------
+
+    def _stripe_index(self, key):
+        return hash(key) % len(self.stripes)
+
+    @contextmanager
+    def locked(self, keys):
+        """
+        Holds the stripe locks of all the given keys, acquired in a fixed order.
+        """
+        indexes = sorted({self._stripe_index(key) for key in keys})
+        for index in indexes:
+            self.stripes[index].acquire()
+        try:
+            yield
+        finally:
+            for index in reversed(indexes):
+                self.stripes[index].release()
+
+    @contextmanager
+    def locked_all(self):
+        for stripe in self.stripes:
+            stripe.acquire()
+        try:
+            yield
+        finally:
+            for stripe in reversed(self.stripes):
+                stripe.release()
+
+    # -- internals (caller holds the key stripe) ---------------------------
+
+    def _is_expired(self, key, now=None):
+        deadline = self.expires.get(key)
+        return deadline is not None and deadline <= (time.time() if now is None else now)
+
+    def _get(self, key):
+        if self._is_expired(key):
+            self._remove(key)
+            self.expired_keys += 1
+            return None
+        if self.tracker is not None and key in self.data:
+            with self.accounting_lock:
+                self.tracker.touch(key)
+        return self.data.get(key, None)
+
+    def _create(self, key, value):
+        """
+        Stores a new value at key, with fresh entry ids.
+        """
+        self._retire(key)
+        self.data[key] = value
+        self.offsets[key] = self.id_floor
+        return value
+
+    def _typed(self, key, kind, create=False):
+        """
+        The value at key, which must be a kind (dict or set). A missing key
+        is None, or a new empty value with create.
+        """
+        current = self._get(key)
+        if current is None:
+            return self._create(key, kind()) if create else None
+        if not isinstance(current, kind):
+            raise StoreError(f"WRONGTYPE {key} does not hold a {'hash' if kind is dict else 'set'}")
+        return current
+
+    def _version(self, key):
+        # 0 for a missing key; versions never repeat, so a recreated key can't pass for the old one
+        self._get(key)
+        return self.versions.get(key, 0) if key in self.data else 0
+
+    def _exists(self, key):
+        self._get(key)
+        return key in self.data
+
+    def _journal(self, *record):
+        if self.journal is not None:
+            self.journal(record)
+
+    @staticmethod
+    def _count(value):
+        return len(value) if isinstance(value, list) else 1
+
+    def _retire(self, key):
+        """
+        Retires the entry ids of the current value of key.
+        """
+        offset = self.offsets.pop(key, None)
+        if offset is not None:
+            with self.accounting_lock:
+                self.id_floor = max(self.id_floor, offset + self._count(self.data.get(key)))
+
+    def _remove(self, key):
+        if key not in self.data:
+            return None
+        self._journal('DEL', key)
+        self._retire(key)
+        if key in self.expires:
+            with self.expiry_lock:
+                self.expires.pop(key, None)
+        with self.accounting_lock:
+            self.revision += 1
+            self.versions.pop(key, None)
+            self.used_memory -= self.sizes.pop(key, 0)
+            self.queue_drops.pop(key, None)
+            index = bisect.bisect_left(self.key_index, key)
+            if index < len(self.key_index) and self.key_index[index] == key:
+                del self.key_index[index]
+            if self.tracker is not None:
+                self.tracker.remove(key)
+        return self.data.pop(key, None)
+
+    def _account(self, key, size):
+        """
+        Records the new size of key, bumps its version and marks it as used
+        for eviction.
+        """
+        with self.accounting_lock:
+            self.revision += 1
+            self.versions[key] = self.revision
+            if key not in self.sizes:
+                bisect.insort(self.key_index, key)
+            self.used_memory += size - self.sizes.get(key, 0)
+            self.sizes[key] = size
+            if self.tracker is not None and (not self.volatile_only or key in self.expires):
+                self.tracker.add(key)
+
+    def _set_expiry(self, key, ttl):
+        """
+        Sets the TTL of key in seconds (None clears it). Returns the absolute deadline.
+        """
+        return self._set_deadline(key, None if ttl is None else time.time() + float(ttl))
+
+    def _set_deadline(self, key, deadline):
+        with self.expiry_lock:
+            if deadline is None:
+                self.expires.pop(key, None)
+            else:
+                self.expires[key] = deadline
+                heapq.heappush(self.expiry_heap, (deadline, key))
+        if self.volatile_only:
+            # volatile-* policies only ever evict keys that carry a TTL
+            with self.accounting_lock:
+                if deadline is None:
+                    self.tracker.remove(key)
+                elif key in self.sizes:
+                    self.tracker.add(key)
+        return deadline
+
+    def _append(self, key, current, value, item_size):
+        """
+        Appends value to the list at key, wrapping a scalar value or creating
+        the list as needed. Returns the new length.
+        """
+        if current is None:
+            current = self._create(key, [])
+        elif not isinstance(current, list):
+            current = self.data[key] = [current]
+        current.append(value)
+        size = self.sizes.get(key)
+        self._account(key, len(key) + sizeof(current) if size is None else size + item_size)
+        return len(current)
+
+    def _trim(self, key, current, maxlen):
+        """
+        Drops the oldest entries of the list at key beyond maxlen. The ids
+        of the remaining entries don't change.
+        """
+        excess = len(current) - maxlen
+        if excess <= 0:
+            return 0
+        freed = sum(sizeof(item) + 1 for item in current[:excess])
+        del current[:excess]
+        self.offsets[key] += excess
+        self._account(key, self.sizes[key] - freed)
+        return excess
+
+    def _consume(self, key, last_id):
+        """
+        Drops the entries of the list at key up to id last_id, which a reader
+        has already handled, and the key itself once none are left. Returns
+        True if anything was dropped.
+        """
+        current = self._get(key)
+        if current is None or not last_id:
+            return False
+        consumed = last_id - self.offsets.get(key, 0)
+        if consumed <= 0:
+            return False
+        if consumed >= self._count(current):
+            self._remove(key)
+        else:
+            self._trim(key, current, len(current) - consumed)
+            self._journal('TRIM', key, self.offsets[key])
+        return True
+
+    def _count_overflow(self, key, dropped=0, rejected=0):
+        with self.accounting_lock:
+            drops = self.queue_drops.setdefault(key, [0, 0])
+            drops[0] += dropped
+            drops[1] += rejected
+            self.dropped_entries += dropped
+            self.rejected_pushes += rejected
+
+    @staticmethod
+    def _check_key(key):
+        # keys are sized, and kept in key_index, as str
+        if not isinstance(key, str):
+            raise StoreError(f"Keys must be strings, not {type(key).__name__}")
+
+    @staticmethod
+    def _parse_path(path):
+        try:
+            return paths.parse(path)
+        except paths.PathError as e:
+            raise StoreError(str(e))
+
+    def _make_room(self, key, size):
+        """
+        Evicts keys until a write of size bytes to key fits within maxmemory.
+        Runs without holding any stripe lock, so it can lock the victims.
+        """
+        if not self.maxmemory:
+            return
+        if size > self.maxmemory:
+            raise StoreError(f"OOM value of {size} bytes exceeds maxmemory ({self.maxmemory})", 507)
+        while self.used_memory - self.sizes.get(key, 0) + size > self.maxmemory:
+            with self.accounting_lock:
+                victim = self.tracker.victim() if self.tracker is not None else None
+            if victim is None:
+                raise StoreError(f"OOM command not allowed when used memory > maxmemory "
+                                 f"(policy {self.eviction_policy})", 507)
+            with self.locked([victim]):
+                if victim in self.data:
+                    self._remove(victim)
+                    self.evicted_keys += 1
+                else:
+                    with self.accounting_lock:
+                        self.tracker.remove(victim)
+
+    def _wake(self, key):
+        with self.waiters_lock:
+            events = self.waiters.get(key)
+            if events:
+                for event in events:
+                    event.set()
+
+    # -- commands ----------------------------------------------------------
+
+    def get(self, key):
+        with self.locked([key]):
+            return export(self._get(key))
+
+    def get_many(self, keys):
+        """
+        Returns a dict of the keys that hold a value, or None if none does.
+        """
+        result = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                result[key] = value
+        return result or None
+
+    def get_path(self, keys, path):
+        """
+        Projection GET: returns {key: part} with the part of each value the
+        path expression addresses (see paths.py), for the keys where it
+        exists, or None. Only that part leaves the store.
+        """
+        steps = self._parse_path(path)
+        result = {}
+        for key in keys:
+            with self.locked([key]):
+                value = self._get(key)
+                part = paths.resolve(export(value), steps) if value is not None else paths.MISSING
+                if part is not paths.MISSING:
+                    result[key] = part
+        return result or None
+
+    def get_versioned(self, keys, versions=None, revision=None):
+        """
+        Conditional multi-key GET. versions maps keys to the version the
+        caller holds (0 for a key it knows is missing). Returns
+        {"revision", "values": {key: [version, value]}, "not_modified": [keys]}
+        where values only holds the keys that changed; keys in neither are
+        missing. If revision is the current store revision nothing can have
+        changed and the answer is just {"revision", "not_modified": true}.
+        """
+        versions = versions or {}
+        # read before the values, so the revision never claims more than was seen
+        current = self.revision
+        if revision is not None and revision == current:
+            return {'revision': current, 'not_modified': True}
+        values, not_modified = {}, []
+        for key in keys:
+            with self.locked([key]):
+                value = export(self._get(key))
+                version = self._version(key)
+            if version == versions.get(key):
+                not_modified.append(key)
+            elif version:
+                values[key] = [version, value]
+        return {'revision': current, 'values': values, 'not_modified': not_modified}
+
+    def changed_since(self, revision):
+        """
+        Returns the current revision, or None if it is still revision.
+        """
+        current = self.revision
+        return None if current == revision else current
+
+    def set(self, key, value, ttl=None):
+        """
+        Sets key to value. As in Redis, a SET without ttl clears any previous TTL.
+        """
+        self._check_key(key)
+        size = len(key) + sizeof(value)
+        self._make_room(key, size)
+        with self.locked([key]):
+            self._set(key, value, ttl, size)
+        self._wake(key)
+        return True
+
+    def _set(self, key, value, ttl, size):
+        # caller holds the key stripe
+        self._create(key, value)
+        deadline = self._set_expiry(key, ttl)
+        self._account(key, size)
+        self._journal('SET', key, value, deadline, self.offsets[key])
+
+    def cas(self, key, version, value, ttl=None):
+        """
+        Compare-and-set: sets key to value only if it still has the version
+        the caller read (0 for a key that must not exist). Returns the new
+        version, or None if the key was changed in the meantime.
+        """
+        self._check_key(key)
+        size = len(key) + sizeof(value)
+        self._make_room(key, size)
+        with self.locked([key]):
+            if self._version(key) != version:
+                return None
+            self._set(key, value, ttl, size)
+            version = self.versions[key]
+        self._wake(key)
+        return version
+
+    def execute(self, watched, calls):
+        """
+        Optimistic transaction (WATCH/MULTI/EXEC): makes calls, a list of
+        [method, args, kwargs] of TRANSACTION_METHODS, atomically, provided
+        every watched key still has the version the caller read ({key:
+        version}, 0 for missing). Returns None if one changed, else
+        {"results", "errors"} as for a pipeline: a refused call yields None
+        and its error keyed by index, and doesn't stop the others.
+        """
+        keys = set(watched)
+        for method, args, kwargs in calls:
+            if method not in TRANSACTION_METHODS:
+                raise StoreError(f"'{method}' can't be used in a transaction")
+            keys.update(args[0] if isinstance(args[0], list) else [args[0]])
+        # eviction locks its victims, which may be any key
+        with self.locked_all() if self.maxmemory else self.locked(keys):
+            if any(self._version(key) != version for key, version in watched.items()):
+                return None
+            results, errors = [], {}
+            for index, (method, args, kwargs) in enumerate(calls):
+                if method == 'push':
+                    # a push that blocked here would hold the locks its consumer needs
+                    kwargs = dict(kwargs, timeout=0)
+                try:
+                    results.append(getattr(self, method)(*args, **kwargs))
+                except StoreError as e:
+                    results.append(None)
+                    errors[index] = str(e)
+        return {'results': results, 'errors': errors}
+
+    def push(self, key, value, ttl=None, maxlen=None, overflow=None, timeout=0):
+        """
+        Appends value to the list stored at key, creating it if needed.
+        A ttl refreshes the expiry of the list. Returns the new length.
+
+        The list is bounded by maxlen, else by the limit set for the key
+        with set_queue_limit(), else by the store default. When it is full,
+        overflow decides: drop_oldest trims the oldest entries, drop_newest
+        discards value, reject raises a StoreError (429) and block waits up
+        to timeout seconds for a consumer to make room before rejecting.
+        Dropped and rejected entries are counted, see queue_info().
+        """
+        self._check_key(key)
+        maxlen, overflow = self._queue_limit(key, maxlen, overflow)
+        length = self._push(key, value, ttl, maxlen, overflow)
+        if length is None and overflow == 'block' and timeout:
+            length = self._wait_for([key], timeout, lambda: self._push(key, value, ttl, maxlen, overflow))
+        if length is None:
+            self._count_overflow(key, rejected=1)
+            raise StoreError(f"Queue '{key}' is full ({maxlen} entries)", 429)
+        return length
+
+    def _queue_limit(self, key, maxlen, overflow):
+        if maxlen is None:
+            maxlen, default = self.queue_limits.get(key, (self.queue_maxlen, self.queue_overflow))
+            overflow = overflow or default
+        overflow = overflow or 'drop_oldest'
+        if overflow not in OVERFLOW_POLICIES:
+            raise StoreError(f"Unknown overflow policy '{overflow}', expected one of {OVERFLOW_POLICIES}")
+        return maxlen, overflow
+
+    def _push(self, key, value, ttl, maxlen, overflow):
+        # returns the new length, or None if the list is full and overflow is reject / block
+        item_size = sizeof(value) + 1
+        self._make_room(key, self.sizes.get(key, len(key) + 2) + item_size)
+        with self.locked([key]):
+            current = self._get(key)
+            if maxlen and overflow != 'drop_oldest' and current is not None and self._count(current) >= maxlen:
+                if overflow != 'drop_newest':
+                    return None
+                self._count_overflow(key, dropped=1)
+                return self._count(current)
+            length = self._append(key, current, value, item_size)
+            if maxlen and length > maxlen:
+                self._count_overflow(key, dropped=self._trim(key, self.data[key], maxlen))
+                length = maxlen
+            # offset + length is the id of the new entry, which makes the record idempotent on replay
+            self._journal('PUSH', key, value, length, self.offsets[key])
+            if ttl is not None:
+                self._journal('EXPIREAT', key, self._set_expiry(key, ttl))
+        self._wake(key)
+        return length
+
+    def set_queue_limit(self, key, maxlen, overflow='drop_oldest'):
+        """
+        Bounds the list at key to maxlen entries with the given overflow
+        policy (see push), whether or not it exists yet; maxlen 0 makes it
+        unbounded, None restores the store default.
+        """
+        if overflow not in OVERFLOW_POLICIES:
+            raise StoreError(f"Unknown overflow policy '{overflow}', expected one of {OVERFLOW_POLICIES}")
+        with self.locked([key]):
+            self._set_queue_limit(key, maxlen, overflow)
+            self._journal('QLIMIT', key, maxlen, overflow)
+        return True
+
+    def _set_queue_limit(self, key, maxlen, overflow):
+        if maxlen is None:
+            self.queue_limits.pop(key, None)
+        else:
+            self.queue_limits[key] = (maxlen, overflow)
+
+    def queue_info(self, keys):
+        """
+        Returns {key: {"length", "maxlen", "overflow", "dropped", "rejected"}}
+        for each key: its current number of entries, its bound and the
+        entries dropped and pushes rejected because it was full since the
+        list was created (a drained list starts over).
+        """
+        result = {}
+        for key in keys:
+            with self.locked([key]):
+                current = self._get(key)
+                maxlen, overflow = self.queue_limits.get(key, (self.queue_maxlen, self.queue_overflow))
+                dropped, rejected = self.queue_drops.get(key, (0, 0))
+                result[key] = {'length': 0 if current is None else self._count(current),
+                               'maxlen': maxlen, 'overflow': overflow,
+                               'dropped': dropped, 'rejected': rejected}
+        return result
+
+    def max_queue_depth(self):
+        """
+        Length of the longest list among the keys with a queue limit or drops.
+        """
+        depth = 0
+        for key in set(self.queue_limits) | set(self.queue_drops):
+            with self.locked([key]):
+                current = self._get(key)
+                if current is not None:
+                    depth = max(depth, self._count(current))
+        return depth
+
+    def set_path(self, key, path, value, append=False):
+        """
+        Sets the part of the value at key that path addresses (see paths.py)
+        to value, or with append adds value to the list there, creating the
+        key and missing dict fields as needed. Appending is done in place, in
+        O(1) however long the list. The TTL is kept. The accounted size is
+        adjusted by the size of the part replaced, not recomputed.
+        Returns the length of the list appended to, or True.
+        """
+        self._check_key(key)
+        steps = self._parse_path(path)
+        if not steps:
+            return self.push(key, value) if append else self.set(key, value)
+        self._make_room(key, self.sizes.get(key, len(key) + 2) + len(path) + sizeof(value) + 4)
+        with self.locked([key]):
+            current = self._get(key)
+            try:
+                if append:
+                    new, length = paths.append(paths.MISSING if current is None else current, steps, value)
+                    replaced = paths.MISSING
+                else:
+                    new, replaced = paths.assign(paths.MISSING if current is None else current, steps, value)
+                    length = None
+            except paths.PathError as e:
+                raise StoreError(str(e))
+            if current is None:
+                self._create(key, new)
+                size = len(key) + sizeof(new)
+            else:
+                self.data[key] = new
+                size = self.sizes.get(key, 0) + sizeof(value) + 1
+                if replaced is not paths.MISSING:
+                    size -= sizeof(replaced) + 1
+                elif not append:
+                    size += len(str(steps[-1][1])) + 3
+            self._account(key, size)
+            self._journal('SETPATH', key, path, value, append, length)
+        self._wake(key)
+        return length if append else True
+
+    def drain(self, keys):
+        """
+        Atomically reads and deletes the given keys. Same result shape as get_many.
+        """
+        result = {}
+        with self.locked(keys):
+            for key in keys:
+                value = self._get(key)
+                if value is not None:
+                    result[key] = export(value)
+                    self._remove(key)
+        # producers blocked on a full queue
+        for key in result or ():
+            self._wake(key)
+        return result or None
+
+    def delete(self, key):
+        with self.locked([key]):
+            deleted = self._remove(key) is not None
+        self._wake(key)
+        return deleted
+
+    def incrby(self, key, amount=1):
+        """
+        Adds amount to the integer at key (0 if missing), keeping its TTL.
+        Returns the new value.
+        """
+        self._check_key(key)
+        self._make_room(key, len(key) + 20)
+        with self.locked([key]):
+            current = self._get(key)
+            if current is None:
+                current = 0
+            elif not isinstance(current, int) or isinstance(current, bool):
+                raise StoreError(f"WRONGTYPE {key} does not hold an integer")
+            value = current + int(amount)
+            self._create(key, value)
+            self._account(key, len(key) + sizeof(value))
+            self._journal('SET', key, value, self.expires.get(key), self.offsets[key])
+        self._wake(key)
+        return value
+
+    def hset(self, key, mapping):
+        """
+        Sets fields of the hash at key, creating it if needed, in O(fields
+        written). Returns the number of new fields.
+        """
+        self._check_key(key)
+        self._make_room(key, self.sizes.get(key, len(key) + 2) +
+                        sum(field_size(field, value) for field, value in mapping.items()))
+        with self.locked([key]):
+            current = self._typed(key, dict, create=True)
+            size = self.sizes.get(key, len(key) + 2)
+            added = 0
+            for field, value in mapping.items():
+                if field in current:
+                    size -= field_size(field, current[field])
+                else:
+                    added += 1
+                current[field] = value
+                size += field_size(field, value)
+            self._account(key, size)
+            self._journal('HSET', key, mapping)
+        self._wake(key)
+        return added
+
+    def hget(self, key, field):
+        with self.locked([key]):
+            current = self._typed(key, dict)
+            return None if current is None else current.get(field)
+
+    def hgetall(self, key):
+        with self.locked([key]):
+            return export(self._typed(key, dict))
+
+    def hdel(self, key, fields):
+        """
+        Removes fields from the hash at key, and the key once it is empty.
+        Returns the number of fields removed.
+        """
+        with self.locked([key]):
+            removed = self._remove_members(key, dict, fields)
+        self._wake(key)
+        return removed
+
+    def sadd(self, key, members):
+        """
+        Adds members to the set at key, creating it if needed. Returns the
+        number of members that were not in the set.
+        """
+        self._check_key(key)
+        try:
+            members = list(dict.fromkeys(members))
+        except TypeError:
+            raise StoreError("Set members must be strings, numbers or booleans")
+        self._make_room(key, self.sizes.get(key, len(key) + 2) +
+                        sum(sizeof(member) + 1 for member in members))
+        with self.locked([key]):
+            current = self._typed(key, set, create=True)
+            size = self.sizes.get(key, len(key) + 2)
+            added = 0
+            for member in members:
+                if member not in current:
+                    current.add(member)
+                    size += sizeof(member) + 1
+                    added += 1
+            self._account(key, size)
+            self._journal('SADD', key, members)
+        self._wake(key)
+        return added
+
+    def srem(self, key, members):
+        with self.locked([key]):
+            removed = self._remove_members(key, set, members)
+        self._wake(key)
+        return removed
+
+    def smembers(self, key):
+        with self.locked([key]):
+            return export(self._typed(key, set)) or []
+
+    def _remove_members(self, key, kind, members):
+        # caller holds the key stripe; HDEL / SREM
+        current = self._typed(key, kind)
+        if current is None:
+            return 0
+        size = self.sizes.get(key, 0)
+        removed = 0
+        for member in members:
+            if member in current:
+                if kind is dict:
+                    size -= field_size(member, current.pop(member))
+                else:
+                    current.discard(member)
+                    size -= sizeof(member) + 1
+                removed += 1
+        if removed:
+            self._journal('HDEL' if kind is dict else 'SREM', key, members)
+            if current:
+                self._account(key, size)
+            else:
+                self._remove(key)
+        return removed
+
+    def has(self, key):
+        with self.locked([key]):
+            return self._exists(key)
+
+    def expire(self, key, ttl):
+        """
+        Sets the TTL of an existing key in seconds, None removes it.
+        Returns False if the key does not exist.
+        """
+        with self.locked([key]):
+            if not self._exists(key):
+                return False
+            self._journal('EXPIREAT', key, self._set_expiry(key, ttl))
+            return True
+
+    def ttl(self, key):
+        """
+        Remaining time to live in seconds, -1 if the key has no TTL, -2 if it does not exist.
+        """
+        with self.locked([key]):
+            if not self._exists(key):
+                return -2
+            deadline = self.expires.get(key)
+            return -1 if deadline is None else max(deadline - time.time(), 0)
+
+    def keys(self):
+        now = time.time()
+        return [key for key in list(self.data.keys()) if not self._is_expired(key, now)]
+
+    def items(self):
+        now = time.time()
+        return [(key, export(value)) for key, value in list(self.data.items()) if not self._is_expired(key, now)]
+
+    def scan(self, cursor=None, match=None, prefix=None, count=100, values=False):
+        """
+        Incremental iteration over the keyspace in key order, backed by the
+        sorted key index. Returns [next_cursor, keys], or [next_cursor,
+        [[key, value], ...]] with values=True; next_cursor is None once the
+        iteration is complete. The cursor is the last key examined, so keys
+        present for the whole iteration are returned exactly once even while
+        other keys are added or removed.
+
+        prefix restricts the range of the index that is walked; match is a
+        glob pattern (its literal prefix is used as prefix if none is given).
+        At most count keys are returned and at most 10 * count examined.
+        """
+        count = max(1, min(int(count), 1000))
+        if prefix is None:
+            prefix = ''
+            if match:
+                for char in match:
+                    if char in '*?[\\':
+                        break
+                    prefix += char
+        after = base64.urlsafe_b64decode(cursor.encode()).decode() if cursor else None
+        limit = count * 10
+        with self.accounting_lock:
+            if after is not None and after >= prefix:
+                start = bisect.bisect_right(self.key_index, after)
+            else:
+                start = bisect.bisect_left(self.key_index, prefix)
+            candidates = self.key_index[start:start + limit]
+
+        keys = []
+        last = None
+        done = len(candidates) < limit
+        now = time.time()
+        for position, key in enumerate(candidates):
+            if not key.startswith(prefix):
+                done = True
+                break
+            last = key
+            if self._is_expired(key, now) or (match and not fnmatchcase(key, match)):
+                continue
+            keys.append(key)
+            if len(keys) >= count:
+                done = done and position == len(candidates) - 1
+                break
+        next_cursor = None if done or last is None else base64.urlsafe_b64encode(last.encode()).decode()
+
+        if values:
+            pairs = []
+            for key in keys:
+                with self.locked([key]):
+                    if key in self.data:
+                        pairs.append([key, export(self.data[key])])
+            return [next_cursor, pairs]
+        return [next_cursor, keys]
+
+    def clear(self):
+        with self.locked_all():
+            self._journal('CLEAR')
+            for key in list(self.offsets):
+                self._retire(key)
+            self.data.clear()
+            with self.expiry_lock:
+                self.expires.clear()
+                self.expiry_heap.clear()
+            with self.accounting_lock:
+                self.revision += 1
+                self.versions.clear()
+                self.sizes.clear()
+                self.key_index.clear()
+                self.queue_drops.clear()
+                self.used_memory = 0
+                if self.tracker is not None:
+                    self.tracker = type(self.tracker)()
+
+    def replay(self, record):
+        """
+        Applies a journal record produced by a mutation, without expiry checks,
+        eviction or journaling. Records are idempotent when replayed in order
+        over a state that already contains some of them: PUSH carries the
+        id of the entry it added (offset + length) and is skipped if the list
+        already reaches it; HSET/HDEL/SADD/SREM are idempotent as they are.
+        An appending SETPATH carries the resulting length of its list likewise.
+        """
+        op, *args = record
+        if op == 'SET':
+            key, value, deadline, *offset = args
+            with self.locked([key]):
+                self._retire(key)
+                self.data[key] = value
+                self.offsets[key] = offset[0] if offset and offset[0] is not None else self.id_floor
+                self._set_deadline(key, deadline)
+                self._account(key, len(key) + sizeof(value))
+        elif op == 'PUSH':
+            key, value, length, *offset = args
+            offset = offset[0] if offset else None
+            with self.locked([key]):
+                current = self.data.get(key)
+                count = 0 if current is None else self._count(current)
+                if offset is not None and key in self.offsets:
+                    behind = self.offsets[key] + count < offset + length
+                else:
+                    behind = count < length
+                if behind:
+                    self._append(key, current, value, sizeof(value) + 1)
+                    if offset is not None:
+                        self._trim(key, self.data[key], length)
+                        self.offsets[key] = offset
+        elif op in ('HSET', 'SADD'):
+            key, members = args
+            kind = dict if op == 'HSET' else set
+            with self.locked([key]):
+                current = self.data.get(key)
+                if not isinstance(current, kind):
+                    # replaced by a later record of the log
+                    current = self._create(key, kind())
+                current.update(members)
+                self._account(key, len(key) + sizeof(current))
+        elif op in ('HDEL', 'SREM'):
+            key, members = args
+            with self.locked([key]):
+                current = self.data.get(key)
+                if isinstance(current, (dict, set)):
+                    for member in members:
+                        if isinstance(current, dict):
+                            current.pop(member, None)
+                        else:
+                            current.discard(member)
+                    if current:
+                        self._account(key, len(key) + sizeof(current))
+                    else:
+                        self._remove(key)
+        elif op == 'EXPIREAT':
+            key, deadline = args
+            with self.locked([key]):
+                if key in self.data:
+                    self._set_deadline(key, deadline)
+        elif op == 'SETPATH':
+            key, path, value, append, length = args
+            steps = paths.parse(path)
+            with self.locked([key]):
+                current = self.data.get(key, paths.MISSING)
+                if append:
+                    target = paths.resolve(current, steps)
+                    if isinstance(target, list) and len(target) >= length:
+                        return
+                if append:
+                    new, _ = paths.append(current, steps, value)
+                else:
+                    new, _ = paths.assign(current, steps, value)
+                if current is paths.MISSING:
+                    self._create(key, new)
+                else:
+                    self.data[key] = new
+                self._account(key, len(key) + sizeof(new))
+        elif op == 'TRIM':
+            key, offset = args
+            with self.locked([key]):
+                current = self.data.get(key)
+                if isinstance(current, list) and key in self.offsets and offset > self.offsets[key]:
+                    self._trim(key, current, len(current) - (offset - self.offsets[key]))
+        elif op == 'QLIMIT':
+            key, maxlen, overflow = args
+            self._set_queue_limit(key, maxlen, overflow)
+        elif op == 'DEL':
+            with self.locked([args[0]]):
+                self._remove(args[0])
+        elif op == 'CLEAR':
+            self.clear()
+
+    def dump(self):
+        """
+        Yields (key, value, deadline, offset) for every key, each read under
+        its own stripe lock, so the store keeps serving while a snapshot is
+        written. value is pickled under the lock since lists keep growing in
+        place.
+        """
+        for key in list(self.data.keys()):
+            with self.locked([key]):
+                if key in self.data:
+                    yield (key, pickle.dumps(self.data[key], pickle.HIGHEST_PROTOCOL),
+                           self.expires.get(key), self.offsets.get(key))
+
+    def __len__(self):
+        return len(self.data)
+
+    def size_bytes(self):
+        """
+        Approximate size of the store in bytes (keys plus JSON-encoded values),
+        maintained incrementally on every write.
+        """
+        return self.used_memory
+
+    def read_since(self, after, count=None, timeout=0, trim=False):
+        """
+        Delta read: after maps keys to the last entry id the caller has seen
+        (0 or None for none). Returns {key: [[id, value], ...]} with up to
+        count entries after that id for each key that has any, or None, in
+        O(new entries). With a timeout, blocks like wait() until there are.
+
+        Entries are left in place for other readers. With trim the caller is
+        the only consumer: the entries up to the ids in after are dropped
+        first, so the lists don't grow without limit.
+        """
+        if trim:
+            trimmed = []
+            for key, after_id in after.items():
+                with self.locked([key]):
+                    if self._consume(key, after_id):
+                        trimmed.append(key)
+            # producers blocked on a full queue
+            for key in trimmed:
+                self._wake(key)
+
+        def fetch():
+            result = {}
+            for key, after_id in after.items():
+                with self.locked([key]):
+                    value = self._get(key)
+                    if key not in self.data:
+                        continue
+                    offset = self.offsets.get(key, 0)
+                    entries = value if isinstance(value, list) else [export(value)]
+                    start = max((after_id or 0) - offset, 0)
+                    end = len(entries) if count is None else start + count
+                    if start < len(entries):
+                        result[key] = [[offset + 1 + index, entries[index]]
+                                       for index in range(start, min(end, len(entries)))]
+            return result or None
+
+        if timeout:
+            return self._wait_for(list(after), timeout, fetch)
+        return fetch()
+
+    def wait(self, keys, timeout, drain=False):
+        """
+        Blocks until at least one of the keys holds a value or the timeout
+        expires. With drain=True the returned keys are removed atomically.
+        """
+        return self._wait_for(keys, timeout, lambda: self.drain(keys) if drain else self.get_many(keys))
+
+    def _wait_for(self, keys, timeout, fetch):
+        """
+        Returns the first non-None result of fetch(), calling it again after
+        every write to one of the keys, or None once the timeout expires.
+        Waiters are registered per key and only woken by writes to those keys.
+        """
+        event = threading.Event()
+        with self.waiters_lock:
+            for key in keys:
+                self.waiters.setdefault(key, set()).add(event)
+        try:
+            deadline = time.monotonic() + timeout
+            while True:
+                event.clear()
+                result = fetch()
+                remaining = deadline - time.monotonic()
+                if result is not None or remaining <= 0:
+                    return result
+                event.wait(remaining)
+        finally:
+            with self.waiters_lock:
+                for key in keys:
+                    events = self.waiters.get(key)
+                    if events is not None:
+                        events.discard(event)
+                        if not events:
+                            del self.waiters[key]
+
+    # -- expiry reaper -----------------------------------------------------
+
+    def reap(self, max_keys=100):
+        """
+        Removes up to max_keys expired keys, earliest deadline first.
+        Returns the number of keys removed.
+        """
+        now = time.time()
+        removed = 0
+        for _ in range(max_keys):
+            with self.expiry_lock:
+                if not self.expiry_heap or self.expiry_heap[0][0] > now:
+                    break
+                deadline, key = heapq.heappop(self.expiry_heap)
+            with self.locked([key]):
+                # skip stale heap entries whose TTL was changed or removed
+                if self.expires.get(key) == deadline:
+                    self._remove(key)
+                    removed += 1
+        self.expired_keys += removed
+        with self.expiry_lock:
+            # drop stale entries once they dominate the heap
+            if len(self.expiry_heap) > 2 * len(self.expires) + 1024:
+                self.expiry_heap = [(deadline, key) for key, deadline in self.expires.items()]
+                heapq.heapify(self.expiry_heap)
+        return removed
+
+    def start_reaper(self, interval=0.1, batch=100):
+        def run():
+            while not self.stop_event.is_set():
+                # keep going without sleeping while there is a backlog
+                if self.reap(batch) < batch:
+                    self.stop_event.wait(interval)
+
+        if self.reaper_thread is None:
+            self.reaper_thread = threading.Thread(target=run, daemon=True)
+            self.reaper_thread.start()
+
+    def stop(self):
+        self.stop_event.set()
@@ -0,0 +1,127 @@
+import bisect
+import threading
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+def format_labels(label_name, label_value, extra=None):
+    labels = []
+    if label_name is not None:
+        labels.append(f'{label_name}="{escape_label(label_value)}"')
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help_text, label_name=None):
+        self.name = name
+        self.help_text = help_text
+        self.label_name = label_name
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, label_value=None, amount=1):
+        with self.lock:
+            self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for label_value, value in sorted(self.values.items(), key=lambda item: str(item[0])):
+                lines.append(f"{self.name}{format_labels(self.label_name, label_value)} {format_value(value)}")
+        return lines
+
+
+class StatsCollector:
+    """
+    Gauges read from a single dict of statistics, fetched by callback once
+    per scrape rather than once per gauge. metric_type='counter' exposes a
+    monotonic value kept elsewhere as a counter.
+    """
+    def __init__(self, callback):
+        self.callback = callback
+        self.gauges = []
+
+    def gauge(self, name, help_text, key, metric_type='gauge'):
+        self.gauges.append((name, help_text, key, metric_type))
+
+    def render(self):
+        stats = self.callback()
+        lines = []
+        for name, help_text, key, metric_type in self.gauges:
+            lines.extend([f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}",
+                          f"{name} {format_value(stats[key])}"])
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, label_name=None, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_name = label_name
+        self.buckets = tuple(buckets)
+        # label value -> [per-bucket counts (+Inf last), sum]
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_value)
+            if series is None:
+                series = self.series[label_value] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for label_value, (counts, total) in sorted(self.series.items(), key=lambda item: str(item[0])):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += count
+                    labels = format_labels(self.label_name, label_value, f'le="{format_value(bound)}"')
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = format_labels(self.label_name, label_value)
+                lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+                lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Minimal in-process metrics collection rendered in the Prometheus text format.
+    """
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help_text, label_name=None):
+        return self._register(Counter(name, help_text, label_name))
+
+    def histogram(self, name, help_text, label_name=None, buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help_text, label_name, buckets))
+
+    def collector(self, callback):
+        return self._register(StatsCollector(callback))
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,154 @@
+"""
+Path expressions addressing part of a stored value, such as
+
+    config.llm              the "llm" field of the "config" field
+    messages[-5:]           the last five items of the "messages" list
+    messages[-5:].content   the "content" of each of them
+    messages[0]['a.b']      a field whose name contains . or [
+
+A path is a chain of steps: .name or ['name'] for dict fields, [i] for list
+items (negative from the end) and [start:stop:step] for list slices. A
+leading '$' is allowed and ignored; the empty path is the whole value.
+Steps after a slice apply to every item of it.
+"""
+import re
+from functools import lru_cache
+
+MISSING = object()
+
+
+class PathError(ValueError):
+    """
+    A malformed path, or one that can't be set on the value.
+    """
+
+
+_STEP = re.compile(r"""
+    \.?(?P<name>[^.\[\]'"]+)                       # name, .name
+  | \[\s*(?P<quote>['"])(?P<quoted>.*?)(?P=quote)\s*\]   # ['name'], ["name"]
+  | \[\s*(?P<index>-?\d+)\s*\]                     # [index]
+  | \[(?P<slice>\s*-?\d*\s*:\s*-?\d*\s*(:\s*-?\d*\s*)?)\]   # [start:stop:step]
+""", re.VERBOSE)
+
+
+@lru_cache(maxsize=1024)
+def parse(path):
+    """
+    Parses path into a tuple of ('field', name), ('index', i) and
+    ('slice', slice) steps. Raises PathError if it is malformed.
+    """
+    path = path.strip()
+    if path.startswith('$'):
+        path = path[1:]
+    steps = []
+    position = 0
+    while position < len(path):
+        match = _STEP.match(path, position)
+        if match is None or (match.group('name') is not None and position and path[position] != '.'):
+            raise PathError(f"Invalid path '{path}' at position {position}")
+        if match.group('name') is not None:
+            steps.append(('field', match.group('name')))
+        elif match.group('quote') is not None:
+            steps.append(('field', match.group('quoted')))
+        elif match.group('index') is not None:
+            steps.append(('index', int(match.group('index'))))
+        else:
+            bounds = [int(part) if part.strip() else None for part in match.group('slice').split(':')]
+            steps.append(('slice', slice(*bounds)))
+        position = match.end()
+    return tuple(steps)
+
+
+def resolve(value, steps):
+    """
+    The part of value the steps address, or MISSING.
+    """
+    for position, (kind, step) in enumerate(steps):
+        if kind == 'field':
+            if not isinstance(value, dict) or step not in value:
+                return MISSING
+            value = value[step]
+        elif kind == 'index':
+            if not isinstance(value, list) or not -len(value) <= step < len(value):
+                return MISSING
+            value = value[step]
+        else:
+            if not isinstance(value, list):
+                return MISSING
+            rest = steps[position + 1:]
+            items = (resolve(item, rest) for item in value[step])
+            return [item for item in items if item is not MISSING]
+    return value
+
+
+def assign(value, steps, new):
+    """
+    Returns a copy of value with new stored at the path. Only the containers
+    along the path are copied, shallowly, so the cost is proportional to
+    their length rather than to the size of value, and value itself is left
+    untouched for readers that still hold it. Missing dict fields along the
+    path are created.
+
+    Returns (copy, replaced) where replaced is the previous value at the
+    path, or MISSING.
+    """
+    if not steps:
+        return new, value
+    kind, step = steps[0]
+    if kind == 'slice':
+        raise PathError("Can't set a slice")
+    if kind == 'field':
+        if value is MISSING or value is None:
+            value = {}
+        elif not isinstance(value, dict):
+            raise PathError(f"Can't set field '{step}' of a {type(value).__name__}")
+        child, replaced = assign(value.get(step, MISSING), steps[1:], new)
+        copy = dict(value)
+    else:
+        if not isinstance(value, list):
+            raise PathError(f"Can't set item {step} of a {type(value).__name__}")
+        if not -len(value) <= step < len(value):
+            raise PathError(f"List index {step} out of range")
+        child, replaced = assign(value[step], steps[1:], new)
+        copy = list(value)
+    copy[step] = child
+    return copy, replaced
+
+
+def append(value, steps, new):
+    """
+    Appends new to the list at the path in value, in place like a PUSH, so
+    the cost doesn't depend on the length of the list. Missing dict fields
+    along the path, and a missing list, are created. Nothing is changed if
+    the path can't be appended to.
+
+    Returns (value, length): value, or a new one if it was missing, and the
+    new length of the list.
+    """
+    if not steps:
+        if value is MISSING or value is None:
+            return [new], 1
+        if not isinstance(value, list):
+            raise PathError("Can only append to a list")
+        value.append(new)
+        return value, len(value)
+    kind, step = steps[0]
+    if kind == 'slice':
+        raise PathError("Can't set a slice")
+    if kind == 'field':
+        if value is MISSING or value is None:
+            value = {}
+        elif not isinstance(value, dict):
+            raise PathError(f"Can't set field '{step}' of a {type(value).__name__}")
+        child = value.get(step, MISSING)
+    else:
+        if not isinstance(value, list):
+            raise PathError(f"Can't set item {step} of a {type(value).__name__}")
+        if not -len(value) <= step < len(value):
+            raise PathError(f"List index {step} out of range")
+        child = value[step]
+    # the deeper steps are checked before anything is changed
+    appended, length = append(child, steps[1:], new)
+    if appended is not child:
+        value[step] = appended
+    return value, length
@@ -0,0 +1,292 @@
+import glob
+import logging
+import os
+import pickle
+import re
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+FSYNC_POLICIES = ('always', 'everysec', 'no')
+
+
+class AppendOnlyLog:
+    """
+    Append-only file of pickled records written by a background thread.
+
+    Records are buffered in memory and written in batches, so many concurrent
+    writers share one write() and one fsync (group commit). With
+    fsync_policy='always' callers can block in wait_synced() until their
+    records are on disk; 'everysec' fsyncs at most once per second and 'no'
+    leaves flushing to the OS.
+    """
+    def __init__(self, path, fsync_policy='everysec'):
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy '{fsync_policy}', expected one of {FSYNC_POLICIES}")
+        self.path = path
+        self.fsync_policy = fsync_policy
+        self.file = open(path, 'ab')
+        self.buffer = []
+        self.seq = 0
+        self.synced_seq = 0
+        self.last_fsync = time.monotonic()
+        self.records_written = 0
+        self.cond = threading.Condition()
+        # held while writing or switching files so batches stay in order
+        self.file_lock = threading.Lock()
+        self.local = threading.local()
+        self.stopped = False
+        self.writer_thread = threading.Thread(target=self._run, daemon=True)
+        self.writer_thread.start()
+
+    def append(self, record):
+        data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        with self.cond:
+            self.buffer.append(data)
+            self.seq += 1
+            self.local.seq = self.seq
+            self.cond.notify()
+
+    def wait_synced(self, timeout=5):
+        """
+        Blocks until every record appended by the calling thread is on disk.
+        """
+        seq = getattr(self.local, 'seq', 0)
+        with self.cond:
+            self.cond.wait_for(lambda: self.synced_seq >= seq or self.stopped, timeout)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.buffer or self.stopped, timeout=1.0)
+                if self.stopped and not self.buffer:
+                    return
+            self.flush()
+
+    def flush(self):
+        with self.file_lock:
+            self._write_pending(fsync=None)
+
+    def _write_pending(self, fsync):
+        # caller holds file_lock; fsync=None applies the fsync policy
+        with self.cond:
+            batch, self.buffer = self.buffer, []
+            seq = self.seq
+        if batch:
+            self.file.write(b''.join(batch))
+            self.file.flush()
+            self.records_written += len(batch)
+        now = time.monotonic()
+        if fsync is None:
+            fsync = self.fsync_policy == 'always' or \
+                (self.fsync_policy == 'everysec' and now - self.last_fsync >= 1.0)
+        if fsync:
+            os.fsync(self.file.fileno())
+            self.last_fsync = now
+        with self.cond:
+            self.synced_seq = max(self.synced_seq, seq)
+            self.cond.notify_all()
+
+    def rotate(self, path):
+        """
+        Flushes and closes the current file and continues appending to path.
+        Every record appended before the call ends up in the old file.
+        """
+        with self.file_lock:
+            self._write_pending(fsync=True)
+            self.file.close()
+            self.path = path
+            self.file = open(path, 'ab')
+
+    def close(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        self.writer_thread.join(timeout=5)
+        with self.file_lock:
+            if not self.file.closed:
+                self._write_pending(fsync=True)
+                self.file.close()
+
+
+class Persistence:
+    """
+    Snapshot + append-only log durability for the DataStore, the streams
+    and the upload file registry.
+
+    Every mutation is journaled to appendonly.<n>.log. A background thread
+    periodically starts a new log file, writes a snapshot of the live data
+    that records which log it starts from, and then deletes the older logs.
+    On startup the snapshot is loaded and only the logs written after it are
+    replayed, so restart time follows the live data, not the full history.
+    The snapshot is taken without stopping the store; replaying the records
+    written while it was taken is safe because they are idempotent in order
+    (see DataStore.replay).
+    """
+    SNAPSHOT_FILE = 'snapshot.pkl'
+    LOG_PATTERN = re.compile(r'appendonly\.(\d+)\.log$')
+
+    def __init__(self, directory, store, file_registry, fsync_policy='everysec',
+                 snapshot_interval=300, snapshot_min_changes=1000, streams=None):
+        self.directory = directory
+        self.store = store
+        self.streams = streams
+        self.file_registry = file_registry
+        self.fsync_policy = fsync_policy
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_min_changes = snapshot_min_changes
+        self.log = None
+        self.log_index = 0
+        self.snapshot_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.snapshot_thread = None
+        os.makedirs(directory, exist_ok=True)
+
+    def _log_path(self, index):
+        return os.path.join(self.directory, f'appendonly.{index}.log')
+
+    def _log_files(self):
+        files = []
+        for path in glob.glob(os.path.join(self.directory, 'appendonly.*.log')):
+            match = self.LOG_PATTERN.search(path)
+            if match:
+                files.append((int(match.group(1)), path))
+        return sorted(files)
+
+    # -- startup -----------------------------------------------------------
+
+    def load(self):
+        """
+        Restores the snapshot and replays the log tail. Must run before start().
+        """
+        start = time.monotonic()
+        first_log = 0
+        snapshot_path = os.path.join(self.directory, self.SNAPSHOT_FILE)
+        if os.path.exists(snapshot_path):
+            with open(snapshot_path, 'rb') as f:
+                snapshot = pickle.load(f)
+            first_log = snapshot['first_log']
+            for key, value, deadline, *offset in snapshot['data']:
+                self.store.replay(('SET', key, pickle.loads(value), deadline, *offset))
+            self.store.id_floor = max(self.store.id_floor, snapshot.get('id_floor', 0))
+            self.store.queue_limits.update(snapshot.get('queue_limits', {}))
+            self.file_registry.update(snapshot['files'])
+            if self.streams is not None:
+                for state in snapshot.get('streams', []):
+                    self.streams.restore(state)
+
+        replayed = 0
+        for index, path in self._log_files():
+            if index < first_log:
+                continue
+            replayed += self._replay_log(path)
+            self.log_index = max(self.log_index, index)
+        self.log_index = max(self.log_index, first_log)
+        logger.info(f"Persistence: loaded {len(self.store)} keys, replayed {replayed} log records "
+                    f"in {time.monotonic() - start:.3f}s")
+
+    def _replay_log(self, path):
+        count = 0
+        with open(path, 'rb') as f:
+            while True:
+                offset = f.tell()
+                try:
+                    record = pickle.load(f)
+                except EOFError:
+                    break
+                except Exception as e:
+                    # torn write at the tail after a crash: drop it
+                    logger.warning(f"Persistence: truncating {path} at offset {offset}: {e}")
+                    f.close()
+                    os.truncate(path, offset)
+                    break
+                self.apply(record)
+                count += 1
+        return count
+
+    def apply(self, record):
+        if record[0] == 'FILE_SET':
+            self.file_registry[record[1]] = record[2]
+        elif record[0] == 'FILE_DEL':
+            self.file_registry.pop(record[1], None)
+        elif self.streams is not None and record[0] in self.streams.RECORDS:
+            self.streams.replay(record)
+        else:
+            self.store.replay(record)
+
+    # -- runtime -----------------------------------------------------------
+
+    def start(self):
+        """
+        Opens a fresh log file, attaches the journal to the store and starts
+        the background snapshot thread.
+        """
+        self.log_index += 1
+        self.log = AppendOnlyLog(self._log_path(self.log_index), self.fsync_policy)
+        self.store.journal = self.journal
+        if self.streams is not None:
+            self.streams.journal = self.journal
+        self.snapshot_thread = threading.Thread(target=self._run_snapshots, daemon=True)
+        self.snapshot_thread.start()
+
+    def journal(self, record):
+        self.log.append(record)
+
+    def wait_synced(self):
+        """
+        With fsync_policy 'always', blocks until the calling thread's records
+        are on disk. Called once per request so a pipeline shares one fsync.
+        """
+        if self.log is not None and self.fsync_policy == 'always':
+            self.log.wait_synced()
+
+    def file_added(self, saved_filename, original_filename):
+        self.journal(('FILE_SET', saved_filename, original_filename))
+
+    def file_deleted(self, saved_filename):
+        self.journal(('FILE_DEL', saved_filename))
+
+    def _run_snapshots(self):
+        last_written = 0
+        while not self.stop_event.wait(self.snapshot_interval):
+            if self.log.records_written - last_written >= self.snapshot_min_changes:
+                last_written = self.log.records_written
+                try:
+                    self.snapshot()
+                except Exception as e:
+                    logger.error(f"Persistence: snapshot failed: {e}")
+
+    def snapshot(self):
+        """
+        Writes a snapshot of the live data and deletes the logs it covers.
+        """
+        with self.snapshot_lock:
+            start = time.monotonic()
+            # records from here on go to the new log, which the snapshot starts from
+            first_log = self.log_index + 1
+            self.log.rotate(self._log_path(first_log))
+            self.log_index = first_log
+            snapshot = {'first_log': first_log,
+                        'id_floor': self.store.id_floor,
+                        'queue_limits': dict(self.store.queue_limits),
+                        'data': list(self.store.dump()),
+                        'files': dict(self.file_registry),
+                        'streams': list(self.streams.dump()) if self.streams is not None else []}
+            path = os.path.join(self.directory, self.SNAPSHOT_FILE)
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+            for index, log_path in self._log_files():
+                if index < first_log:
+                    os.remove(log_path)
+            logger.info(f"Persistence: snapshot of {len(snapshot['data'])} keys "
+                        f"written in {time.monotonic() - start:.3f}s")
+
+    def stop(self):
+        self.stop_event.set()
+        if self.log is not None:
+            self.log.close()
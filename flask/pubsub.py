@@ -0,0 +1,175 @@
+import threading
+import time
+import uuid
+from collections import deque
+from fnmatch import fnmatchcase
+
+from kv_store import StoreError
+
+
+class Subscription:
+    """
+    One subscriber: the channels and glob patterns it listens to and a
+    bounded buffer of messages waiting to be received. When the buffer is
+    full the oldest message is dropped and counted, so a slow subscriber
+    never holds back publishers or other subscribers.
+    """
+    def __init__(self, subscription_id, buffer_size):
+        self.id = subscription_id
+        self.channels = set()
+        self.patterns = set()
+        self.buffer = deque(maxlen=buffer_size)
+        self.dropped = 0
+        self.cond = threading.Condition()
+        self.last_seen = time.monotonic()
+        self.receiving = 0
+        self.closed = False
+
+    def deliver(self, message):
+        """
+        Buffers message. Returns True if the oldest message had to be dropped.
+        """
+        with self.cond:
+            overflow = len(self.buffer) == self.buffer.maxlen
+            if overflow:
+                self.dropped += 1
+            self.buffer.append(message)
+            self.cond.notify_all()
+        return overflow
+
+
+class PubSub:
+    """
+    Fire-and-forget publish/subscribe channels. Every message published on a
+    channel is copied to the buffer of each subscription listening to it,
+    directly or through a pattern, so any number of listeners see the same
+    events. Messages are not stored, persisted or replayed: a subscription
+    only receives what is published after it subscribed.
+
+    HTTP subscribers can vanish without unsubscribing, so subscriptions that
+    have not received for idle_timeout seconds are removed.
+    """
+    def __init__(self, buffer_size=1000, idle_timeout=300):
+        self.buffer_size = buffer_size
+        self.idle_timeout = idle_timeout
+        self.subscriptions = {}
+        self.channels = {}
+        self.patterns = {}
+        self.lock = threading.Lock()
+        self.published = 0
+        self.dropped = 0
+
+    def _lookup(self, subscription_id):
+        subscription = self.subscriptions.get(subscription_id)
+        if subscription is None:
+            raise StoreError(f"Unknown subscription '{subscription_id}'", status=404)
+        return subscription
+
+    def subscribe(self, channels=None, patterns=None, subscription_id=None):
+        """
+        Adds channels and glob patterns to a subscription, creating it when
+        subscription_id is None. Returns the subscription id.
+        """
+        self.reap()
+        with self.lock:
+            if subscription_id is None:
+                subscription = Subscription(uuid.uuid4().hex, self.buffer_size)
+                self.subscriptions[subscription.id] = subscription
+            else:
+                subscription = self._lookup(subscription_id)
+            for channel in channels or []:
+                subscription.channels.add(channel)
+                self.channels.setdefault(channel, set()).add(subscription)
+            for pattern in patterns or []:
+                subscription.patterns.add(pattern)
+                self.patterns.setdefault(pattern, set()).add(subscription)
+            subscription.last_seen = time.monotonic()
+            return subscription.id
+
+    def unsubscribe(self, subscription_id, channels=None, patterns=None):
+        """
+        Removes channels and patterns from a subscription, or the whole
+        subscription when neither is given. Returns False if it is unknown.
+        """
+        with self.lock:
+            subscription = self.subscriptions.get(subscription_id)
+            if subscription is None:
+                return False
+            if channels is None and patterns is None:
+                channels, patterns = list(subscription.channels), list(subscription.patterns)
+                del self.subscriptions[subscription_id]
+                with subscription.cond:
+                    subscription.closed = True
+                    subscription.cond.notify_all()
+            self._detach(self.channels, subscription.channels, subscription, channels or [])
+            self._detach(self.patterns, subscription.patterns, subscription, patterns or [])
+            return True
+
+    @staticmethod
+    def _detach(registry, names, subscription, remove):
+        for name in remove:
+            names.discard(name)
+            subscribers = registry.get(name)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del registry[name]
+
+    def publish(self, channel, message):
+        """
+        Delivers message to every subscription listening to channel.
+        Returns the number of subscriptions it was delivered to.
+        """
+        with self.lock:
+            targets = [(subscription, None) for subscription in self.channels.get(channel, ())]
+            for pattern, subscribers in self.patterns.items():
+                if fnmatchcase(channel, pattern):
+                    targets.extend((subscription, pattern) for subscription in subscribers)
+            self.published += 1
+        dropped = 0
+        for subscription, pattern in targets:
+            dropped += subscription.deliver({'channel': channel, 'pattern': pattern, 'data': message})
+        if dropped:
+            with self.lock:
+                self.dropped += dropped
+        return len(targets)
+
+    def receive(self, subscription_id, timeout=0, count=100):
+        """
+        Returns {"messages": [...], "dropped": n} with up to count buffered
+        messages, blocking up to timeout seconds while the buffer is empty.
+        dropped is the number of messages lost to buffer overflow since the
+        previous receive.
+        """
+        with self.lock:
+            subscription = self._lookup(subscription_id)
+        with subscription.cond:
+            subscription.receiving += 1
+            try:
+                if timeout and not subscription.buffer:
+                    subscription.cond.wait_for(lambda: subscription.buffer or subscription.closed, timeout)
+            finally:
+                subscription.receiving -= 1
+                subscription.last_seen = time.monotonic()
+            messages = [subscription.buffer.popleft()
+                        for _ in range(min(count, len(subscription.buffer)))]
+            dropped, subscription.dropped = subscription.dropped, 0
+        return {'messages': messages, 'dropped': dropped}
+
+    def reap(self):
+        """
+        Removes the subscriptions nobody has received from for idle_timeout seconds.
+        """
+        deadline = time.monotonic() - self.idle_timeout
+        idle = [subscription.id for subscription in list(self.subscriptions.values())
+                if not subscription.receiving and subscription.last_seen < deadline]
+        for subscription_id in idle:
+            self.unsubscribe(subscription_id)
+        return len(idle)
+
+    def stats(self):
+        with self.lock:
+            return {'subscriptions': len(self.subscriptions),
+                    'published': self.published,
+                    'dropped': self.dropped,
+                    'buffered': sum(len(s.buffer) for s in self.subscriptions.values())}
@@ -0,0 +1,85 @@
+"""
+Production entry point: one store process shared by N gunicorn worker processes.
+
+The store process owns the DataStore, the upload file registry and the
+persistence files, and serves them on a Unix socket (STORE_SOCKET). Every
+worker imports app.py with STORE_SOCKET set, so its commands go to the shared
+store, and /command throughput scales with the number of workers.
+
+    python serve.py --workers 4 --threads 16 --bind 0.0.0.0:5000
+
+The store itself is configured with the same STORE_* variables as app.py,
+and it is the store process that restores persisted data, expires keys and
+logs the STORE_DUMP_INTERVAL summaries.
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import tempfile
+
+from gunicorn.app.base import BaseApplication
+
+from store_service import StoreService
+
+
+def run_store(path):
+    logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO').upper(), format='%(asctime)s - %(message)s')
+    service = StoreService.from_env()
+
+    def shutdown(signum, frame):
+        # flush the append-only log before exiting
+        service.stop()
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    service.start()
+    service.serve_unix(path)
+
+
+class WorkersApplication(BaseApplication):
+    def __init__(self, options):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        # imported in each worker, after STORE_SOCKET is set
+        from wsgi import app
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the Flask data store with multiple worker processes.")
+    parser.add_argument('--bind', default=os.getenv('BIND', '0.0.0.0:5000'))
+    parser.add_argument('--workers', type=int, default=int(os.getenv('WORKERS', multiprocessing.cpu_count())))
+    # threads per worker; long-poll /wait requests hold one thread each while they wait
+    parser.add_argument('--threads', type=int, default=int(os.getenv('THREADS', '16')))
+    parser.add_argument('--store-socket', default=os.getenv('STORE_SOCKET') or
+                        os.path.join(tempfile.gettempdir(), f'flask-store-{os.getpid()}.sock'))
+    args = parser.parse_args()
+
+    os.environ['STORE_SOCKET'] = args.store_socket
+    store_process = multiprocessing.Process(target=run_store, args=(args.store_socket,), daemon=True)
+    store_process.start()
+
+    try:
+        WorkersApplication({
+            'bind': args.bind,
+            'workers': args.workers,
+            'threads': args.threads,
+            'worker_class': 'gthread',
+            'preload_app': False,
+        }).run()
+    finally:
+        store_process.terminate()
+        store_process.join(timeout=5)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,307 @@
+import logging
+import os
+import pickle
+import socket
+import socketserver
+import struct
+import threading
+import time
+from functools import partial
+
+from audit_log import summarize
+from kv_store import DataStore, StoreError
+from persistence import Persistence
+from pubsub import PubSub
+from streams import StreamStore
+
+logger = logging.getLogger(__name__)
+
+# Methods a RemoteStore may call on the StoreService in the store process
+REMOTE_METHODS = {
+    'get', 'get_many', 'get_path', 'get_versioned', 'changed_since', 'set', 'set_path', 'cas', 'execute', 'push', 'drain', 'delete', 'has', 'expire', 'ttl',
+    'keys', 'items', 'scan', 'clear', 'wait', 'stats',
+    'set_queue_limit', 'queue_info',
+    'hset', 'hget', 'hgetall', 'hdel', 'incrby', 'sadd', 'srem', 'smembers',
+    'publish', 'subscribe', 'unsubscribe', 'receive',
+    'read_since', 'xadd', 'xgroup', 'xread', 'xreadgroup', 'xack', 'xpending', 'xlen',
+    'register_file', 'lookup_file', 'unregister_file',
+}
+# ...of which these are served by the StreamStore
+STREAM_METHODS = {'xadd', 'xgroup', 'xread', 'xreadgroup', 'xack', 'xpending', 'xlen'}
+
+HEADER = struct.Struct('!I')
+
+
+def parse_bytes(value):
+    """
+    Parses a memory size such as '1048576', '512kb', '256mb' or '1gb'.
+    """
+    value = str(value).strip().lower()
+    for suffix, factor in (('kb', 1024), ('mb', 1024 ** 2), ('gb', 1024 ** 3)):
+        if value.endswith(suffix):
+            return int(float(value[:-len(suffix)]) * factor)
+    return int(value)
+
+
+def send_frame(sock, obj):
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+
+def recv_exactly(sock, size):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:], size - received)
+        if count == 0:
+            raise ConnectionError("Connection closed by peer")
+        received += count
+    return buffer
+
+
+def recv_frame(sock):
+    size, = HEADER.unpack(recv_exactly(sock, HEADER.size))
+    return pickle.loads(recv_exactly(sock, size))
+
+
+class StoreService:
+    """
+    The data store together with the upload file registry and persistence.
+
+    The Flask app uses it in-process by default. For multi-process serving
+    (see serve.py) a single store process runs it behind a Unix socket with
+    serve_unix(), and every worker talks to it through a RemoteStore.
+    """
+    def __init__(self, data_store, persistence=None, file_registry=None,
+                 reaper_interval=0.1, reaper_batch=100, pubsub=None, streams=None,
+                 dump_interval=0, dump_max_chars=200):
+        self.data_store = data_store
+        self.pubsub = PubSub() if pubsub is None else pubsub
+        self.streams = StreamStore() if streams is None else streams
+        self.file_registry = {} if file_registry is None else file_registry
+        self.persistence = persistence
+        self.reaper_interval = reaper_interval
+        self.reaper_batch = reaper_batch
+        # seconds between summaries of the store in the log, 0 for none
+        self.dump_interval = dump_interval
+        self.dump_max_chars = dump_max_chars
+        self.stop_event = threading.Event()
+
+    @classmethod
+    def from_env(cls):
+        """
+        Builds the service from the STORE_* / REAPER_* environment variables.
+        """
+        # STORE_MAXMEMORY 0 means unlimited; see kv_store.EVICTION_POLICIES for the policies
+        # QUEUE_MAXLEN bounds every list (0 means unbounded) unless set per key; see
+        # kv_store.OVERFLOW_POLICIES for QUEUE_OVERFLOW
+        data_store = DataStore(maxmemory=parse_bytes(os.getenv('STORE_MAXMEMORY', '0')),
+                               eviction_policy=os.getenv('STORE_EVICTION_POLICY', 'noeviction'),
+                               queue_maxlen=int(os.getenv('QUEUE_MAXLEN', '0')),
+                               queue_overflow=os.getenv('QUEUE_OVERFLOW', 'drop_oldest'))
+        file_registry = {}
+        # STREAM_MAXLEN caps the entries kept per stream, 0 means unbounded
+        streams = StreamStore(maxlen=int(os.getenv('STREAM_MAXLEN', '100000')))
+        # Durability is opt-in: STORE_DATA_DIR enables snapshot + append-only log persistence
+        persistence = None
+        if os.getenv('STORE_DATA_DIR'):
+            persistence = Persistence(os.getenv('STORE_DATA_DIR'), data_store, file_registry,
+                                      fsync_policy=os.getenv('STORE_FSYNC', 'everysec'),
+                                      snapshot_interval=float(os.getenv('STORE_SNAPSHOT_INTERVAL', '300')),
+                                      snapshot_min_changes=int(os.getenv('STORE_SNAPSHOT_MIN_CHANGES', '1000')),
+                                      streams=streams)
+        # Messages buffered per subscriber before the oldest are dropped, and the
+        # seconds after which a subscriber that stopped receiving is removed
+        pubsub = PubSub(buffer_size=int(os.getenv('PUBSUB_BUFFER_SIZE', '1000')),
+                        idle_timeout=float(os.getenv('PUBSUB_IDLE_TIMEOUT', '300')))
+        # Seconds between expiry reaper passes; each pass removes at most REAPER_BATCH keys.
+        # STORE_DUMP_INTERVAL: seconds between store summaries in the log, 0 disables them
+        return cls(data_store, persistence, file_registry,
+                   reaper_interval=float(os.getenv('REAPER_INTERVAL', '0.1')),
+                   reaper_batch=int(os.getenv('REAPER_BATCH', '100')),
+                   pubsub=pubsub, streams=streams,
+                   dump_interval=float(os.getenv('STORE_DUMP_INTERVAL', '0')),
+                   dump_max_chars=int(os.getenv('LOG_MAX_CHARS', '200')))
+
+    def start(self):
+        """
+        Restores persisted data and starts the background threads.
+        """
+        if self.persistence:
+            self.persistence.load()
+            self.persistence.start()
+        self.data_store.start_reaper(self.reaper_interval, self.reaper_batch)
+        if self.dump_interval > 0:
+            threading.Thread(target=self._dump_periodically, daemon=True).start()
+
+    def _dump_periodically(self):
+        """
+        Logs a summary of the store every dump_interval seconds. Per-key
+        details are only logged at DEBUG level, and values are summarized.
+        """
+        while not self.stop_event.wait(self.dump_interval):
+            items = self.data_store.items()
+            logger.info(f"data_store: {len(items)} keys")
+            if logger.isEnabledFor(logging.DEBUG):
+                for key, value in items:
+                    logger.debug("%s -> %s", key, summarize(value, self.dump_max_chars))
+
+    def stop(self):
+        self.stop_event.set()
+        self.data_store.stop()
+        if self.persistence:
+            self.persistence.stop()
+
+    def __getattr__(self, name):
+        # store commands (get, set, push, ...) go straight to the DataStore,
+        # stream commands (xadd, xreadgroup, ...) to the StreamStore
+        if name in REMOTE_METHODS:
+            return getattr(self.streams if name in STREAM_METHODS else self.data_store, name)
+        raise AttributeError(name)
+
+    def publish(self, channel, message):
+        return self.pubsub.publish(channel, message)
+
+    def subscribe(self, channels=None, patterns=None, subscription_id=None):
+        return self.pubsub.subscribe(channels, patterns, subscription_id)
+
+    def unsubscribe(self, subscription_id, channels=None, patterns=None):
+        return self.pubsub.unsubscribe(subscription_id, channels, patterns)
+
+    def receive(self, subscription_id, timeout=0, count=100):
+        return self.pubsub.receive(subscription_id, timeout, count)
+
+    def stats(self):
+        pubsub = self.pubsub.stats()
+        streams = self.streams.stats()
+        return {'keys': len(self.data_store),
+                'used_memory': self.data_store.used_memory,
+                'maxmemory': self.data_store.maxmemory,
+                'evicted_keys': self.data_store.evicted_keys,
+                'expired_keys': self.data_store.expired_keys,
+                'queue_dropped_entries': self.data_store.dropped_entries,
+                'queue_rejected_pushes': self.data_store.rejected_pushes,
+                'queue_max_depth': self.data_store.max_queue_depth(),
+                'subscriptions': pubsub['subscriptions'],
+                'published_messages': pubsub['published'],
+                'dropped_messages': pubsub['dropped'],
+                'streams': streams['streams'],
+                'stream_entries': streams['stream_entries'],
+                'pending_entries': streams['pending_entries']}
+
+    def wait_synced(self):
+        if self.persistence:
+            self.persistence.wait_synced()
+
+    def register_file(self, saved_filename, original_filename):
+        self.file_registry[saved_filename] = original_filename
+        if self.persistence:
+            self.persistence.file_added(saved_filename, original_filename)
+
+    def lookup_file(self, saved_filename):
+        return self.file_registry.get(saved_filename)
+
+    def unregister_file(self, saved_filename):
+        if self.file_registry.pop(saved_filename, None) is not None and self.persistence:
+            self.persistence.file_deleted(saved_filename)
+
+    # -- store process -----------------------------------------------------
+
+    def serve_unix(self, path):
+        """
+        Serves REMOTE_METHODS on a Unix socket, one thread per connection.
+        Workers keep their connections open, so this is one thread per
+        worker thread rather than per request. The socket is only accessible
+        to the user running the server.
+        """
+        service = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                while True:
+                    try:
+                        method, args, kwargs = recv_frame(self.request)
+                    except (ConnectionError, OSError):
+                        return
+                    try:
+                        if method not in REMOTE_METHODS:
+                            raise StoreError(f"Unknown store method '{method}'")
+                        response = ('ok', getattr(service, method)(*args, **kwargs))
+                        service.wait_synced()
+                    except StoreError as e:
+                        response = ('error', (str(e), e.status))
+                    except Exception as e:
+                        logger.exception(f"Store: {method} failed")
+                        response = ('error', (f"{type(e).__name__}: {e}", 500))
+                    send_frame(self.request, response)
+
+        if os.path.exists(path):
+            os.remove(path)
+        # create the file without access for other users rather than chmod it after
+        umask = os.umask(0o177)
+        try:
+            server = socketserver.ThreadingUnixStreamServer(path, Handler)
+        finally:
+            os.umask(umask)
+        server.daemon_threads = True
+        logger.info(f"Store: serving on {path}")
+        server.serve_forever()
+
+
+class RemoteStore:
+    """
+    StoreService proxy used by worker processes. Each thread keeps its own
+    persistent connection to the store process.
+    """
+    def __init__(self, path, connect_timeout=10):
+        self.path = path
+        self.connect_timeout = connect_timeout
+        self.local = threading.local()
+
+    def _connect(self):
+        deadline = time.monotonic() + self.connect_timeout
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.path)
+                return sock
+            except OSError:
+                sock.close()
+                # the store process may still be starting up
+                if time.monotonic() >= deadline:
+                    raise
+                time.sleep(0.1)
+
+    def call(self, method, *args, **kwargs):
+        sock = getattr(self.local, 'sock', None)
+        fresh = sock is None
+        if fresh:
+            sock = self.local.sock = self._connect()
+        try:
+            send_frame(sock, (method, args, kwargs))
+        except OSError:
+            # a reused connection may have been closed by a store restart
+            sock.close()
+            self.local.sock = None
+            if fresh:
+                raise
+            return self.call(method, *args, **kwargs)
+        try:
+            status, value = recv_frame(sock)
+        except (ConnectionError, OSError):
+            sock.close()
+            self.local.sock = None
+            raise
+        if status == 'error':
+            raise StoreError(*value)
+        return value
+
+    def __getattr__(self, name):
+        if name in REMOTE_METHODS:
+            return partial(self.call, name)
+        raise AttributeError(name)
+
+    def wait_synced(self):
+        # the store process waits for the fsync before it replies
+        pass
@@ -0,0 +1,301 @@
+import threading
+import time
+from collections import OrderedDict, deque
+
+from kv_store import StoreError
+
+
+class ConsumerGroup:
+    """
+    Delivery state of one consumer group: the last entry handed out and the
+    pending entries that were delivered but not acknowledged yet.
+    """
+    def __init__(self, name, last_delivered=0, visibility_timeout=30):
+        self.name = name
+        self.last_delivered = last_delivered
+        self.visibility_timeout = visibility_timeout
+        # entry id -> [consumer, delivered_at (monotonic), deliveries], oldest delivery first
+        self.pending = OrderedDict()
+
+    def redeliverable(self, now):
+        """
+        Yields the ids of pending entries whose visibility timeout has passed.
+        """
+        for entry_id, (consumer, delivered_at, deliveries) in self.pending.items():
+            if delivered_at + self.visibility_timeout > now:
+                return
+            yield entry_id
+
+    def next_redelivery(self):
+        for consumer, delivered_at, deliveries in self.pending.values():
+            return delivered_at + self.visibility_timeout
+        return None
+
+
+class Stream:
+    """
+    Append-only log of values. Entry ids are consecutive integers starting at
+    1, so the entry with a given id is found by offset from the first one.
+    """
+    def __init__(self):
+        self.entries = deque()
+        self.last_id = 0
+        self.groups = {}
+        self.cond = threading.Condition()
+
+    @property
+    def first_id(self):
+        return self.last_id - len(self.entries) + 1
+
+    def entry(self, entry_id):
+        index = entry_id - self.first_id
+        return self.entries[index] if 0 <= index < len(self.entries) else None
+
+    def append(self, value, maxlen=0):
+        self.entries.append(value)
+        self.last_id += 1
+        while maxlen and len(self.entries) > maxlen:
+            self.entries.popleft()
+        return self.last_id
+
+
+class StreamStore:
+    """
+    Streams with consumer groups, for events that must not be lost when a
+    consumer crashes.
+
+    Each group hands every entry to one of its consumers and keeps it pending
+    until that consumer acknowledges it. Pending entries that are not
+    acknowledged within the group's visibility timeout are delivered again,
+    to whichever consumer reads next, so delivery is at-least-once. Several
+    groups can read the same stream independently.
+
+    Streams live outside the key/value keyspace and are not counted against
+    maxmemory; maxlen bounds them instead, trimming the oldest entries.
+    Deliveries are not journaled: after a restart the entries that were not
+    acknowledged are delivered again.
+    """
+    RECORDS = ('XADD', 'XGROUP', 'XACK')
+
+    def __init__(self, maxlen=0):
+        self.maxlen = maxlen
+        self.streams = {}
+        self.lock = threading.Lock()
+        # called with every mutation as a replayable record, see replay()
+        self.journal = None
+
+    def _journal(self, *record):
+        if self.journal is not None:
+            self.journal(record)
+
+    def _stream(self, key, create=False):
+        with self.lock:
+            stream = self.streams.get(key)
+            if stream is None and create:
+                stream = self.streams[key] = Stream()
+        if stream is None:
+            raise StoreError(f"No such stream '{key}'", status=404)
+        return stream
+
+    @staticmethod
+    def _group(stream, key, group):
+        consumer_group = stream.groups.get(group)
+        if consumer_group is None:
+            raise StoreError(f"No consumer group '{group}' on stream '{key}'", status=404)
+        return consumer_group
+
+    # -- commands ----------------------------------------------------------
+
+    def xadd(self, key, value, maxlen=None):
+        """
+        Appends value to the stream at key, creating it if needed, and trims
+        it to maxlen entries (default: the store's maxlen, 0 for unbounded).
+        Returns the id of the new entry.
+        """
+        maxlen = self.maxlen if maxlen is None else maxlen
+        stream = self._stream(key, create=True)
+        with stream.cond:
+            entry_id = stream.append(value, maxlen)
+            self._journal('XADD', key, entry_id, value, maxlen)
+            stream.cond.notify_all()
+        return entry_id
+
+    def xgroup(self, key, group, start='$', visibility_timeout=30):
+        """
+        Creates a consumer group on the stream at key (creating the stream if
+        needed) that delivers the entries after id start: '$' for new entries
+        only, 0 for the whole stream. Returns False if the group exists.
+        """
+        stream = self._stream(key, create=True)
+        with stream.cond:
+            if group in stream.groups:
+                return False
+            last_delivered = stream.last_id if start == '$' else int(start)
+            stream.groups[group] = ConsumerGroup(group, last_delivered, visibility_timeout)
+            self._journal('XGROUP', key, group, last_delivered, visibility_timeout)
+        return True
+
+    def xread(self, key, after=0, count=100, block=0):
+        """
+        Returns up to count [id, value] entries with an id above after,
+        without any consumer group bookkeeping. With block, waits up to
+        block seconds for one to be added.
+        """
+        with self.lock:
+            stream = self.streams.get(key)
+        if stream is None:
+            return []
+        deadline = time.monotonic() + block
+        with stream.cond:
+            while stream.last_id <= (after or 0):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                stream.cond.wait(remaining)
+            start = max((after or 0) + 1, stream.first_id)
+            return [[entry_id, stream.entry(entry_id)]
+                    for entry_id in range(start, min(start + count, stream.last_id + 1))]
+
+    def xreadgroup(self, key, group, consumer, count=10, block=0):
+        """
+        Delivers up to count entries to consumer as [[id, value], ...]:
+        first pending entries whose visibility timeout expired, then new
+        ones. Every returned entry stays pending until acknowledged with
+        xack(). With block, waits up to block seconds for an entry.
+        """
+        stream = self._stream(key)
+        deadline = time.monotonic() + block
+        with stream.cond:
+            consumer_group = self._group(stream, key, group)
+            while True:
+                now = time.monotonic()
+                result = self._deliver(stream, consumer_group, consumer, count, now)
+                if result or now >= deadline:
+                    return result
+                wakeup = consumer_group.next_redelivery()
+                stream.cond.wait(deadline - now if wakeup is None else min(deadline, wakeup) - now)
+
+    @staticmethod
+    def _deliver(stream, consumer_group, consumer, count, now):
+        # caller holds stream.cond
+        result = []
+        pending = consumer_group.pending
+        for entry_id in list(consumer_group.redeliverable(now)):
+            if len(result) >= count:
+                return result
+            if entry_id < stream.first_id:
+                # trimmed by maxlen before it was acknowledged
+                del pending[entry_id]
+                continue
+            state = pending.pop(entry_id)
+            pending[entry_id] = [consumer, now, state[2] + 1]
+            result.append([entry_id, stream.entry(entry_id)])
+        while len(result) < count and consumer_group.last_delivered < stream.last_id:
+            entry_id = max(consumer_group.last_delivered + 1, stream.first_id)
+            consumer_group.last_delivered = entry_id
+            pending[entry_id] = [consumer, now, 1]
+            result.append([entry_id, stream.entry(entry_id)])
+        return result
+
+    def xack(self, key, group, ids):
+        """
+        Acknowledges entries delivered to the group. Returns how many were pending.
+        """
+        stream = self._stream(key)
+        with stream.cond:
+            consumer_group = self._group(stream, key, group)
+            acked = [entry_id for entry_id in ids if consumer_group.pending.pop(entry_id, None) is not None]
+            if acked:
+                self._journal('XACK', key, group, acked)
+        return len(acked)
+
+    def xpending(self, key, group, count=100):
+        """
+        Summary of the unacknowledged entries of a group: their total, the
+        number per consumer, and [id, consumer, idle seconds, deliveries] for
+        the count oldest deliveries.
+        """
+        stream = self._stream(key)
+        with stream.cond:
+            consumer_group = self._group(stream, key, group)
+            now = time.monotonic()
+            consumers = {}
+            entries = []
+            for entry_id, (consumer, delivered_at, deliveries) in consumer_group.pending.items():
+                consumers[consumer] = consumers.get(consumer, 0) + 1
+                if len(entries) < count:
+                    entries.append([entry_id, consumer, round(now - delivered_at, 3), deliveries])
+            return {'count': len(consumer_group.pending), 'consumers': consumers, 'entries': entries}
+
+    def xlen(self, key):
+        with self.lock:
+            stream = self.streams.get(key)
+        return 0 if stream is None else len(stream.entries)
+
+    def stats(self):
+        with self.lock:
+            streams = list(self.streams.values())
+        return {'streams': len(streams),
+                'stream_entries': sum(len(stream.entries) for stream in streams),
+                'pending_entries': sum(len(group.pending) for stream in streams
+                                       for group in list(stream.groups.values()))}
+
+    # -- persistence -------------------------------------------------------
+
+    def replay(self, record):
+        """
+        Applies a journal record, idempotently when replayed in order over a
+        snapshot that already contains it. An XACK proves that the entries up
+        to it were delivered, so the unacknowledged ones before it become
+        pending again (redelivered after one visibility timeout).
+        """
+        op, key, *args = record
+        stream = self._stream(key, create=True)
+        with stream.cond:
+            if op == 'XADD':
+                entry_id, value, maxlen = args
+                if entry_id > stream.last_id:
+                    if entry_id != stream.last_id + 1:
+                        stream.entries.clear()
+                        stream.last_id = entry_id - 1
+                    stream.append(value, maxlen)
+            elif op == 'XGROUP':
+                group, last_delivered, visibility_timeout = args
+                if group not in stream.groups:
+                    stream.groups[group] = ConsumerGroup(group, last_delivered, visibility_timeout)
+            elif op == 'XACK':
+                group, ids = args
+                consumer_group = stream.groups.get(group)
+                if consumer_group is None:
+                    return
+                now = time.monotonic()
+                for entry_id in ids:
+                    for missed in range(max(consumer_group.last_delivered + 1, stream.first_id), entry_id):
+                        consumer_group.pending[missed] = [None, now, 1]
+                    consumer_group.last_delivered = max(consumer_group.last_delivered, entry_id)
+                    consumer_group.pending.pop(entry_id, None)
+
+    def dump(self):
+        """
+        Yields the state of every stream, each read under its own lock:
+        (key, last_id, entries, [(group, last_delivered, visibility_timeout, pending ids)]).
+        """
+        with self.lock:
+            items = list(self.streams.items())
+        for key, stream in items:
+            with stream.cond:
+                groups = [(group.name, group.last_delivered, group.visibility_timeout, list(group.pending))
+                          for group in stream.groups.values()]
+                yield key, stream.last_id, list(stream.entries), groups
+
+    def restore(self, state):
+        key, last_id, entries, groups = state
+        stream = self._stream(key, create=True)
+        now = time.monotonic()
+        with stream.cond:
+            stream.entries = deque(entries)
+            stream.last_id = last_id
+            for name, last_delivered, visibility_timeout, pending in groups:
+                consumer_group = stream.groups[name] = ConsumerGroup(name, last_delivered, visibility_timeout)
+                for entry_id in pending:
+                    consumer_group.pending[entry_id] = [None, now, 1]
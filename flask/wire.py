@@ -0,0 +1,80 @@
+"""
+Request/response encoding for the store endpoints.
+
+JSON is the default and the fallback for browsers and curl. Clients that
+send Content-Type: application/msgpack get MessagePack back (or ask for it
+with Accept), which is faster to encode for large nested values and carries
+bytes natively. Request bodies may be gzip or deflate compressed
+(Content-Encoding), and responses above COMPRESS_MIN_BYTES are compressed
+when the client accepts it.
+"""
+import base64
+import gzip
+import json
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+
+
+def _json_default(value):
+    # JSON can't carry bytes: JSON clients get them base64-encoded
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return base64.b64encode(bytes(value)).decode('ascii')
+    return str(value)
+
+
+def encode(payload, content_type):
+    if content_type == MSGPACK:
+        return msgpack.packb(payload, use_bin_type=True, default=_json_default)
+    return json.dumps(payload, default=_json_default, separators=(',', ':')).encode()
+
+
+def decode(body, content_type):
+    if not body:
+        return {}
+    if content_type == MSGPACK:
+        return msgpack.unpackb(body, raw=False, strict_map_key=False)
+    return json.loads(body)
+
+
+def compress(body, encoding):
+    # level 1: about twice as fast as the default for ~10% larger output
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=1)
+    return zlib.compress(body, 1)
+
+
+def decompress(body, encoding):
+    if encoding == 'gzip':
+        return gzip.decompress(body)
+    if encoding == 'deflate':
+        return zlib.decompress(body)
+    return body
+
+
+def negotiate(content_type, accept):
+    """
+    Picks the response format: MessagePack if the client asked for it with
+    Accept, or sent its request in it without stating a preference.
+    """
+    if msgpack is None:
+        return JSON
+    accept = accept or ''
+    if MSGPACK in accept or (content_type == MSGPACK and JSON not in accept):
+        return MSGPACK
+    return JSON
+
+
+def accepted_encoding(accept_encoding):
+    accept_encoding = accept_encoding or ''
+    if 'gzip' in accept_encoding:
+        return 'gzip'
+    if 'deflate' in accept_encoding:
+        return 'deflate'
+    return None
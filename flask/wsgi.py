@@ -0,0 +1,12 @@
+"""
+WSGI entry point, e.g. for a single gunicorn worker process:
+
+    gunicorn --threads 16 --bind 0.0.0.0:5000 wsgi:app
+
+Importing app.py only builds the store; this also restores its persisted
+data and starts its background threads (see app.start_services). serve.py
+loads its workers from here too.
+"""
+from app import app, start_services
+
+start_services()
@@ -0,0 +1,684 @@
+"""
+Tests of the Flask store endpoints, through the Flask test client.
+
+    python -m pytest tests
+"""
+import gzip
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'flask'))
+import app  # noqa: E402
+import wire  # noqa: E402
+from kv_store import DataStore  # noqa: E402
+from persistence import Persistence  # noqa: E402
+from pubsub import PubSub  # noqa: E402
+from store_service import StoreService  # noqa: E402
+
+
+@pytest.fixture
+def client():
+    app.data_store.clear()
+    return app.app.test_client()
+
+
+def command(client, name, *args):
+    return client.post('/command', json={'command': name, 'args': list(args)})
+
+
+@pytest.mark.parametrize('name, args', [('SET', [1, 'x']), ('PUSH', [1, 'x']), ('INCRBY', [1.5, 1]),
+                                        ('HSET', [True, {'field': 1}]), ('SADD', [None, ['a']]),
+                                        ('SETPATH', [1, 'a', 'x'])])
+def test_non_str_key_is_refused(client, name, args):
+    response = command(client, name, *args)
+    assert response.status_code == 400
+    assert response.json['error'].startswith('Keys must be strings')
+    assert command(client, 'LIST_KEYS').json['result'] == []
+
+
+def test_pipeline_reports_errors_per_command(client):
+    response = client.post('/command', json={'commands': [
+        {'command': 'SET', 'args': ['a', 1]},
+        {'command': 'INCRBY', 'args': ['a', 'x']},      # not a number
+        {'command': 'SET', 'args': ['b']},              # missing the value
+        'GET',                                          # not a command object
+        {'command': 'PUSH', 'args': [['list'], 1]},     # refused by the store
+        {'command': 'GET', 'args': ['a']},
+    ]})
+    assert response.status_code == 200
+    assert response.json['results'] == [True, None, None, None, None, {'a': 1}]
+    errors = response.json['errors']
+    assert sorted(errors) == ['1', '2', '3', '4']
+    assert errors['2'].startswith('ValueError')
+    assert errors['4'].startswith('Keys must be strings')
+
+
+def test_wsgi_entry_point_starts_the_store_services():
+    import wsgi  # noqa: F401
+    assert app.data_store.data_store.reaper_thread.is_alive()
+
+
+def test_store_service_logs_summaries(caplog):
+    service = StoreService(DataStore(), dump_interval=0.01)
+    service.set('a', 1)
+    with caplog.at_level(logging.INFO, logger='store_service'):
+        service.start()
+        time.sleep(0.1)
+        service.stop()
+    assert 'data_store: 1 keys' in caplog.text
+
+
+def test_metrics_render_the_store_gauges(client):
+    command(client, 'SET', 'a', 1)
+    text = client.get('/metrics').get_data(as_text=True)
+    assert '\nstore_keys 1\n' in text
+    assert '# TYPE store_expired_keys_total counter\n' in text
+
+
+@pytest.mark.parametrize('settings', [{'level': 'LOUD'}, {'level': [10]}, {'sample_rate': 'half'},
+                                      {'level': 'DEBUG', 'max_chars': 'many'}])
+def test_logging_refuses_invalid_settings(client, settings):
+    before = client.get('/logging').json['result']
+    response = client.post('/logging', json=settings)
+    assert response.status_code == 400
+    assert response.json['error']
+    assert client.get('/logging').json['result'] == before
+
+
+def test_logging_changes_settings(client):
+    before = client.get('/logging').json['result']
+    try:
+        response = client.post('/logging', json={'level': 'warning', 'max_chars': 50})
+        assert response.json['result'] == dict(before, level='WARNING', max_chars=50)
+    finally:
+        client.post('/logging', json=before)
+
+
+def test_audit_log_truncates_and_samples(client, caplog):
+    before = client.get('/logging').json['result']
+    try:
+        client.post('/logging', json={'level': 'INFO', 'sample_rate': 1, 'max_chars': 20})
+        with caplog.at_level(logging.INFO):
+            command(client, 'SET', 'big', 'x' * 100000)
+        message, = [record.getMessage() for record in caplog.records if '-SET-data:' in record.getMessage()]
+        assert len(message) < 200
+        assert '(+99980 chars)' in message
+        caplog.clear()
+        client.post('/logging', json={'sample_rate': 0})
+        with caplog.at_level(logging.INFO):
+            for _ in range(20):
+                command(client, 'HAS', 'big')
+        assert not [record for record in caplog.records if '-HAS-data:' in record.getMessage()]
+    finally:
+        client.post('/logging', json=before)
+
+
+def later(delay, func, *args):
+    # runs func in another thread while the test client blocks on a request
+    timer = threading.Timer(delay, func, args)
+    timer.start()
+    return timer
+
+
+def test_wait_times_out(client):
+    start = time.monotonic()
+    response = client.post('/wait', json={'keys': ['event'], 'timeout': 0.2})
+    assert response.json['result'] is None
+    assert 0.2 <= time.monotonic() - start < 2
+
+
+def test_wait_wakes_on_a_write(client):
+    timer = later(0.1, app.data_store.push, 'event', 'hello')
+    start = time.monotonic()
+    response = client.post('/wait', json={'keys': ['other', 'event'], 'timeout': 10})
+    timer.join()
+    assert response.json['result'] == {'event': ['hello']}
+    assert time.monotonic() - start < 5
+    # without drain the value stays
+    assert command(client, 'HAS', 'event').json['result'] is True
+
+
+def test_wait_drains_what_it_returns(client):
+    command(client, 'PUSH', 'event', 1)
+    response = client.post('/wait', json={'keys': 'event', 'timeout': 1, 'drain': True})
+    assert response.json['result'] == {'event': [1]}
+    assert command(client, 'HAS', 'event').json['result'] is False
+
+
+def test_push_and_drain(client):
+    assert command(client, 'PUSH', 'queue', 'a').json['result'] == 1
+    assert command(client, 'PUSH', 'queue', 'b').json['result'] == 2
+    assert command(client, 'DRAIN', 'queue', 'missing').json['result'] == {'queue': ['a', 'b']}
+    assert command(client, 'DRAIN', 'queue').json['result'] is None
+
+
+def test_concurrent_pushes_are_not_lost(client):
+    def push(worker):
+        worker_client = app.app.test_client()
+        for index in range(50):
+            command(worker_client, 'PUSH', 'queue', [worker, index])
+
+    threads = [threading.Thread(target=push, args=(worker,)) for worker in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    drained = command(client, 'DRAIN', 'queue').json['result']['queue']
+    assert sorted(drained) == [[worker, index] for worker in range(8) for index in range(50)]
+
+
+def metric_value(client, line_start):
+    for line in client.get('/metrics').get_data(as_text=True).splitlines():
+        if line.startswith(line_start + ' '):
+            return float(line.rsplit(' ', 1)[1])
+    return 0.0
+
+
+def test_metrics_count_commands(client):
+    sets = metric_value(client, 'store_commands_total{command="SET"}')
+    timed = metric_value(client, 'store_command_duration_seconds_count{command="SET"}')
+    unknown = metric_value(client, 'store_commands_total{command="UNKNOWN"}')
+    errors = metric_value(client, 'store_command_errors_total{command="INCRBY"}')
+    command(client, 'SET', 'a', 1)
+    command(client, 'SET', 'a', 2)
+    command(client, 'NO_SUCH_COMMAND')
+    command(client, 'INCRBY', 'a', 'x')
+    assert metric_value(client, 'store_commands_total{command="SET"}') == sets + 2
+    assert metric_value(client, 'store_command_duration_seconds_count{command="SET"}') == timed + 2
+    # arbitrary command names don't become labels
+    assert metric_value(client, 'store_commands_total{command="UNKNOWN"}') == unknown + 1
+    assert metric_value(client, 'store_command_errors_total{command="INCRBY"}') == errors + 1
+
+
+def test_ttl_expiry(client):
+    app.start_services()
+    expired = app.data_store.stats()['expired_keys']
+    command(client, 'SET', 'session', 'x', {'ttl': 0.2})
+    command(client, 'SET', 'kept', 'y', {'ttl': 0.2})
+    assert 0 < command(client, 'TTL', 'session').json['result'] <= 0.2
+    # a SET without ttl clears the TTL
+    command(client, 'SET', 'kept', 'y')
+    assert command(client, 'TTL', 'kept').json['result'] == -1
+    # the reaper removes the key without anyone reading it
+    deadline = time.monotonic() + 5
+    while 'session' in app.data_store.data_store.data and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert 'session' not in app.data_store.data_store.data
+    assert app.data_store.stats()['expired_keys'] == expired + 1
+    assert command(client, 'GET', 'session').json['result'] is None
+    assert command(client, 'TTL', 'session').json['result'] == -2
+    assert command(client, 'GET', 'kept').json['result'] == {'kept': 'y'}
+
+
+def test_write_over_maxmemory_is_refused(client, monkeypatch):
+    monkeypatch.setattr(app.data_store.data_store, 'maxmemory', 1000)
+    assert command(client, 'SET', 'a', 'x' * 500).json['result'] is True
+    response = command(client, 'SET', 'b', 'x' * 600)
+    assert response.status_code == 507
+    assert response.json['error'].startswith('OOM')
+    assert command(client, 'SET', 'c', 'x' * 2000).status_code == 507
+    # overwriting a key only needs room for the difference
+    assert command(client, 'SET', 'a', 'x' * 900).status_code == 200
+    assert command(client, 'LIST_KEYS').json['result'] == ['a']
+
+
+def test_lru_eviction_makes_room():
+    store = DataStore(maxmemory=1000, eviction_policy='allkeys-lru')
+    for key in ('a', 'b', 'c'):
+        app.execute_command('SET', [key, 'x' * 300], store=store)
+    app.execute_command('GET', 'a', store=store)
+    app.execute_command('SET', ['d', 'x' * 300], store=store)
+    # b was the least recently used
+    assert sorted(store.keys()) == ['a', 'c', 'd']
+    assert store.evicted_keys == 1
+    assert store.used_memory <= 1000
+
+
+def persistent_service(directory):
+    store, file_registry = DataStore(), {}
+    persistence = Persistence(str(directory), store, file_registry, fsync_policy='always',
+                              snapshot_interval=3600)
+    return StoreService(store, persistence, file_registry)
+
+
+def run(service, name, *args):
+    result = app.execute_command(name, list(args), store=service)
+    service.wait_synced()
+    return result
+
+
+def test_persistence_replays_snapshot_and_log(tmp_path):
+    service = persistent_service(tmp_path)
+    service.start()
+    run(service, 'SET', 'a', {'x': 1})
+    run(service, 'SET', 'session', 'x', {'ttl': 600})
+    run(service, 'PUSH', 'queue', 1)
+    run(service, 'HSET', 'user', {'name': 'ann'})
+    service.register_file('saved.txt', 'original.txt')
+    service.persistence.snapshot()
+    # written after the snapshot, so only in the log
+    run(service, 'PUSH', 'queue', 2)
+    run(service, 'SETPATH', 'a', 'y', 2)
+    run(service, 'INCRBY', 'count', 5)
+    run(service, 'SET', 'gone', 1)
+    run(service, 'DELETE', 'gone')
+    run(service, 'SET', 'expired', 1, {'ttl': 0.05})
+    versions = run(service, 'GET', 'a', 'queue', {})['values']
+    service.stop()
+    time.sleep(0.1)
+
+    restored = persistent_service(tmp_path)
+    restored.persistence.load()
+    assert sorted(restored.keys()) == ['a', 'count', 'queue', 'session', 'user']
+    assert run(restored, 'GET', 'a', 'queue', 'user', 'count') == {
+        'a': {'x': 1, 'y': 2}, 'queue': [1, 2], 'user': {'name': 'ann'}, 'count': 5}
+    assert 590 < run(restored, 'TTL', 'session') <= 600
+    assert restored.lookup_file('saved.txt') == 'original.txt'
+    # the revision restarts from the clock, so a version handed out before
+    # the restart never claims a restored value is unchanged
+    held = {key: version for key, (version, _) in versions.items()}
+    assert sorted(run(restored, 'GET', 'a', 'queue', {'versions': held})['values']) == ['a', 'queue']
+
+
+def test_torn_log_tail_is_dropped(tmp_path):
+    service = persistent_service(tmp_path)
+    service.start()
+    run(service, 'SET', 'a', 1)
+    run(service, 'SET', 'b', 2)
+    service.stop()
+    log_path, = tmp_path.glob('appendonly.*.log')
+    # a crash in the middle of the last record
+    log_path.write_bytes(log_path.read_bytes()[:-3])
+
+    restored = persistent_service(tmp_path)
+    restored.persistence.load()
+    assert run(restored, 'GET', 'a', 'b') == {'a': 1}
+    restored.start()
+    run(restored, 'SET', 'c', 3)
+    restored.stop()
+
+    again = persistent_service(tmp_path)
+    again.persistence.load()
+    assert run(again, 'GET', 'a', 'b', 'c') == {'a': 1, 'c': 3}
+
+
+def scan_all(client, *options):
+    cursor, pages, found = None, 0, []
+    while True:
+        cursor, keys = command(client, 'SCAN', cursor, *options).json['result']
+        pages += 1
+        found.extend(keys)
+        if cursor is None:
+            return found, pages
+
+
+def test_scan_pages_through_the_keyspace(client):
+    for index in range(25):
+        command(client, 'SET', f'user:{index:02}', index)
+        command(client, 'SET', f'item:{index:02}', index)
+    keys, pages = scan_all(client, {'match': 'user:*', 'count': 10})
+    assert keys == [f'user:{index:02}' for index in range(25)]
+    assert pages == 3
+    keys, _ = scan_all(client, {'match': 'user:1?', 'count': 4})
+    assert keys == [f'user:{index}' for index in range(10, 20)]
+    cursor, pairs = command(client, 'SCAN', None, {'prefix': 'item:', 'count': 2, 'values': True}).json['result']
+    assert pairs == [['item:00', 0], ['item:01', 1]]
+
+
+def test_scan_returns_keys_present_throughout_exactly_once(client):
+    for index in range(20):
+        command(client, 'SET', f'key:{index:02}', index)
+    cursor, first = command(client, 'SCAN', None, {'count': 5}).json['result']
+    # changes between pages don't repeat or skip the keys that stay
+    command(client, 'DELETE', 'key:02')
+    command(client, 'DELETE', 'key:10')
+    command(client, 'SET', 'key:00a', 'new')
+    rest = []
+    while cursor is not None:
+        cursor, keys = command(client, 'SCAN', cursor, {'count': 5}).json['result']
+        rest.extend(keys)
+    found = first + rest
+    assert len(found) == len(set(found))
+    assert set(found) >= {f'key:{index:02}' for index in range(20)} - {'key:02', 'key:10'}
+    assert 'key:10' not in found
+
+
+def test_publish_fans_out_to_every_subscriber(client):
+    first = command(client, 'SUBSCRIBE', ['chat']).json['result']
+    second = command(client, 'SUBSCRIBE', [], {'patterns': ['chat*']}).json['result']
+    try:
+        assert command(client, 'PUBLISH', 'chat', 'hello').json['result'] == 2
+        assert command(client, 'PUBLISH', 'chatter', 'hi').json['result'] == 1
+        assert command(client, 'RECEIVE', first).json['result'] == {
+            'messages': [{'channel': 'chat', 'pattern': None, 'data': 'hello'}], 'dropped': 0}
+        assert command(client, 'RECEIVE', second).json['result']['messages'] == [
+            {'channel': 'chat', 'pattern': 'chat*', 'data': 'hello'},
+            {'channel': 'chatter', 'pattern': 'chat*', 'data': 'hi'}]
+        # messages are not stored for later subscribers
+        assert command(client, 'RECEIVE', first).json['result']['messages'] == []
+    finally:
+        command(client, 'UNSUBSCRIBE', first)
+        command(client, 'UNSUBSCRIBE', second)
+    assert command(client, 'PUBLISH', 'chat', 'nobody').json['result'] == 0
+
+
+def test_receive_waits_for_a_message(client):
+    subscription = command(client, 'SUBSCRIBE', ['chat']).json['result']
+    try:
+        timer = later(0.1, app.data_store.publish, 'chat', 'hello')
+        start = time.monotonic()
+        response = client.post('/receive', json={'subscription': subscription, 'timeout': 10})
+        timer.join()
+        assert response.json['result']['messages'][0]['data'] == 'hello'
+        assert time.monotonic() - start < 5
+    finally:
+        command(client, 'UNSUBSCRIBE', subscription)
+    response = client.post('/receive', json={'subscription': subscription, 'timeout': 0.1})
+    assert response.status_code == 404
+
+
+def test_slow_subscriber_drops_its_oldest_messages():
+    service = StoreService(DataStore(), pubsub=PubSub(buffer_size=2))
+    slow = app.execute_command('SUBSCRIBE', [['chat']], store=service)
+    for index in range(5):
+        app.execute_command('PUBLISH', ['chat', index], store=service)
+    received = app.execute_command('RECEIVE', [slow], store=service)
+    assert [message['data'] for message in received['messages']] == [3, 4]
+    assert received['dropped'] == 3
+    assert service.stats()['dropped_messages'] == 3
+
+
+def test_consumer_group_redelivers_unacknowledged_entries():
+    service = StoreService(DataStore())
+    assert app.execute_command('XGROUP', ['jobs', 'workers', {'visibility_timeout': 0.2}], store=service) is True
+    app.execute_command('XGROUP', ['jobs', 'audit', {'start': 0}], store=service)
+    for job in ('a', 'b', 'c'):
+        app.execute_command('XADD', ['jobs', job], store=service)
+    first = app.execute_command('XREADGROUP', ['jobs', 'workers', 'one', {'count': 2}], store=service)
+    second = app.execute_command('XREADGROUP', ['jobs', 'workers', 'two'], store=service)
+    assert first == [[1, 'a'], [2, 'b']]
+    assert second == [[3, 'c']]
+    assert app.execute_command('XACK', ['jobs', 'workers', [1, 3]], store=service) == 2
+    pending = app.execute_command('XPENDING', ['jobs', 'workers'], store=service)
+    assert pending['count'] == 1 and pending['consumers'] == {'one': 1}
+    # 'one' crashed before acknowledging b: it goes to the next reader
+    assert app.execute_command('XREADGROUP', ['jobs', 'workers', 'two'], store=service) == []
+    time.sleep(0.25)
+    assert app.execute_command('XREADGROUP', ['jobs', 'workers', 'two'], store=service) == [[2, 'b']]
+    # every group reads the whole stream on its own
+    assert app.execute_command('XREADGROUP', ['jobs', 'audit', 'reader', {'count': 10}], store=service) == [
+        [1, 'a'], [2, 'b'], [3, 'c']]
+    assert service.stats()['pending_entries'] == 4
+
+
+def test_unknown_consumer_group_is_not_found(client):
+    command(client, 'XADD', 'test-unknown-group', 'a')
+    response = command(client, 'XREADGROUP', 'test-unknown-group', 'nobody', 'consumer')
+    assert response.status_code == 404
+    assert command(client, 'XREADGROUP', 'test-no-stream', 'nobody', 'consumer').status_code == 404
+
+
+def test_read_returns_only_new_entries(client):
+    for value in ('a', 'b', 'c'):
+        command(client, 'PUSH', 'log', value)
+    entries = command(client, 'READ', {'log': 0}).json['result']['log']
+    assert [value for _, value in entries] == ['a', 'b', 'c']
+    first, second, third = (entry_id for entry_id, _ in entries)
+    assert first < second < third
+    assert command(client, 'READ', {'log': second}).json['result'] == {'log': [[third, 'c']]}
+    assert command(client, 'READ', {'log': 0}, {'count': 1}).json['result'] == {'log': [[first, 'a']]}
+    assert command(client, 'READ', {'log': third, 'missing': 0}).json['result'] is None
+    # trim drops what the only consumer has seen; ids stay where they were
+    assert command(client, 'READ', {'log': second}, {'trim': True}).json['result'] == {'log': [[third, 'c']]}
+    assert command(client, 'GET', 'log').json['result'] == {'log': ['c']}
+    command(client, 'PUSH', 'log', 'd')
+    assert command(client, 'READ', {'log': third}).json['result'] == {'log': [[third + 1, 'd']]}
+    # a new list under the same key never reuses ids
+    command(client, 'DELETE', 'log')
+    command(client, 'PUSH', 'log', 'e')
+    (entry_id, _), = command(client, 'READ', {'log': 0}).json['result']['log']
+    assert entry_id > third + 1
+
+
+def test_wait_after_returns_new_entries(client):
+    command(client, 'PUSH', 'log', 'a')
+    (seen, _), = command(client, 'READ', {'log': 0}).json['result']['log']
+    timer = later(0.1, app.data_store.push, 'log', 'b')
+    response = client.post('/wait', json={'after': {'log': seen}, 'timeout': 10})
+    timer.join()
+    assert response.json['result'] == {'log': [[seen + 1, 'b']]}
+    response = client.post('/wait', json={'after': {'log': seen + 1}, 'timeout': 0.1})
+    assert response.json['result'] is None
+
+
+def test_conditional_get_answers_not_modified(client):
+    command(client, 'SET', 'a', {'x': 1})
+    command(client, 'SET', 'b', 2)
+    first = command(client, 'GET', 'a', 'b', 'missing', {}).json['result']
+    versions = {key: version for key, (version, _) in first['values'].items()}
+    assert first['values']['a'][1] == {'x': 1}
+    assert first['not_modified'] == []
+    # nothing written since: the revision alone answers
+    assert command(client, 'GET', 'a', 'b', {'versions': versions, 'revision': first['revision']}).json['result'] == {
+        'revision': first['revision'], 'not_modified': True}
+    command(client, 'SET', 'b', 3)
+    result = command(client, 'GET', 'a', 'b', 'missing',
+                     {'versions': dict(versions, missing=0), 'revision': first['revision']}).json['result']
+    assert result['revision'] > first['revision']
+    assert result['not_modified'] == ['a', 'missing']
+    assert result['values'] == {'b': [result['revision'], 3]}
+
+
+def test_conditional_drain_skips_the_keys_when_unchanged(client):
+    command(client, 'PUSH', 'queue', 1)
+    result = command(client, 'DRAIN', 'queue', {'revision': None}).json['result']
+    assert result['values'] == {'queue': [1]}
+    # the drain was a write itself, so the next poll still reads once
+    result = command(client, 'DRAIN', 'queue', {'revision': result['revision']}).json['result']
+    assert result['values'] is None
+    assert command(client, 'DRAIN', 'queue', {'revision': result['revision']}).json['result'] is None
+    command(client, 'PUSH', 'queue', 2)
+    assert command(client, 'DRAIN', 'queue', {'revision': result['revision']}).json['result']['values'] == {
+        'queue': [2]}
+
+
+def test_msgpack_requests_get_msgpack_back(client):
+    msgpack = pytest.importorskip('msgpack')
+    body = msgpack.packb({'command': 'SET', 'args': ['blob', b'\x00\xff']})
+    assert client.post('/command', data=body, content_type=wire.MSGPACK).status_code == 200
+    response = client.post('/command', data=msgpack.packb({'command': 'GET', 'args': 'blob'}),
+                           content_type=wire.MSGPACK)
+    assert response.mimetype == wire.MSGPACK
+    assert msgpack.unpackb(response.data) == {'result': b'\x00\xff'}
+    # bytes reach JSON clients base64-encoded
+    assert command(client, 'GET', 'blob').json['result'] == {'blob': 'AP8='}
+    # an explicit Accept wins over the request format
+    response = client.post('/command', data=msgpack.packb({'command': 'HAS', 'args': ['blob']}),
+                           content_type=wire.MSGPACK, headers={'Accept': wire.JSON})
+    assert response.json == {'result': True}
+
+
+def test_gzip_request_and_response(client):
+    value = 'x' * (app.COMPRESS_MIN_BYTES * 2)
+    body = gzip.compress(json.dumps({'command': 'SET', 'args': ['big', value]}).encode())
+    response = client.post('/command', data=body, content_type=wire.JSON,
+                           headers={'Content-Encoding': 'gzip'})
+    assert response.status_code == 200
+    response = client.post('/command', json={'command': 'GET', 'args': 'big'},
+                           headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert json.loads(gzip.decompress(response.data)) == {'result': value}
+    # small responses are not worth compressing
+    response = client.post('/command', json={'command': 'HAS', 'args': ['big']},
+                           headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in response.headers
+
+
+def test_undecodable_body_is_a_bad_request(client):
+    response = client.post('/command', data=b'not gzip', content_type=wire.JSON,
+                           headers={'Content-Encoding': 'gzip'})
+    assert response.status_code == 400
+
+
+def test_hash_commands(client):
+    assert command(client, 'HSET', 'user', {'name': 'ann', 'age': 30}).json['result'] == 2
+    assert command(client, 'HSET', 'user', {'age': 31, 'city': 'Oslo'}).json['result'] == 1
+    assert command(client, 'HGET', 'user', 'age').json['result'] == 31
+    assert command(client, 'HGETALL', 'user').json['result'] == {'name': 'ann', 'age': 31, 'city': 'Oslo'}
+    assert command(client, 'HDEL', 'user', ['name', 'age', 'missing']).json['result'] == 2
+    assert command(client, 'HDEL', 'user', ['city']).json['result'] == 1
+    # the key goes away with its last field
+    assert command(client, 'HAS', 'user').json['result'] is False
+    command(client, 'SET', 'plain', 'text')
+    response = command(client, 'HSET', 'plain', {'a': 1})
+    assert response.status_code == 400
+    assert response.json['error'].startswith('WRONGTYPE')
+
+
+def test_counters_are_not_lost_under_concurrency(client):
+    def increment():
+        worker_client = app.app.test_client()
+        for _ in range(50):
+            command(worker_client, 'INCRBY', 'count', 2)
+
+    threads = [threading.Thread(target=increment) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert command(client, 'INCRBY', 'count').json['result'] == 801
+    command(client, 'SET', 'name', 'ann')
+    assert command(client, 'INCRBY', 'name', 1).json['error'].startswith('WRONGTYPE')
+
+
+def test_set_commands(client):
+    assert command(client, 'SADD', 'tags', ['a', 'b', 'a']).json['result'] == 2
+    assert command(client, 'SADD', 'tags', ['b', 'c']).json['result'] == 1
+    assert sorted(command(client, 'SMEMBERS', 'tags').json['result']) == ['a', 'b', 'c']
+    assert command(client, 'SREM', 'tags', ['a', 'missing']).json['result'] == 1
+    assert command(client, 'SADD', 'tags', [['unhashable']]).status_code == 400
+    assert command(client, 'SREM', 'tags', ['b', 'c']).json['result'] == 2
+    assert command(client, 'SMEMBERS', 'tags').json['result'] == []
+    assert command(client, 'HAS', 'tags').json['result'] is False
+
+
+def test_get_projects_a_path(client):
+    chat = {'config': {'llm': 'small'},
+            'messages': [{'role': 'user', 'content': str(index)} for index in range(10)]}
+    command(client, 'SET', 'chat', chat)
+    command(client, 'SET', 'other', {'config': {}})
+    assert command(client, 'GET', 'chat', 'other', {'path': 'config.llm'}).json['result'] == {'chat': 'small'}
+    assert command(client, 'GET', 'chat', {'path': 'messages[-2:].content'}).json['result'] == {
+        'chat': ['8', '9']}
+    assert command(client, 'GET', 'chat', {'path': "$['config']"}).json['result'] == {
+        'chat': {'llm': 'small'}}
+    assert command(client, 'GET', 'chat', {'path': 'messages[99]'}).json['result'] is None
+    assert command(client, 'GET', 'chat', {'path': 'messages[oops'}).status_code == 400
+
+
+def test_setpath_assigns_and_appends(client):
+    assert command(client, 'SETPATH', 'chat', 'config.llm', 'small').json['result'] is True
+    assert command(client, 'SETPATH', 'chat', 'messages', 'hi', {'append': True}).json['result'] == 1
+    assert command(client, 'SETPATH', 'chat', 'messages', 'there', {'append': True}).json['result'] == 2
+    command(client, 'SETPATH', 'chat', 'messages[0]', 'hello')
+    assert command(client, 'GET', 'chat').json['result'] == {
+        'chat': {'config': {'llm': 'small'}, 'messages': ['hello', 'there']}}
+    # the whole value when the path is empty
+    assert command(client, 'SETPATH', 'log', '', 'entry', {'append': True}).json['result'] == 1
+    response = command(client, 'SETPATH', 'chat', 'config.llm.name', 'x')
+    assert response.status_code == 400
+    assert command(client, 'GET', 'chat', {'path': 'config'}).json['result'] == {'chat': {'llm': 'small'}}
+
+
+@pytest.mark.parametrize('overflow, kept, length', [('drop_oldest', [3, 4, 5], 3), ('drop_newest', [1, 2, 3], 3)])
+def test_bounded_queue_drops_entries(client, overflow, kept, length):
+    for value in range(1, 6):
+        response = command(client, 'PUSH', 'queue', value, {'maxlen': 3, 'overflow': overflow})
+    assert response.json['result'] == length
+    assert command(client, 'GET', 'queue').json['result'] == {'queue': kept}
+    info = command(client, 'QUEUE_INFO', 'queue').json['result']['queue']
+    assert (info['length'], info['dropped'], info['rejected']) == (3, 2, 0)
+
+
+def test_full_queue_rejects_or_blocks(client):
+    assert command(client, 'QUEUE_LIMIT', 'queue', 2, {'overflow': 'reject'}).json['result'] is True
+    try:
+        command(client, 'PUSH', 'queue', 1)
+        command(client, 'PUSH', 'queue', 2)
+        response = command(client, 'PUSH', 'queue', 3)
+        assert response.status_code == 429
+        assert command(client, 'QUEUE_INFO', 'queue').json['result']['queue'] == {
+            'length': 2, 'maxlen': 2, 'overflow': 'reject', 'dropped': 0, 'rejected': 1}
+        # a blocked producer goes on once a consumer makes room
+        timer = later(0.1, app.data_store.drain, ['queue'])
+        start = time.monotonic()
+        response = command(client, 'PUSH', 'queue', 3, {'overflow': 'block', 'timeout': 10})
+        timer.join()
+        assert response.json['result'] == 1
+        assert time.monotonic() - start < 5
+        command(client, 'PUSH', 'queue', 4)
+        response = command(client, 'PUSH', 'queue', 5, {'overflow': 'block', 'timeout': 0.1})
+        assert response.status_code == 429
+    finally:
+        command(client, 'QUEUE_LIMIT', 'queue', None)
+    assert command(client, 'QUEUE_INFO', 'queue').json['result']['queue']['maxlen'] == 0
+
+
+def version_of(client, key):
+    values = command(client, 'GET', key, {}).json['result']['values']
+    return values[key][0] if key in values else 0
+
+
+def test_cas_refuses_a_stale_version(client):
+    created = command(client, 'CAS', 'a', 0, 1).json['result']
+    assert created == version_of(client, 'a')
+    # the key exists now, so "must not exist" fails
+    assert command(client, 'CAS', 'a', 0, 2).json['result'] is None
+    command(client, 'SET', 'a', 3)
+    assert command(client, 'CAS', 'a', created, 4).json['result'] is None
+    assert command(client, 'CAS', 'a', version_of(client, 'a'), 5).json['result'] > created
+    assert command(client, 'GET', 'a').json['result'] == {'a': 5}
+
+
+def test_cas_retries_lose_no_updates(client):
+    command(client, 'SET', 'count', 0)
+
+    def increment():
+        worker_client = app.app.test_client()
+        for _ in range(20):
+            while True:
+                version, value = command(worker_client, 'GET', 'count', {}).json['result']['values']['count']
+                if command(worker_client, 'CAS', 'count', version, value + 1).json['result'] is not None:
+                    break
+
+    threads = [threading.Thread(target=increment) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert command(client, 'GET', 'count').json['result'] == {'count': 80}
+
+
+def test_exec_applies_only_if_watched_keys_are_unchanged(client):
+    command(client, 'SET', 'balance', 10)
+    version = version_of(client, 'balance')
+    transaction = [{'command': 'SET', 'args': ['balance', 5]},
+                   {'command': 'PUSH', 'args': ['history', -5]},
+                   {'command': 'INCRBY', 'args': ['history', 1]}]     # refused: not an integer
+    result = command(client, 'EXEC', transaction, {'watch': {'balance': version}}).json['result']
+    assert result['results'] == [True, 1, None]
+    assert list(result['errors']) == ['2']
+    # balance changed since it was read: nothing is applied
+    result = command(client, 'EXEC', [{'command': 'SET', 'args': ['balance', 0]},
+                                      {'command': 'PUSH', 'args': ['history', -5]}],
+                     {'watch': {'balance': version}}).json['result']
+    assert result is None
+    assert command(client, 'GET', 'balance', 'history').json['result'] == {'balance': 5, 'history': [-5]}
+    response = command(client, 'EXEC', [{'command': 'PUBLISH', 'args': ['chat', 'x']}])
+    assert response.status_code == 400
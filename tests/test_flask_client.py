@@ -0,0 +1,81 @@
+"""
+Tests of FlaskClient against the Flask app served in a thread.
+
+    python -m pytest tests
+"""
+import os
+import sys
+import threading
+import time
+
+import pytest
+from werkzeug.serving import make_server
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'flask'))
+sys.path.insert(0, os.path.join(ROOT, 'classes'))
+import app  # noqa: E402
+import flask_client  # noqa: E402
+
+
+@pytest.fixture(scope='module')
+def server():
+    server = make_server('127.0.0.1', 0, app.app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server.server_port
+    server.shutdown()
+    thread.join()
+
+
+@pytest.fixture
+def client(server):
+    app.data_store.clear()
+    return flask_client.FlaskClient('127.0.0.1', server, long_poll=False)
+
+
+def test_get_data_returns_a_copy_of_the_cached_value(client, server):
+    client.set_data('chat', {'messages': ['hello']})
+    client.get_data('chat')['chat']['messages'].append('changed')
+    # the second read is answered "not modified" from the shared cache
+    assert client.get_data('chat') == {'chat': {'messages': ['hello']}}
+    other = flask_client.FlaskClient('127.0.0.1', server)
+    assert other.get_data('chat') == {'chat': {'messages': ['hello']}}
+
+
+def test_new_client_does_not_inherit_poll_revision(client, server):
+    for value in (1, 2):
+        client.fire_event('event', value)
+    reader = flask_client.FlaskClient('127.0.0.1', server, long_poll=False, delta_reads=True,
+                                      trim_consumed=False)
+    assert reader._fetch_events(['event'], non_blocking=True) == {'event': [1, 2]}
+    assert reader._fetch_events(['event'], non_blocking=True) is None
+    # as on a Streamlit rerun: a new client has read nothing yet
+    rerun = flask_client.FlaskClient('127.0.0.1', server, long_poll=False, delta_reads=True,
+                                     trim_consumed=False)
+    assert rerun._fetch_events(['event'], non_blocking=True) == {'event': [1, 2]}
+
+
+def test_long_poll_returns_when_an_event_is_fired(client, server):
+    listener = flask_client.FlaskClient('127.0.0.1', server, poll_timeout=5)
+    timer = threading.Timer(0.1, client.fire_event, ('event', 'hello'))
+    timer.start()
+    start = time.monotonic()
+    assert listener.listen_once('event', non_blocking=False) == 'hello'
+    timer.join()
+    assert time.monotonic() - start < 4
+    # the event was consumed
+    assert client.has_data('event') is False
+
+
+def test_clients_share_a_pooled_session(server):
+    first = flask_client.FlaskClient('127.0.0.1', server)
+    second = flask_client.FlaskClient('127.0.0.1', server)
+    assert first.session is second.session
+    assert flask_client.FlaskClient('127.0.0.1', server, pool_size=2).session is not first.session
+    adapter = first.session.get_adapter(first.base_url)
+    # POST is retried only when the request never reached the app
+    assert adapter.max_retries.read == 0
+    for index in range(20):
+        first.set_data('key', index)
+    assert second.get_data('key') == {'key': 19}
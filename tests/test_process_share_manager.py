@@ -0,0 +1,364 @@
+"""
+Tests of the ProcessSharedObject socket IPC: the length-prefixed framing and
+the pooled connections of SharedDataClient.
+
+    python -m pytest tests
+
+Each server runs in its own process, in both server modes, on a free TCP port
+or on the Unix socket named after that port number.
+"""
+import contextlib
+import errno
+import glob
+import mmap
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'classes'))
+import process_share_manager as psm  # noqa: E402
+
+KB = 1024
+MB = 1024 * KB
+
+
+@pytest.fixture(scope='module', autouse=True)
+def stop_default_manager():
+    # importing process_share_manager starts the default manager on port 50000,
+    # which these tests don't use
+    manager = psm.ProcessSharedObject.manager_process
+    if manager is not None:
+        manager.kill()
+        manager.join()
+        psm.ProcessSharedObject.manager_process = None
+    yield
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+def run_server(port, event_loop, transport, segment_release_delay):
+    # the server prints every SET/GET
+    sys.stdout = open(os.devnull, 'w')
+    psm.SEGMENT_RELEASE_DELAY = segment_release_delay
+    psm.ProcessSharedObject(port=port, event_loop=event_loop, transport=transport).start()
+
+
+def connect(port, transport):
+    if transport == 'tcp':
+        return socket.create_connection(('localhost', port))
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(psm.socket_path(port))
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def start_server(port, event_loop, transport='tcp', segment_release_delay=psm.SEGMENT_RELEASE_DELAY):
+    server = multiprocessing.Process(target=run_server, args=(port, event_loop, transport, segment_release_delay))
+    server.start()
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            connect(port, transport).close()
+            return server
+        except OSError:
+            if time.monotonic() >= deadline:
+                stop_server(server)
+                raise
+            time.sleep(0.05)
+
+
+def stop_server(server):
+    server.kill()
+    server.join()
+
+
+def segments():
+    # the shared memory segments of every client and server
+    return set(glob.glob('/dev/shm/psm_*'))
+
+
+def wait_until(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.05)
+
+
+@pytest.fixture(params=[False, True], ids=['threaded', 'event_loop'])
+def port(request):
+    port = free_port()
+    server = start_server(port, request.param)
+    yield port
+    stop_server(server)
+
+
+@pytest.fixture
+def client(port):
+    # shared memory off, so values go through the socket
+    client = psm.SharedDataClient(port=port, transport='tcp', shared_memory_min_bytes=None)
+    yield client
+    client.close()
+
+
+def send_in_pieces(sock, data, cuts):
+    """
+    Sends data split at the offsets in cuts, pausing after each piece so the
+    peer reads them separately.
+    """
+    for start, end in zip([0] + cuts, cuts + [len(data)]):
+        sock.sendall(data[start:end])
+        time.sleep(0.02)
+
+
+@pytest.mark.parametrize('size', [KB, MB, 100 * MB], ids=['1KB', '1MB', '100MB'])
+def test_round_trip(client, size):
+    value = os.urandom(KB) * (size // KB)
+    assert client.set_data('value', value).startswith('SET value')
+    assert client.get_data('value') == value
+    # the connection is still in sync after the large messages
+    assert client.has_data('value') is True
+
+
+def test_round_trip_object(client):
+    value = {'messages': [{'role': 'user', 'content': 'x' * 1000}] * 1000, 'blob': os.urandom(MB)}
+    client.set_data('chat', value)
+    assert client.get_data('chat') == value
+
+
+def test_server_reads_split_header_and_payload(port):
+    value = os.urandom(100 * KB)
+    message = b''.join(psm.encode_message(('SET', 'split', value)))
+    with socket.create_connection(('localhost', port)) as sock:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # the header in two pieces, then the payload in three
+        send_in_pieces(sock, message, [3, psm.HEADER.size, psm.HEADER.size + 10, len(message) // 2])
+        assert psm.recv_message(sock).startswith('SET split')
+        psm.send_message(sock, ('GET', 'split'))
+        assert psm.recv_message(sock) == value
+
+
+def test_recv_message_split_reads():
+    value = {'payload': os.urandom(3 * MB)}
+    data = b''.join(psm.encode_message(value))
+    reader, writer = socket.socketpair()
+    with reader, writer:
+        sender = threading.Thread(target=send_in_pieces,
+                                  args=(writer, data, [1, psm.HEADER.size - 1, psm.HEADER.size + 1, len(data) // 3]))
+        sender.start()
+        assert psm.recv_message(reader) == value
+        sender.join()
+
+
+def test_recv_message_closed_connection():
+    reader, writer = socket.socketpair()
+    with reader:
+        writer.close()
+        with pytest.raises(EOFError):
+            psm.recv_message(reader)
+
+    # closed after the header, or partway through the payload
+    data = b''.join(psm.encode_message(b'x' * KB))
+    for cut in (psm.HEADER.size, len(data) // 2):
+        reader, writer = socket.socketpair()
+        with reader:
+            writer.sendall(data[:cut])
+            writer.close()
+            with pytest.raises(ConnectionError):
+                psm.recv_message(reader)
+
+
+@pytest.mark.parametrize('event_loop', [False, True], ids=['threaded', 'event_loop'])
+def test_reconnects_after_server_restart(event_loop):
+    port = free_port()
+    server = start_server(port, event_loop)
+    client = psm.SharedDataClient(port=port, transport='tcp', shared_memory_min_bytes=None)
+    try:
+        client.set_data('key', 1)
+        assert client.idle
+        # the pooled connections die with the server: the command is retried on a new one
+        stop_server(server)
+        server = start_server(port, event_loop)
+        assert client.get_data('key') is None
+        stop_server(server)
+        server = start_server(port, event_loop)
+        with client.pipeline() as pipe:
+            pipe.set_data('key', 2).get_data('key')
+        assert pipe.results[1] == 2
+        # with no server to reconnect to, the error is raised rather than retried
+        stop_server(server)
+        with pytest.raises(ConnectionRefusedError):
+            client.get_data('key')
+    finally:
+        client.close()
+        stop_server(server)
+
+
+def test_shared_memory_only_for_local_servers():
+    assert psm.SharedDataClient(port=free_port(), transport='tcp').shared_memory_min_bytes == psm.SHARED_MEMORY_MIN_BYTES
+    assert psm.SharedDataClient(host='192.0.2.1', port=free_port()).shared_memory_min_bytes is None
+
+
+@pytest.mark.skipif(not psm.SHARED_MEMORY, reason='shared memory is POSIX only')
+def test_failed_set_unlinks_segments(port):
+    client = psm.SharedDataClient(port=port, transport='tcp')
+    before = segments()
+    try:
+        value = os.urandom(MB)
+        # a list key is unhashable: the server answers an error and stores nothing
+        assert client.set_data(['key'], value).startswith('Error: ')
+        assert segments() == before
+        with client.pipeline() as pipe:
+            pipe.set_data('key', value).set_data(['key'], value)
+        assert pipe.results[1].startswith('Error: ')
+        # only the stored value's segment is left
+        assert len(segments() - before) == 1
+        assert client.get_data('key') == value
+    finally:
+        client.close()
+        # the server is killed, so it can't unlink the stored one itself
+        for path in segments() - before:
+            os.unlink(path)
+
+
+@pytest.mark.skipif(not psm.SHARED_MEMORY, reason='shared memory is POSIX only')
+@pytest.mark.parametrize('event_loop', [False, True], ids=['threaded', 'event_loop'])
+def test_shared_memory_round_trip(event_loop):
+    port = free_port()
+    # segments are unlinked on the server's next reaping pass, a second at most
+    server = start_server(port, event_loop, segment_release_delay=0)
+    client = psm.SharedDataClient(port=port, transport='tcp')
+    before = segments()
+    try:
+        value = os.urandom(4 * psm.SHARED_MEMORY_MIN_BYTES)
+        client.set_data('blob', value)
+        first = segments() - before
+        assert len(first) == 1
+        loaded = client.get_data('blob')
+        # a read-only view of the segment itself, not a copy
+        assert isinstance(loaded, memoryview) and loaded.readonly
+        assert isinstance(loaded.obj, mmap.mmap)
+        assert loaded == value
+
+        # overwritten: the old segment goes, the new one stays
+        client.set_data('blob', value[::-1])
+        wait_until(lambda: not first & segments())
+        assert len(segments() - before) == 1
+        assert client.get_data('blob') == value[::-1]
+        # deleted: no segment is left
+        assert client.delete_data('blob') is True
+        wait_until(lambda: segments() == before)
+    finally:
+        client.close()
+        stop_server(server)
+
+
+@pytest.mark.skipif(not hasattr(socket, 'AF_UNIX'), reason='no Unix sockets')
+@pytest.mark.parametrize('event_loop', [False, True], ids=['threaded', 'event_loop'])
+def test_unix_socket_round_trip(event_loop):
+    port = free_port()
+    server = start_server(port, event_loop, transport='unix')
+    # the default for a loopback host
+    client = psm.SharedDataClient(port=port, shared_memory_min_bytes=None)
+    try:
+        assert client.transport == 'unix'
+        # only the user running the server can connect
+        assert os.stat(psm.socket_path(port)).st_mode & 0o777 == 0o600
+        for size in (KB, MB):
+            value = os.urandom(size)
+            assert client.set_data('value', value).startswith('SET value')
+            assert client.get_data('value') == value
+        with client.pipeline() as pipe:
+            pipe.set_data('a', 1).get_data('a').has_data('b')
+        assert pipe.results[1:] == [1, False]
+    finally:
+        client.close()
+        stop_server(server)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(psm.socket_path(port))
+
+
+@pytest.mark.skipif(not hasattr(socket, 'AF_UNIX'), reason='no Unix sockets')
+@pytest.mark.parametrize('event_loop', [False, True], ids=['threaded', 'event_loop'])
+def test_stale_socket_file_is_replaced(event_loop):
+    port = free_port()
+    path = psm.socket_path(port)
+    server = start_server(port, event_loop, transport='unix')
+    try:
+        # a live server keeps its socket
+        with pytest.raises(OSError) as error:
+            psm.ProcessSharedObject(port=port, transport='unix')
+        assert error.value.errno == errno.EADDRINUSE
+        # killed, it leaves the file behind, which the next server replaces
+        stop_server(server)
+        assert os.path.exists(path)
+        server = start_server(port, event_loop, transport='unix')
+        client = psm.SharedDataClient(port=port, shared_memory_min_bytes=None)
+        try:
+            client.set_data('key', 'value')
+            assert client.get_data('key') == 'value'
+        finally:
+            client.close()
+    finally:
+        stop_server(server)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+
+
+def test_event_listener_skips_an_error_reply(port, capsys):
+    listener = psm.SharedProcessBase(port)
+    client = listener.shared_object = psm.SharedDataClient(port=port, transport='tcp',
+                                                           shared_memory_min_bytes=None)
+    replies = ["Error: unhashable type: 'list'"]
+
+    def execute(commands, watched=None):
+        # the first poll is answered with an error, as the server does when a command raises
+        return replies.pop() if replies else psm.SharedDataClient.execute(client, commands, watched)
+    client.execute = execute
+    received = []
+    try:
+        listener.add_event_listener('event', received.append)
+        listener.fire_event('event', 1)
+        listener.start_listening(asynchronous=True)
+        # the error is logged rather than taken for results, and the event read on the next poll
+        wait_until(lambda: received == [1])
+    finally:
+        listener.stop_listening()
+        client.close()
+    output = capsys.readouterr().out
+    assert "Error reading events: Error: unhashable type: 'list'" in output
+    assert "Listening for event: event with value: [1]" in output
+    assert output.count("Listening for event:") == 1
+
+
+def test_event_listener_survives_the_server_going_away():
+    port = free_port()
+    server = start_server(port, False)
+    listener = psm.SharedProcessBase(port)
+    listener.shared_object = psm.SharedDataClient(port=port, transport='tcp', shared_memory_min_bytes=None)
+    received = []
+    try:
+        listener.add_event_listener('event', received.append)
+        listener.start_listening(asynchronous=True)
+        stop_server(server)
+        # polls while the server is down fail, and are retried
+        time.sleep(2.5)
+        assert listener.listener_thread.is_alive()
+        server = start_server(port, False)
+        listener.fire_event('event', 1)
+        wait_until(lambda: received == [1])
+    finally:
+        listener.stop_listening()
+        listener.shared_object.close()
+        stop_server(server)